@@ -0,0 +1,30 @@
+"""add server_id, status index to gs_serverdaemoncommands
+
+Revision ID: 31249e41337c
+Revises: 553bdd8a749f
+Create Date: 2026-10-18 09:12:41.204518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '31249e41337c'
+down_revision = '553bdd8a749f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    op.create_index('ix_gs_serverdaemoncommands_server_id_status', 'gs_serverdaemoncommands',
+                    ['server_id', 'status'])
+    op.drop_index('ix_gs_serverdaemoncommands_server_id')
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.create_index('ix_gs_serverdaemoncommands_server_id', 'gs_serverdaemoncommands',
+                    ['server_id'])
+    op.drop_index('ix_gs_serverdaemoncommands_server_id_status')
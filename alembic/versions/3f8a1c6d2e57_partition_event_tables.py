@@ -0,0 +1,139 @@
+"""monthly partitioning of event tables
+
+Revision ID: 3f8a1c6d2e57
+Revises: 9b2e4f6a8c10
+Create Date: 2026-10-19 09:41:12.330918
+
+The event tables are renamed to '<table>_old' and replaced with empty tables
+partitioned by month. Only the catalog is changed so the tables are locked
+briefly and no rows are copied in the migration. Events are written to the
+partitioned tables as soon as it commits. The existing events are moved over
+afterwards, in batches of one transaction each, with
+
+    flask tasks --tenant <tenant> move-old-events
+
+which drops each old table once it's empty. Until then the older events are
+only in the '_old' tables. Nothing in drift-base reads them back, but anything
+querying the event tables directly won't see them until they are moved.
+
+The downgrade copies every event back into an unpartitioned table in a single
+transaction, blocking writes to the event tables while it runs, so it needs
+downtime.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f8a1c6d2e57'
+down_revision = '9b2e4f6a8c10'
+branch_labels = None
+depends_on = None
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# Partitions are created this many months past the current one
+MONTHS_AHEAD = 2
+
+# table name, sequence owned by event_id, indexes, foreign keys
+EVENT_TABLES = [
+    ('ck_player_events', None,
+     [('ix_ckplayerevent_player_id_create_date', ['player_id', 'create_date'], None),
+      ('ix_ck_player_events_create_date', ['create_date'], 'brin')],
+     [('player_id', 'ck_players', 'player_id')]),
+    ('gs_matchevents', 'gs_matchevents_event_id_seq',
+     [('ix_gs_matchevents_match_id', ['match_id'], None),
+      ('ix_gs_matchevents_player_id', ['player_id'], None),
+      ('ix_gs_matchevents_create_date', ['create_date'], 'brin')],
+     []),
+    ('gs_machine_events', 'gs_machine_events_event_id_seq',
+     [('ix_gs_machine_events_machine_id', ['machine_id'], None),
+      ('ix_gs_machine_events_create_date', ['create_date'], 'brin')],
+     []),
+    ('ck_user_events', None,
+     [('ix_ckuserevent_user_id_event_date', ['user_id', 'event_date'], None),
+      ('ix_ck_user_events_create_date', ['create_date'], 'brin')],
+     [('user_id', 'ck_users', 'user_id')]),
+]
+
+# the indexes the tables had before they were partitioned
+OLD_INDEXES = {
+    'ck_player_events': [('ix_ckplayerevent_player_id_create_date', ['player_id', 'create_date']),
+                         ('ix_ck_player_events_player_id', ['player_id'])],
+    'gs_matchevents': [('ix_gs_matchevents_match_id', ['match_id']),
+                       ('ix_gs_matchevents_player_id', ['player_id'])],
+    'gs_machine_events': [('ix_gs_machine_events_machine_id', ['machine_id'])],
+    'ck_user_events': [('ix_ckuserevent_user_id_event_date', ['user_id', 'event_date']),
+                       ('ix_ck_user_events_user_id', ['user_id'])],
+}
+
+
+def _add_months(dt, months):
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def _old_index_names(table_name):
+    return ['%s_pkey' % table_name] + [index_name for index_name, _ in OLD_INDEXES[table_name]]
+
+
+def _set_sequence_owner(sequence_name, table_name):
+    # or the sequence is dropped along with the table that owns it
+    if sequence_name:
+        op.execute("ALTER SEQUENCE %s OWNED BY %s" % (
+            sequence_name, '%s.event_id' % table_name if table_name else 'NONE'))
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    now = datetime.datetime.utcnow()
+    for table_name, sequence_name, indexes, foreign_keys in EVENT_TABLES:
+        old_name = table_name + '_old'
+        op.execute("ALTER TABLE %s RENAME TO %s" % (table_name, old_name))
+        # index names are shared by all tables, the new table gets the current ones
+        for index_name in _old_index_names(table_name):
+            op.execute("ALTER INDEX %s RENAME TO %s_old" % (index_name, index_name))
+        _set_sequence_owner(sequence_name, None)
+        op.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (create_date)" % (
+            table_name, old_name))
+        _set_sequence_owner(sequence_name, table_name)
+
+        # partitions for the older events are created when they are moved over
+        op.execute("CREATE TABLE %s_default PARTITION OF %s DEFAULT" % (table_name, table_name))
+        for i in range(MONTHS_AHEAD + 1):
+            month = _add_months(now, i)
+            op.execute("CREATE TABLE %s_p%04d%02d PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+                table_name, month.year, month.month, table_name,
+                month.isoformat(), _add_months(month, 1).isoformat()))
+
+        # the partition key has to be a part of the primary key
+        op.create_primary_key('%s_pkey' % table_name, table_name, ['event_id', 'create_date'])
+        for index_name, columns, using in indexes:
+            kw = {'postgresql_using': using} if using else {}
+            op.create_index(index_name, table_name, columns, **kw)
+        for column, ref_table, ref_column in foreign_keys:
+            op.create_foreign_key('%s_%s_fkey' % (table_name, column), table_name,
+                                  ref_table, [column], [ref_column])
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    for table_name, sequence_name, indexes, foreign_keys in EVENT_TABLES:
+        old_name = table_name + '_old'
+        if not op.get_bind().execute("SELECT to_regclass('%s')" % old_name).scalar():
+            # all events have been moved, recreate the old table
+            op.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (old_name, table_name))
+            op.create_primary_key('%s_pkey_old' % table_name, old_name, ['event_id'])
+            for index_name, columns in OLD_INDEXES[table_name]:
+                op.create_index(index_name + '_old', old_name, columns)
+            for column, ref_table, ref_column in foreign_keys:
+                op.create_foreign_key('%s_%s_fkey' % (table_name, column), old_name,
+                                      ref_table, [column], [ref_column])
+        op.execute("INSERT INTO %s SELECT * FROM %s" % (old_name, table_name))
+        _set_sequence_owner(sequence_name, None)
+        op.drop_table(table_name)
+        op.execute("ALTER TABLE %s RENAME TO %s" % (old_name, table_name))
+        for index_name in _old_index_names(table_name):
+            op.execute("ALTER INDEX %s_old RENAME TO %s" % (index_name, index_name))
+        _set_sequence_owner(sequence_name, table_name)
@@ -0,0 +1,27 @@
+"""add player_id, deleted, journal_id index to ck_playerjournal
+
+Revision ID: 4d9b7f1e2a63
+Revises: c81e4d0a5f36
+Create Date: 2026-10-18 12:41:09.662180
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d9b7f1e2a63'
+down_revision = 'c81e4d0a5f36'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    op.create_index('ix_ck_playerjournal_player_id_deleted_journal_id', 'ck_playerjournal',
+                    ['player_id', 'deleted', sa.text('journal_id DESC'), sa.text('sequence_id DESC')])
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.drop_index('ix_ck_playerjournal_player_id_deleted_journal_id')
@@ -0,0 +1,36 @@
+"""delta encoded, compressed gamestate history
+
+Revision ID: 7a3c5e2f9b14
+Revises: 31249e41337c
+Create Date: 2026-10-18 10:02:17.538211
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a3c5e2f9b14'
+down_revision = '31249e41337c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    op.add_column('ck_gamestateshistory', sa.Column('packed_data', sa.LargeBinary(), nullable=True))
+    op.add_column('ck_gamestateshistory', sa.Column('is_delta', sa.Boolean(), nullable=True,
+                                                    server_default='false'))
+    op.add_column('ck_gamestateshistory', sa.Column('base_gamestatehistory_id', sa.BigInteger(),
+                                                    nullable=True))
+    op.alter_column('ck_gamestateshistory', 'data', nullable=True)
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    # Note: rows stored in 'packed_data' are lost on downgrade
+    op.execute("DELETE FROM ck_gamestateshistory WHERE data IS NULL")
+    op.alter_column('ck_gamestateshistory', 'data', nullable=False)
+    op.drop_column('ck_gamestateshistory', 'base_gamestatehistory_id')
+    op.drop_column('ck_gamestateshistory', 'is_delta')
+    op.drop_column('ck_gamestateshistory', 'packed_data')
@@ -0,0 +1,42 @@
+"""uuid tokens and expiry index on ck_friend_invites
+
+Revision ID: 9b2e4f6a8c10
+Revises: e5a0c3b7d914
+Create Date: 2026-10-18 14:02:31.518204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b2e4f6a8c10'
+down_revision = 'e5a0c3b7d914'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    # Tokens have always been issued as uuids, anything else can never be redeemed
+    op.execute(
+        "DELETE FROM ck_friend_invites "
+        "WHERE token !~* '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'"
+    )
+    op.drop_index('ix_ck_friend_invites_token')
+    op.alter_column('ck_friend_invites', 'token',
+                    type_=postgresql.UUID(as_uuid=True),
+                    postgresql_using='token::uuid')
+    op.create_index('ix_ck_friend_invites_token', 'ck_friend_invites', ['token'], unique=True)
+    op.create_index('ix_ck_friend_invites_expiry_date', 'ck_friend_invites', ['expiry_date'])
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.drop_index('ix_ck_friend_invites_expiry_date')
+    op.drop_index('ix_ck_friend_invites_token')
+    op.alter_column('ck_friend_invites', 'token',
+                    type_=sa.String(length=50),
+                    postgresql_using='token::text')
+    op.create_index('ix_ck_friend_invites_token', 'ck_friend_invites', ['token'])
@@ -0,0 +1,43 @@
+"""unique name on ck_user_identities
+
+Revision ID: c41d7e9a2b68
+Revises: 3f8a1c6d2e57
+Create Date: 2026-10-19 15:27:48.902114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c41d7e9a2b68'
+down_revision = '3f8a1c6d2e57'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    # Logins picked an arbitrary one of any duplicates, as the lookup wasn't
+    # ordered. The oldest is kept, which is the one logins pick now, and the
+    # others are renamed out of the way rather than deleted as users may refer
+    # to them. The renamed identities are listed so they can be followed up on.
+    renamed = op.get_bind().execute(
+        "UPDATE ck_user_identities SET name = left(name, 180) || ':dup:' || identity_id "
+        "WHERE identity_id IN ("
+        "    SELECT identity_id FROM ("
+        "        SELECT identity_id, row_number() OVER (PARTITION BY name ORDER BY identity_id) AS n"
+        "        FROM ck_user_identities WHERE name IS NOT NULL"
+        "    ) dups WHERE n > 1"
+        ") RETURNING identity_id, user_id, name"
+    ).fetchall()
+    for identity_id, user_id, name in renamed:
+        print("Renamed duplicate user identity {} of user {} to '{}'".format(identity_id, user_id, name))
+    op.drop_index('ix_ck_user_identities_name')
+    op.create_index('ix_ck_user_identities_name', 'ck_user_identities', ['name'], unique=True)
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.drop_index('ix_ck_user_identities_name')
+    op.create_index('ix_ck_user_identities_name', 'ck_user_identities', ['name'])
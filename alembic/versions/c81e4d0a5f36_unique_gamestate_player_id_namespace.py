@@ -0,0 +1,36 @@
+"""unique player_id, namespace on ck_gamestates
+
+Revision ID: c81e4d0a5f36
+Revises: 7a3c5e2f9b14
+Create Date: 2026-10-18 11:20:45.917302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c81e4d0a5f36'
+down_revision = '7a3c5e2f9b14'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    # Keep only the newest gamestate for each player and namespace, which is the
+    # one that has been served to clients. The others are still in the history table.
+    op.execute(
+        "DELETE FROM ck_gamestates a USING ck_gamestates b "
+        "WHERE a.player_id = b.player_id AND a.namespace = b.namespace "
+        "AND a.gamestate_id < b.gamestate_id"
+    )
+    op.create_index('ix_ck_gamestates_player_id_namespace', 'ck_gamestates',
+                    ['player_id', 'namespace'], unique=True)
+    op.drop_index('ix_ck_gamestates_player_id')
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.create_index('ix_ck_gamestates_player_id', 'ck_gamestates', ['player_id'])
+    op.drop_index('ix_ck_gamestates_player_id_namespace')
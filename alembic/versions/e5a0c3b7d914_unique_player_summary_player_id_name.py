@@ -0,0 +1,32 @@
+"""unique player_id, name on ck_player_summary
+
+Revision ID: e5a0c3b7d914
+Revises: 4d9b7f1e2a63
+Create Date: 2026-10-18 13:15:52.104377
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5a0c3b7d914'
+down_revision = '4d9b7f1e2a63'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    # Keep the newest row of any duplicated summary field
+    op.execute(
+        "DELETE FROM ck_player_summary a USING ck_player_summary b "
+        "WHERE a.player_id = b.player_id AND a.name = b.name AND a.id < b.id"
+    )
+    op.create_index('ix_ck_player_summary_player_id_name', 'ck_player_summary',
+                    ['player_id', 'name'], unique=True)
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.drop_index('ix_ck_player_summary_player_id_name')
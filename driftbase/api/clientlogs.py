@@ -12,6 +12,7 @@ from drift.core.extensions.urlregistry import Endpoints
 from drift.core.extensions.jwt import current_user
 
 from driftbase.utils import verify_log_request
+from driftbase.logshipping import ship_events, CLIENTLOG
 
 log = logging.getLogger(__name__)
 bp = Blueprint(
@@ -19,9 +20,6 @@ bp = Blueprint(
 )
 endpoints = Endpoints()
 
-clientlogger = logging.getLogger("clientlog")
-eventlogger = logging.getLogger("eventlog")
-
 
 def drift_init_extension(app, api, **kwargs):
     api.register_blueprint(bp)
@@ -56,11 +54,9 @@ class ClientLogsAPI(MethodView):
             args = [args]
         player_id = current_user["player_id"] if current_user else None
 
-        print(args)
         for event in args:
             event["player_id"] = player_id
-            print("event is; {}".format(event))
-            clientlogger.info("clientlog", extra={"extra": event})
+        ship_events(CLIENTLOG, args)
 
         if request.headers.get("Accept") == "application/json":
             return jsonify(status="OK"), http_client.CREATED
@@ -12,14 +12,12 @@ from drift.core.extensions.urlregistry import Endpoints
 from drift.core.extensions.jwt import current_user
 
 from driftbase.utils import verify_log_request
+from driftbase.logshipping import ship_events, EVENTLOG
 
 log = logging.getLogger(__name__)
 bp = Blueprint("events", __name__, url_prefix="/events", description="Client Logs")
 endpoints = Endpoints()
 
-clientlogger = logging.getLogger("clientlog")
-eventlogger = logging.getLogger("eventlog")
-
 
 def drift_init_extension(app, api, **kwargs):
     api.register_blueprint(bp)
@@ -61,7 +59,7 @@ class EventsAPI(MethodView):
                 event.setdefault("player_id", player_id)
             else:
                 event["player_id"] = player_id  # Always override!
-            eventlogger.info("eventlog", extra={"extra": event})
+        ship_events(EVENTLOG, args)
 
         if request.headers.get("Accept") == "application/json":
             return jsonify(status="OK"), http_client.CREATED
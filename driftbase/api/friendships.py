@@ -4,7 +4,7 @@ import datetime
 
 from six.moves import http_client
 
-from flask import request, g, abort, url_for, jsonify
+from flask import request, g, abort, url_for, jsonify, current_app
 from flask.views import MethodView
 import marshmallow as ma
 from flask_restx import reqparse
@@ -14,11 +14,19 @@ from drift.core.extensions.urlregistry import Endpoints
 from drift.core.extensions.jwt import current_user
 from drift.core.extensions.schemachecker import simple_schema_request
 
-from driftbase.models.db import Friendship, FriendInvite, CorePlayer
+from sqlalchemy import and_, exists
+
+from driftbase.models.db import Friendship, FriendInvite, CorePlayer, Client, \
+    DEFAULT_HEARTBEAT_TIMEOUT, utcnow
+from driftbase.friendships import are_friends, add_friendship, remove_friendship, \
+    get_mutual_friend_ids, create_redis_invite, get_redis_invite, delete_redis_invite
 
 
 DEFAULT_INVITE_EXPIRATION_TIME_SECONDS = 60 * 60 * 1
 
+# Optional sections of the friend list
+EXPANSIONS = {"player", "presence"}
+
 
 log = logging.getLogger(__name__)
 
@@ -49,22 +57,49 @@ class FriendshipsAPI(MethodView):
     def get(self, player_id):
         """
         List my friends
+
+        Pass 'expand=player,presence' to include the name and online status of each
+        friend in the response.
         """
         if player_id != current_user["player_id"]:
             abort(http_client.FORBIDDEN, description="That is not your player!")
 
-        left = g.db.query(Friendship.id, Friendship.player1_id, Friendship.player2_id).filter_by(player1_id=player_id, status="active")
-        right = g.db.query(Friendship.id, Friendship.player2_id, Friendship.player1_id).filter_by(player2_id=player_id, status="active")
-        friend_rows = left.union_all(right)
+        expand = set(filter(None, request.args.get("expand", "").split(",")))
+        unknown = expand - EXPANSIONS
+        if unknown:
+            abort(http_client.BAD_REQUEST, description="Unknown expansions: %s" % ", ".join(sorted(unknown)))
+
+        left = g.db.query(Friendship.id, Friendship.player2_id.label("friend_id")) \
+                   .filter_by(player1_id=player_id, status="active")
+        right = g.db.query(Friendship.id, Friendship.player1_id.label("friend_id")) \
+                    .filter_by(player2_id=player_id, status="active")
+        friend_rows = left.union_all(right).subquery()
+
+        columns = [friend_rows.c.id, friend_rows.c.friend_id]
+        if "player" in expand:
+            columns.append(CorePlayer.player_name)
+        if "presence" in expand:
+            heartbeat_timeout = current_app.config.get("heartbeat_timeout", DEFAULT_HEARTBEAT_TIMEOUT)
+            min_heartbeat_time = utcnow() - datetime.timedelta(seconds=heartbeat_timeout)
+            is_online = exists().where(and_(Client.player_id == friend_rows.c.friend_id,
+                                            Client.status == "active",
+                                            Client.heartbeat >= min_heartbeat_time))
+            columns.append(is_online.label("is_online"))
+        query = g.db.query(*columns)
+        if "player" in expand:
+            query = query.join(CorePlayer, CorePlayer.player_id == friend_rows.c.friend_id)
+
         friends = []
-        for row in friend_rows:
-            friendship_id = row[0]
-            friend_id = row[2]
+        for row in query:
             friend = {
-                "friend_id": friend_id,
-                "player_url": url_for("players.entry", player_id=friend_id, _external=True),
-                "friendship_url": url_for("friendships.entry", friendship_id=friendship_id, _external=True)
+                "friend_id": row.friend_id,
+                "player_url": url_for("players.entry", player_id=row.friend_id, _external=True),
+                "friendship_url": url_for("friendships.entry", friendship_id=row.id, _external=True)
             }
+            if "player" in expand:
+                friend["player"] = {"player_name": row.player_name}
+            if "presence" in expand:
+                friend["presence"] = {"is_online": row.is_online}
             friends.append(friend)
 
         ret = friends
@@ -81,25 +116,36 @@ class FriendshipsAPI(MethodView):
             abort(http_client.FORBIDDEN, description="That is not your player!")
 
         args = request.json
-        invite_token = args.get("token")
-
-        invite = g.db.query(FriendInvite).filter_by(token=invite_token).first()
-        if invite is None:
+        try:
+            invite_token = uuid.UUID(args.get("token"))
+        except ValueError:
             abort(http_client.NOT_FOUND, description="The invite was not found!")
 
-        if invite.expiry_date < datetime.datetime.utcnow():
-            abort(http_client.FORBIDDEN, description="The invite has expired!")
+        friend_id = None
+        if _invites_in_redis():
+            friend_id = get_redis_invite(g.redis, invite_token)
+        if friend_id is None:
+            # invites issued before they were moved to redis are still in the db
+            invite = g.db.query(FriendInvite).filter_by(token=invite_token).first()
+            if invite is None:
+                abort(http_client.NOT_FOUND, description="The invite was not found!")
+
+            if invite.deleted:
+                abort(http_client.FORBIDDEN, description="The invite has been deleted!")
 
-        if invite.deleted:
-            abort(http_client.FORBIDDEN, description="The invite has been deleted!")
+            if invite.expiry_date < datetime.datetime.utcnow():
+                abort(http_client.FORBIDDEN, description="The invite has expired!")
 
-        friend_id = invite.issued_by_player_id
+            friend_id = invite.issued_by_player_id
         left_id = player_id
         right_id = friend_id
 
         if left_id == right_id:
             abort(http_client.FORBIDDEN, description="You cannot befriend yourself!")
 
+        if are_friends(g.redis, g.db, player_id, friend_id):
+            return "{}", http_client.OK
+
         if left_id > right_id:
             left_id, right_id = right_id, left_id
 
@@ -117,6 +163,7 @@ class FriendshipsAPI(MethodView):
             friendship = Friendship(player1_id=left_id, player2_id=right_id)
             g.db.add(friendship)
         g.db.commit()
+        add_friendship(g.redis, player_id, friend_id)
 
         ret = {
             "friend_id": friend_id,
@@ -128,6 +175,27 @@ class FriendshipsAPI(MethodView):
         return jsonify(ret), http_client.CREATED
 
 
+@bp.route('/players/<int:player_id>/mutual/<int:other_player_id>', endpoint='mutual')
+class MutualFriendsAPI(MethodView):
+
+    def get(self, player_id, other_player_id):
+        """
+        List the friends I have in common with another player
+        """
+        if player_id != current_user["player_id"]:
+            abort(http_client.FORBIDDEN, description="That is not your player!")
+
+        friend_ids = get_mutual_friend_ids(g.redis, g.db, player_id, other_player_id)
+        ret = [
+            {
+                "friend_id": friend_id,
+                "player_url": url_for("players.entry", player_id=friend_id, _external=True),
+            }
+            for friend_id in sorted(friend_ids)
+        ]
+        return jsonify(ret)
+
+
 @bp.route('/<int:friendship_id>', endpoint='entry')
 class FriendshipAPI(MethodView):
 
@@ -148,10 +216,16 @@ class FriendshipAPI(MethodView):
         if friendship:
             friendship.status = "deleted"
             g.db.commit()
+            remove_friendship(g.redis, friendship.player1_id, friendship.player2_id)
 
         return "{}", http_client.NO_CONTENT
 
 
+def _invites_in_redis():
+    config = g.conf.tenant.get('friends')
+    return bool(config and config.get('invites_in_redis'))
+
+
 @bp.route('/invites', endpoint='invites')
 class FriendInvitesAPI(MethodView):
 
@@ -161,7 +235,7 @@ class FriendInvitesAPI(MethodView):
         """
         player_id = current_user["player_id"]
 
-        token = str(uuid.uuid4())
+        token = uuid.uuid4()
         expires_seconds = DEFAULT_INVITE_EXPIRATION_TIME_SECONDS
         config = g.conf.tenant.get('friends')
         if config:
@@ -169,19 +243,24 @@ class FriendInvitesAPI(MethodView):
         expires_seconds = expires_seconds
         expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_seconds)
 
-        invite = FriendInvite(
-            token=token,
-            issued_by_player_id=player_id,
-            expiry_date=expires
-        )
+        if _invites_in_redis():
+            create_redis_invite(g.redis, token, player_id, expires_seconds)
+            url = url_for("friendships.token_invite", token=token, _external=True)
+        else:
+            invite = FriendInvite(
+                token=token,
+                issued_by_player_id=player_id,
+                expiry_date=expires
+            )
 
-        g.db.add(invite)
-        g.db.commit()
+            g.db.add(invite)
+            g.db.commit()
+            url = url_for("friendships.invite", invite_id=invite.id, _external=True)
 
         ret = jsonify({
-            "token": token,
+            "token": str(token),
             "expires": expires,
-            "url": url_for("friendships.invite", invite_id=invite.id, _external=True)
+            "url": url
         }), http_client.CREATED
         return ret
 
@@ -204,10 +283,31 @@ class FriendInviteAPI(MethodView):
             return "{}", http_client.GONE
 
         invite.deleted = True
+        # expire it so it gets reaped
+        invite.expiry_date = min(invite.expiry_date, datetime.datetime.utcnow())
         g.db.commit()
         return "{}", http_client.NO_CONTENT
 
 
+@bp.route('/invites/<uuid:token>', endpoint='token_invite')
+class FriendTokenInviteAPI(MethodView):
+
+    def delete(self, token):
+        """
+        Delete a friend token stored in redis
+        """
+        player_id = current_user["player_id"]
+
+        issued_by_player_id = get_redis_invite(g.redis, token)
+        if issued_by_player_id is None:
+            abort(http_client.NOT_FOUND)
+        elif issued_by_player_id != player_id:
+            abort(http_client.FORBIDDEN)
+
+        delete_redis_invite(g.redis, token)
+        return "{}", http_client.NO_CONTENT
+
+
 @endpoints.register
 def endpoint_info(*args):
     ret = {}
@@ -15,6 +15,7 @@ from drift.core.extensions.schemachecker import simple_schema_request
 from drift.core.extensions.jwt import requires_roles
 
 from driftbase.models.db import Machine, MachineEvent
+from driftbase import heartbeats
 
 log = logging.getLogger(__name__)
 
@@ -91,6 +92,7 @@ class MachinesAPI(MethodView):
             record = row.as_dict()
             record["url"] = url_for("machines.entry", machine_id=row.machine_id, _external=True)
             ret.append(record)
+        heartbeats.apply_heartbeats(g.redis, heartbeats.MACHINES, ret, "machine_id")
 
         return jsonify(ret)
 
@@ -159,6 +161,7 @@ class MachineAPI(MethodView):
             log.warning("Requested a non-existant machine: %s", machine_id)
             abort(http_client.NOT_FOUND, description="Machine not found")
         record = row.as_dict()
+        heartbeats.apply_heartbeats(g.redis, heartbeats.MACHINES, [record], "machine_id")
         record["url"] = url_for("machines.entry", machine_id=machine_id, _external=True)
         record["servers_url"] = url_for("servers.list", machine_id=machine_id, _external=True)
         record["matches_url"] = url_for("matches.list", machine_id=machine_id, _external=True)
@@ -184,31 +187,36 @@ class MachineAPI(MethodView):
         Heartbeat and update the machine reference
         """
         args = request.json
-        row = g.db.query(Machine).get(machine_id)
-        if not row:
-            abort(http_client.NOT_FOUND, description="Machine not found")
-        last_heartbeat = row.heartbeat_date
-        row.heartbeat_date = utcnow()
-        if args.get("status"):
-            row.status = args["status"]
-        if args.get("details"):
-            row.details = args["details"]
-        if args.get("config"):
-            row.config = args["config"]
-        if args.get("statistics"):
-            row.statistics = args["statistics"]
-        if args.get("group_name"):
-            row.group_name = args["group_name"]
+        last_heartbeat = heartbeats.record_heartbeat(g.redis, heartbeats.MACHINES, machine_id)
+        if last_heartbeat is None:
+            row = g.db.query(Machine).get(machine_id)
+            if not row:
+                heartbeats.discard_heartbeat(g.redis, heartbeats.MACHINES, machine_id)
+                abort(http_client.NOT_FOUND, description="Machine not found")
+            last_heartbeat = row.heartbeat_date
+
+        values = {}
+        for key in ("status", "details", "config", "statistics", "group_name"):
+            if args.get(key):
+                values[key] = args[key]
+        if values:
+            g.db.query(Machine) \
+                .filter(Machine.machine_id == machine_id) \
+                .update(values, synchronize_session=False)
         if args.get("events"):
+            event_rows = []
             for event in args["events"]:
-                timestamp = parser.parse(event["timestamp"])
-                event_row = MachineEvent(event_type_name=event["event"],
-                                         machine_id=machine_id,
-                                         details=event,
-                                         create_date=timestamp)
-                g.db.add(event_row)
-
-        g.db.commit()
+                event_rows.append({
+                    "event_type_name": event["event"],
+                    "machine_id": machine_id,
+                    "details": event,
+                    "create_date": parser.parse(event["timestamp"]),
+                })
+            g.db.execute(MachineEvent.__table__.insert().values(event_rows))
+        if values or args.get("events"):
+            g.db.commit()
+
+        heartbeats.maybe_flush_heartbeats(g.redis, g.db)
         return jsonify({"last_heartbeat": last_heartbeat})
 
 
@@ -16,7 +16,8 @@ from drift.core.extensions.jwt import current_user, requires_roles
 
 from driftbase.models.db import Machine, Server, Match, MatchTeam, MatchPlayer, MatchQueuePlayer
 from driftbase.utils import log_match_event
-from driftbase.matchqueue import process_match_queue
+from driftbase.matchqueue import process_match_queue, server_may_be_alive, filter_alive_servers
+from driftbase import heartbeats
 
 log = logging.getLogger(__name__)
 
@@ -55,13 +56,14 @@ class ActiveMatchesAPI(MethodView):
         """
         args = self.get_args.parse_args()
         num_rows = args.get("rows") or 100
+        since = utcnow() - datetime.timedelta(seconds=60)
 
         query = g.db.query(Match, Server, Machine)
         query = query.filter(Server.machine_id == Machine.machine_id,
                              Match.server_id == Server.server_id,
                              Match.status.notin_(["ended", "completed"]),
                              Server.status.in_(["started", "running", "active", "ready"]),
-                             Server.heartbeat_date >= utcnow() - datetime.timedelta(seconds=60)
+                             server_may_be_alive(since)
                              )
         if args.get("ref"):
             query = query.filter(Server.ref == args.get("ref"))
@@ -78,6 +80,10 @@ class ActiveMatchesAPI(MethodView):
         query = query.order_by(-Match.num_players, -Match.server_id)
         query = query.limit(num_rows)
         rows = query.all()
+        server_heartbeats = heartbeats.get_heartbeats(g.redis, heartbeats.SERVERS,
+                                                      [row[1].server_id for row in rows])
+        rows = filter_alive_servers(g.redis, rows, since, server_index=1,
+                                    server_heartbeats=server_heartbeats)
 
         ret = []
         for row in rows:
@@ -102,6 +108,8 @@ class ActiveMatchesAPI(MethodView):
             record["server_id"] = match.server_id
             record["machine_id"] = server.machine_id
             record["heartbeat_date"] = server.heartbeat_date
+            if server.server_id in server_heartbeats:
+                record["heartbeat_date"] = server_heartbeats[server.server_id][0]
             record["realm"] = machine.realm
             record["placement"] = machine.placement
             record["ref"] = server.ref
@@ -208,7 +216,6 @@ class MatchesAPI(MethodView):
         g.db.flush()
         # ! have to set this explicitly after the row is created
         match.start_date = None
-        g.db.commit()
         match_id = match.match_id
 
         if args.get("num_teams"):
@@ -217,7 +224,10 @@ class MatchesAPI(MethodView):
                                  name="Team %s" % (i + 1)
                                  )
                 g.db.add(team)
-            g.db.commit()
+
+        log_match_event(match_id, None, "gameserver.match.created",
+                        details={"server_id": server_id})
+        g.db.commit()
 
         resource_uri = url_for("matches.entry", match_id=match_id, _external=True)
         players_resource_uri = url_for("matches.players", match_id=match_id, _external=True)
@@ -226,8 +236,6 @@ class MatchesAPI(MethodView):
         }
 
         log.info("Created match %s for server %s", match_id, server_id)
-        log_match_event(match_id, None, "gameserver.match.created",
-                        details={"server_id": server_id})
 
         try:
             process_match_queue()
@@ -267,6 +275,7 @@ class MatchAPI(MethodView):
         ret["machine_url"] = None
         if server:
             ret["server"] = server.as_dict()
+            heartbeats.apply_heartbeats(g.redis, heartbeats.SERVERS, [ret["server"]], "server_id")
             ret["server_url"] = url_for("servers.entry", server_id=server.server_id, _external=True)
 
             machine = g.db.query(Machine).get(server.machine_id)
@@ -399,16 +408,17 @@ class MatchTeamsAPI(MethodView):
                          details=args.get("details"),
                          )
         g.db.add(team)
-        g.db.commit()
+        g.db.flush()
         team_id = team.team_id
-        resource_uri = url_for("matches.team", match_id=match_id, team_id=team_id, _external=True)
-        response_header = {"Location": resource_uri}
-
-        log.info("Created team %s for match %s", team_id, match_id)
         log_match_event(match_id,
                         None,
                         "gameserver.match.team_created",
                         details={"team_id": team_id})
+        g.db.commit()
+        resource_uri = url_for("matches.team", match_id=match_id, team_id=team_id, _external=True)
+        response_header = {"Location": resource_uri}
+
+        log.info("Created team %s for match %s", team_id, match_id)
 
         return jsonify({"team_id": team_id,
                 "url": resource_uri,
@@ -551,6 +561,8 @@ class MatchPlayersAPI(MethodView):
         if match.start_date is None:
             match.start_date = utcnow()
 
+        log_match_event(match_id, player_id, "gameserver.match.player_joined",
+                        details={"team_id": team_id})
         g.db.commit()
 
         # prepare the response
@@ -561,9 +573,6 @@ class MatchPlayersAPI(MethodView):
         response_header = {"Location": resource_uri}
         log.info("Player %s has joined match %s in team %s.", player_id, match_id, team_id)
 
-        log_match_event(match_id, player_id, "gameserver.match.player_joined",
-                        details={"team_id": team_id})
-
         return jsonify({"match_id": match_id,
                 "player_id": player_id,
                 "team_id": team_id,
@@ -627,12 +636,12 @@ class MatchPlayerAPI(MethodView):
         match_player.leave_date = utcnow()
         match_player.seconds += num_seconds
 
-        g.db.commit()
-
-        log.info("Player %s has left battle %s", player_id, match_id)
         log_match_event(match_id, player_id,
                         "gameserver.match.player_left",
                         details={"team_id": team_id})
+        g.db.commit()
+
+        log.info("Player %s has left battle %s", player_id, match_id)
 
         return jsonify({"message": "Player has left the battle"})
 
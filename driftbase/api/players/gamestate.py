@@ -1,15 +1,20 @@
+import json
 import logging
 
 import marshmallow as ma
 from drift.utils import Url
-from drift.utils import json_response
-from flask import g
+from flask import g, request, make_response, url_for
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 from marshmallow_sqlalchemy import ModelSchema
 from six.moves import http_client
 
+from driftbase.gamestate import save_gamestate, get_history_data, load_history_data, \
+    schedule_history_prune
+from driftbase.gamestatecache import cache_gamestate, cache_gamestates, uncache_gamestate, \
+    get_cached_gamestate, get_cached_gamestates
 from driftbase.models.db import GameState, GameStateHistory, PlayerJournal
+from driftbase.utils.jsonpatch import apply_patch, JsonPatchError
 from driftbase.players import can_edit_player
 
 log = logging.getLogger(__name__)
@@ -20,12 +25,33 @@ MAX_DATA_LEN = 1024 * 1024  # 1MB
 
 TASK_VALIDATED = "validated"
 
+DEFAULT_HISTORY_ROWS = 50
+MAX_HISTORY_ROWS = 500
+
+HISTORY_METADATA_COLUMNS = (
+    "gamestatehistory_id", "player_id", "namespace", "version", "journal_id", "is_valid",
+    "create_date", "modify_date",
+)
+
 
 class GameStateRequestSchema(ma.Schema):
     gamestate = ma.fields.Dict()
     journal_id = ma.fields.Integer(allow_none=True)
 
 
+class GameStatePatchArgsSchema(ma.Schema):
+    journal_id = ma.fields.Integer(allow_none=True)
+
+
+class GameStateHistoryListArgsSchema(ma.Schema):
+    rows = ma.fields.Integer(description="Number of rows to return, maximum of %s" % MAX_HISTORY_ROWS)
+    before_gamestatehistory_id = ma.fields.Integer(
+        description="Only return entries older than this one"
+    )
+    include_data = ma.fields.Boolean(missing=False,
+                                     description="Include the full gamestate in each entry")
+
+
 class GameStateSchema(ModelSchema):
     class Meta:
         strict = True
@@ -40,10 +66,14 @@ class GameStateSchema(ModelSchema):
                                doc="Url to the game state history resource")
 
 
+_cache_schema = GameStateSchema(exclude=("gamestate_url", "gamestatehistory_url"))
+
+
 class GameStateHistorySchema(ModelSchema):
     class Meta:
         strict = True
         model = GameStateHistory
+        exclude = ("packed_data", "is_delta", "base_gamestatehistory_id")
     gamestatehistoryentry_url = Url('player_gamestate.historyentry',
                                     player_id='<player_id>',
                                     namespace='<namespace>',
@@ -61,10 +91,78 @@ class GameStatesAPI(MethodView):
         """
         can_edit_player(player_id)
 
-        gamestates = g.db.query(GameState) \
-                         .filter(GameState.player_id == player_id) \
-                         .order_by(GameState.namespace)
-        return gamestates
+        entries = get_cached_gamestates(g.redis, player_id)
+        if entries is None:
+            gamestates = g.db.query(GameState) \
+                             .filter(GameState.player_id == player_id) \
+                             .order_by(GameState.namespace)
+            entries = [(gamestate.namespace, gamestate.gamestate_id, gamestate.version,
+                        _serialize(gamestate))
+                       for gamestate in gamestates]
+            cache_gamestates(g.redis, player_id, entries)
+
+        body = b"[" + b",".join(_add_urls(body, player_id, namespace)
+                                for namespace, _, _, body in entries) + b"]"
+        response = make_response(body)
+        response.mimetype = "application/json"
+        return response
+
+
+def gamestate_etag(gamestate_id, version):
+    """
+    Returns the entity tag for a version of a gamestate. The id is included so
+    that a gamestate which is deleted and recreated does not reuse old tags.
+    """
+    return "%s.%s" % (gamestate_id, version)
+
+
+def _serialize(gamestate):
+    """Returns the gamestate serialized to JSON, without urls."""
+    return json.dumps(_cache_schema.dump(gamestate)).encode("utf-8")
+
+
+def _add_urls(body, player_id, namespace):
+    """Returns the serialized gamestate 'body' with the urls added, without parsing it."""
+    urls = json.dumps({
+        "gamestate_url": url_for("player_gamestate.entry", player_id=player_id,
+                                 namespace=namespace, _external=True),
+        "gamestatehistory_url": url_for("player_gamestate.historylist", player_id=player_id,
+                                        namespace=namespace, _external=True),
+    }).encode("utf-8")
+    return body[:-1] + b"," + urls[1:]
+
+
+def _gamestate_response(player_id, namespace, gamestate_id, version, body):
+    response = make_response(_add_urls(body, player_id, namespace))
+    response.mimetype = "application/json"
+    response.set_etag(gamestate_etag(gamestate_id, version))
+    return response
+
+
+def _check_if_match(gamestate):
+    """Abort with 412 if the request is conditional on another version of 'gamestate'"""
+    if not request.if_match:
+        return
+    if gamestate is None:
+        abort(http_client.PRECONDITION_FAILED, message="Gamestate does not exist")
+    if not request.if_match.contains(gamestate_etag(gamestate.gamestate_id, gamestate.version)):
+        abort(http_client.PRECONDITION_FAILED,
+              message="Gamestate has been modified. Current version is %s" % gamestate.version)
+
+
+def _check_journal_id(player_id, journal_id):
+    journal_row = g.db.query(PlayerJournal) \
+        .filter(PlayerJournal.player_id == player_id,
+                PlayerJournal.journal_id == journal_id,
+                PlayerJournal.deleted != True) \
+        .first()
+    if not journal_row:
+        # Note: this might happen normally unless we serialize on the
+        # client to ensure all journal entries
+        # are acked before sending up the new state
+        msg = "Journal entry %s for player %s not found!" % (journal_id, player_id)
+        log.warning(msg)
+        abort(http_client.BAD_REQUEST, message=msg)
 
 
 @bp.route("/<int:player_id>/gamestates/<string:namespace>", endpoint="entry")
@@ -75,31 +173,41 @@ class GameStateAPI(MethodView):
         """
         Get full dump of game state
 
-        for the current player in namespace 'namespace'
+        for the current player in namespace 'namespace'.
+        Returns 304 if the 'If-None-Match' header matches the current ETag.
         """
         can_edit_player(player_id)
 
-        gamestates = g.db.query(GameState) \
-                         .filter(GameState.player_id == player_id,
-                                 GameState.namespace == namespace) \
-                         .order_by(-GameState.gamestate_id)
-        if gamestates.count() == 0:
+        cached = get_cached_gamestate(g.redis, player_id, namespace)
+        if cached is None:
+            gamestate = g.db.query(GameState) \
+                            .filter(GameState.player_id == player_id,
+                                    GameState.namespace == namespace) \
+                            .first()
+            if gamestate:
+                cached = gamestate.gamestate_id, gamestate.version, _serialize(gamestate)
+                cache_gamestate(g.redis, player_id, namespace, *cached)
+        gamestate_id, version, body = cached or (None, None, None)
+        if gamestate_id is None:
             msg = "Gamestate '%s' for player %s not found" % (namespace, player_id)
             log.info(msg)
             abort(http_client.NOT_FOUND)
 
-        elif gamestates.count() > 1:
-            raise RuntimeError("Player %s has %s game states with namespace '%s'" %
-                               (player_id, gamestates.count(), namespace))
-
-        gamestate = gamestates.first()
-        return gamestate
+        etag = gamestate_etag(gamestate_id, version)
+        if request.if_none_match.contains(etag):
+            response = make_response("", http_client.NOT_MODIFIED)
+            response.set_etag(etag)
+            return response
+        return _gamestate_response(player_id, namespace, gamestate_id, version, body)
 
     @bp.arguments(GameStateRequestSchema())
     @bp.response(GameStateSchema())
     def put(self, args, player_id, namespace):
         """
         Upload the gamestate state to the server
+
+        If the 'If-Match' header is set the upload is rejected with 412 unless
+        it matches the ETag of the current version of the gamestate.
         """
         can_edit_player(player_id)
 
@@ -109,66 +217,81 @@ class GameStateAPI(MethodView):
             journal_id = int(args["journal_id"])
 
         if journal_id:
-            journal_row = g.db.query(PlayerJournal) \
-                .filter(PlayerJournal.player_id == player_id,
-                        PlayerJournal.journal_id == journal_id,
-                        PlayerJournal.deleted != True) \
-                .first()
-            if not journal_row:
-                # Note: this might happen normally unless we serialize on the
-                # client to ensure all journal entries
-                # are acked before sending up the new state
-                msg = "Journal entry %s for player %s not found!" % (journal_id, player_id)
-                log.warning(msg)
-                return json_response(msg, http_client.BAD_REQUEST)
-
-        gamestate = g.db.query(GameState)\
+            _check_journal_id(player_id, journal_id)
+
+        if request.if_match:
+            _check_if_match(self._get_for_update(player_id, namespace))
+        return self._save(player_id, namespace, data, journal_id)
+
+    @bp.arguments(GameStatePatchArgsSchema(), location="query")
+    @bp.response(GameStateSchema())
+    def patch(self, args, player_id, namespace):
+        """
+        Apply a JSON Patch (RFC 6902) to the gamestate
+
+        The request body is a list of patch operations. If the 'If-Match' header is
+        set the patch is rejected with 412 unless it matches the ETag of the current
+        version of the gamestate.
+        """
+        can_edit_player(player_id)
+
+        patch = request.get_json(force=True, silent=True)
+        if not isinstance(patch, list):
+            abort(http_client.BAD_REQUEST, message="Request body must be a list of patch operations.")
+
+        journal_id = args.get("journal_id")
+        if journal_id:
+            _check_journal_id(player_id, journal_id)
+
+        gamestate = self._get_for_update(player_id, namespace)
+        _check_if_match(gamestate)
+        if not gamestate:
+            abort(http_client.NOT_FOUND)
+
+        try:
+            data = apply_patch(gamestate.data, patch)
+        except JsonPatchError as e:
+            abort(http_client.UNPROCESSABLE_ENTITY, message="Unable to apply patch: %s" % e)
+        if not isinstance(data, dict):
+            abort(http_client.UNPROCESSABLE_ENTITY, message="Patched gamestate must be an object.")
+
+        return self._save(player_id, namespace, data, journal_id)
+
+    def _get_for_update(self, player_id, namespace):
+        # lock the row so concurrent writes are serialized on the version
+        return g.db.query(GameState) \
             .filter(GameState.player_id == player_id, GameState.namespace == namespace) \
-            .order_by(-GameState.gamestate_id).first()
-
-        if gamestate:
-            if journal_id and journal_id <= gamestate.journal_id:
-                # TODO: Raise here?
-                log.warning("Writing a new gamestate with an older journal_id, %s "
-                            "than the current one", journal_id, extra=gamestate.as_dict())
-            gamestate.version += 1
-            gamestate.data = data
-            gamestate.journal_id = journal_id
-            log.info("Updated gamestate for player %s to version %s. journal_id = %s", player_id,
-                     gamestate.version, journal_id)
-        else:
-            gamestate = GameState(player_id=player_id, data=data,
-                                  journal_id=journal_id, namespace=namespace)
-            g.db.add(gamestate)
-            g.db.flush()
-            log.info("Added new gamestate for player")
-
-        # write new gamestate to the history table for safe keeping
-        gamestatehistory_row = GameStateHistory(player_id=player_id,
-                                                version=gamestate.version,
-                                                data=gamestate.data,
-                                                namespace=gamestate.namespace,
-                                                journal_id=gamestate.journal_id)
-        g.db.add(gamestatehistory_row)
-        g.db.flush()
-
-        gamestatehistory_id = gamestatehistory_row.gamestatehistory_id
-        gamestate.gamestatehistory_id = gamestatehistory_id
+            .with_for_update() \
+            .first()
+
+    def _save(self, player_id, namespace, data, journal_id):
+        gamestate = save_gamestate(g.db, player_id, namespace, data, journal_id)
         g.db.commit()
+        log.info("Saved gamestate '%s' for player %s, version %s. journal_id = %s",
+                 namespace, player_id, gamestate.version, journal_id)
+
+        body = _serialize(gamestate)
+        cache_gamestate(g.redis, player_id, namespace, gamestate.gamestate_id, gamestate.version, body)
 
-        return gamestate
+        schedule_history_prune(g.redis, player_id, namespace)
+
+        return _gamestate_response(player_id, namespace, gamestate.gamestate_id,
+                                   gamestate.version, body)
 
     def delete(self, player_id, namespace):
         """
         Remove a gamestate from the player (it will still exist in the history table)
         """
         can_edit_player(player_id)
-        gamestates = g.db.query(GameState) \
-                         .filter(GameState.player_id == player_id,
-                                 GameState.namespace == namespace)
-
-        gamestates.delete()
+        table = GameState.__table__
+        deleted = g.db.execute(table.delete()
+                               .where(table.c.player_id == player_id)
+                               .where(table.c.namespace == namespace)
+                               .returning(table.c.gamestate_id)) \
+                      .fetchall()
         g.db.commit()
+        for row in deleted:
+            uncache_gamestate(g.redis, player_id, namespace, row.gamestate_id)
 
         log.info("Gamestate '%s' for player %s has been deleted", namespace, player_id)
 
@@ -178,17 +301,43 @@ class GameStateAPI(MethodView):
 @bp.route("/<int:player_id>/gamestates/<string:namespace>/history", endpoint="historylist")
 class GameStateHistoryListAPI(MethodView):
 
+    @bp.arguments(GameStateHistoryListArgsSchema(), location="query")
     @bp.response(GameStateHistorySchema(many=True))
-    def get(self, player_id, namespace):
+    def get(self, args, player_id, namespace):
+        """
+        List the history of a gamestate, newest first
+
+        Returns metadata only unless 'include_data' is set. Use 'before_gamestatehistory_id'
+        with the id of the last entry returned to fetch the next page.
+        """
         can_edit_player(player_id)
 
-        rows = g.db.query(GameStateHistory) \
-                   .filter(GameStateHistory.player_id == player_id,
-                           GameStateHistory.namespace == namespace) \
-                   .order_by(-GameStateHistory.gamestatehistory_id)
-        if not rows:
+        num_rows = min(args.get("rows") or DEFAULT_HISTORY_ROWS, MAX_HISTORY_ROWS)
+        if args.get("include_data"):
+            query = g.db.query(GameStateHistory)
+        else:
+            query = g.db.query(*[getattr(GameStateHistory, c) for c in HISTORY_METADATA_COLUMNS])
+        query = query.filter(GameStateHistory.player_id == player_id,
+                             GameStateHistory.namespace == namespace)
+        before_id = args.get("before_gamestatehistory_id")
+        if before_id:
+            query = query.filter(GameStateHistory.gamestatehistory_id < before_id)
+        rows = query.order_by(GameStateHistory.gamestatehistory_id.desc()) \
+                    .limit(num_rows) \
+                    .all()
+        if not rows and not before_id:
             abort(http_client.NOT_FOUND)
-        return rows
+
+        if not args.get("include_data"):
+            return [row._asdict() for row in rows]
+
+        data_by_id = load_history_data(g.db, rows)
+        ret = []
+        for row in rows:
+            entry = {c: getattr(row, c) for c in HISTORY_METADATA_COLUMNS}
+            entry["data"] = data_by_id[row.gamestatehistory_id]
+            ret.append(entry)
+        return ret
 
 
 @bp.route("/<int:player_id>/gamestates/<string:namespace>/history/<int:gamestatehistory_id>",
@@ -205,4 +354,6 @@ class GameStateHistoryEntryAPI(MethodView):
                             .first()
         if not row_gamestate:
             abort(http_client.NOT_FOUND)
-        return row_gamestate
+        ret = row_gamestate.as_dict()
+        ret["data"] = get_history_data(g.db, row_gamestate)
+        return ret
@@ -5,30 +5,37 @@ from operator import itemgetter
 from dateutil import parser
 from drift.core.extensions.jwt import current_user
 from drift.utils import json_response
-from flask import request, g, url_for, jsonify
+from flask import request, g, url_for, jsonify, json, stream_with_context, Response
 from flask.views import MethodView
 from flask_restx import reqparse
 from flask_smorest import Blueprint, abort
 from six.moves import http_client
+from sqlalchemy import tuple_
 
-from driftbase.models.db import PlayerJournal, GameState
+from driftbase.models.db import PlayerJournal
 from driftbase.players import can_edit_player
-from driftbase.players import write_journal, JournalError
+from driftbase.players import write_journal_entries, JournalError
 
 log = logging.getLogger(__name__)
 
 bp = Blueprint("player_journal", __name__, url_prefix='/players')
 
+EXPORT_CHUNK_SIZE = 1000
+
 
 @bp.route("/<int:player_id>/journal", endpoint="list")
 class JournalAPI(MethodView):
     get_args = reqparse.RequestParser()
     get_args.add_argument("rows", type=int)
     get_args.add_argument("include_deleted", type=bool)
+    get_args.add_argument("before_journal_id", type=int)
 
     def get(self, player_id):
         """
         Get a list of recent journal entries for the player
+
+        Use 'before_journal_id' with the journal_id of the last entry returned
+        to fetch the next page.
         """
         DEFAULT_ROWS = 100
         args = self.get_args.parse_args()
@@ -39,7 +46,9 @@ class JournalAPI(MethodView):
         query = query.filter(PlayerJournal.player_id == player_id)
         if not getattr(args, "include_deleted", False):
             query = query.filter(PlayerJournal.deleted == False)  # noqa: E711
-        query = query.order_by(-PlayerJournal.journal_id, -PlayerJournal.sequence_id)
+        if args.before_journal_id:
+            query = query.filter(PlayerJournal.journal_id < args.before_journal_id)
+        query = query.order_by(PlayerJournal.journal_id.desc(), PlayerJournal.sequence_id.desc())
         query = query.limit(args.rows or DEFAULT_ROWS)
         ret = []
         for entry in query:
@@ -60,7 +69,6 @@ class JournalAPI(MethodView):
         for a in args_list:
             if "journal_id" not in a:
                 abort(http_client.BAD_REQUEST)
-        ret = []
         now = datetime.datetime.utcnow()
         MAX_DRIFT = 60
         args_list.sort(key=itemgetter('journal_id'))
@@ -75,31 +83,6 @@ class JournalAPI(MethodView):
                             "Client system time: '%s', Server time: '%s'",
                             diff, client_current_time, now)
         for args in args_list:
-            # Special handling if this is a rollback event.
-            # We mark all journal entries higher than the event to rollback to
-            # as deleted (as an optimization) and then add the rollback event itself.
-            if "rollback_to_journal_id" in args:
-                to_journal_id = int(args.get("rollback_to_journal_id"))
-                # TODO: Check if there are any gamestates persisted after the id
-                gamestate = get_player_gamestate(player_id)
-                if not gamestate:
-                    log.warning("Player is rebasing journal entries but doesn't"
-                                "have any gamestate.")
-
-                elif gamestate.journal_id > to_journal_id:
-                    return json_response("Journal has already been persisted into home base!",
-                                         http_client.BAD_REQUEST)
-
-                entry = get_journal_entry(player_id, to_journal_id)
-                if not entry.first():
-                    log.warning("Rolling back to journal entry %s which doesn't exist")
-                elif entry.first().deleted:
-                    log.warning("Rolling back to journal entry %s which has been rolled back")
-
-                g.db.query(PlayerJournal).filter(PlayerJournal.player_id == player_id,
-                                                 PlayerJournal.journal_id > to_journal_id) \
-                                         .update({"deleted": True})
-
             # report if the client's clock is out of sync with the server
             timestamp = parser.parse(args["timestamp"])
             diff = (timestamp.replace(tzinfo=None) - now).total_seconds()
@@ -109,26 +92,75 @@ class JournalAPI(MethodView):
                          "Client journal timestamp: '%s', Server timestamp: '%s'",
                          args["journal_id"], args["action"], diff, args["timestamp"], now)
 
-            try:
-                journal = write_journal(player_id, args["action"], args["journal_id"],
-                                        args["timestamp"],
-                                        details=args.get("details"), steps=args.get("steps"),
-                                        actor_id=current_user["player_id"])
-            except JournalError as e:
-                # TODO: We now reject the journal entry and subsequent entries instead of
-                # rolling the entire thing back. Is that what we want?
-                log.warning("Error writing to journal. Rejecting entry. Error was: %s", e)
-                abort(http_client.BAD_REQUEST, description=str(e))
-
-            ret.append({"journal_id": journal["journal_id"],
-                        "url": url_for("player_journal.entry",
-                                       player_id=player_id,
-                                       journal_id=journal["journal_id"],
-                                       _external=True)
-                        })
+        try:
+            journals = write_journal_entries(player_id, args_list,
+                                             actor_id=current_user["player_id"])
+        except JournalError as e:
+            # The entries before the rejected one are written. The client is told which
+            # ones so it can resubmit from there.
+            log.warning("Error writing to journal. Rejecting entry. Error was: %s", e)
+            abort(http_client.BAD_REQUEST, description=str(e),
+                  accepted=[_journal_ref(player_id, journal) for journal in e.accepted])
+
+        ret = [_journal_ref(player_id, journal) for journal in journals]
         return jsonify(ret), http_client.CREATED
 
 
+def _journal_ref(player_id, journal):
+    return {"journal_id": journal["journal_id"],
+            "url": url_for("player_journal.entry",
+                           player_id=player_id,
+                           journal_id=journal["journal_id"],
+                           _external=True)
+            }
+
+
+@bp.route("/<int:player_id>/journal/export", endpoint="export")
+class JournalExportAPI(MethodView):
+    get_args = reqparse.RequestParser()
+    get_args.add_argument("include_deleted", type=bool)
+
+    def get(self, player_id):
+        """
+        Stream the player's entire journal, oldest entry first
+
+        The entries are read in chunks, each in its own transaction, and written
+        out as they are fetched so arbitrarily large journals can be exported.
+        """
+        args = self.get_args.parse_args()
+        can_edit_player(player_id)
+        include_deleted = getattr(args, "include_deleted", False)
+
+        def streamer():
+            yield "["
+            last_key = None
+            while True:
+                query = g.db.query(PlayerJournal) \
+                            .filter(PlayerJournal.player_id == player_id)
+                if not include_deleted:
+                    query = query.filter(PlayerJournal.deleted == False)  # noqa: E711
+                if last_key:
+                    query = query.filter(tuple_(PlayerJournal.journal_id,
+                                                PlayerJournal.sequence_id) > last_key)
+                entries = query.order_by(PlayerJournal.journal_id, PlayerJournal.sequence_id) \
+                               .limit(EXPORT_CHUNK_SIZE) \
+                               .all()
+                chunk = [json.dumps(entry.as_dict()) for entry in entries]
+                next_key = (entries[-1].journal_id, entries[-1].sequence_id) if entries else None
+                # end the transaction before the chunk is written out so a slow
+                # client doesn't leave the connection idle in transaction
+                g.db.rollback()
+                for i, row in enumerate(chunk):
+                    prefix = "," if last_key or i else ""
+                    yield prefix + row
+                if len(chunk) < EXPORT_CHUNK_SIZE:
+                    break
+                last_key = next_key
+            yield "]"
+
+        return Response(stream_with_context(streamer()), mimetype="application/json")
+
+
 def get_journal_entry(player_id, journal_id):
     entry = g.db.query(PlayerJournal) \
                 .filter(PlayerJournal.player_id == player_id,
@@ -136,14 +168,6 @@ def get_journal_entry(player_id, journal_id):
     return entry
 
 
-def get_player_gamestate(player_id):
-    gamestate = g.db.query(GameState) \
-                    .filter(GameState.player_id == player_id) \
-                    .order_by(-GameState.journal_id) \
-                    .first()
-    return gamestate
-
-
 @bp.route("/<int:player_id>/journal/<int:journal_id>", endpoint="entry")
 class JournalEntryAPI(MethodView):
     def get(self, player_id, journal_id):
@@ -3,11 +3,11 @@ import uuid
 
 import marshmallow as ma
 from drift.core.extensions.jwt import current_user
-from drift.utils import Url
 from flask import url_for, g
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort, utils
 from six.moves import http_client
+from sqlalchemy import literal, or_
 
 from driftbase.models.db import CorePlayer, UserIdentity
 from driftbase.players import get_playergroup, set_playergroup
@@ -16,6 +16,11 @@ log = logging.getLogger(__name__)
 
 bp = Blueprint("playergroups", __name__, url_prefix='/players/<int:player_id>/player-groups')
 
+# Max number of identity names and player id's in each lookup query
+LOOKUP_CHUNK_SIZE = 1000
+# Stands in for the player id when the player url is resolved
+PLAYER_ID_PLACEHOLDER = 9876543210123
+
 
 class PlayerGroupGetRequestSchema(ma.Schema):
     secret = ma.fields.String(description="Shared secret for this group")
@@ -28,7 +33,7 @@ class PlayerGroupPutRequestSchema(ma.Schema):
 
 class PlayerGroupPlayerSchema(ma.Schema):
     player_id = ma.fields.Integer()
-    player_url = Url('players.entry', player_id='<player_id>', doc='Player resource')
+    player_url = ma.fields.String(description='Player resource')
     player_name = ma.fields.String()
     identity_name = ma.fields.String()
 
@@ -66,6 +71,7 @@ class PlayerGroupsAPI(MethodView):
                 message = "'player_id' does not match current user. " \
                     "A proper 'secret' or role 'service' is required to use arbitrary 'player_id'."
                 abort(http_client.FORBIDDEN, message=message)
+        _add_player_urls(pg['players'])
         return pg
 
     @bp.arguments(PlayerGroupPutRequestSchema, location='json')
@@ -86,33 +92,9 @@ class PlayerGroupsAPI(MethodView):
             abort(http_client.BAD_REQUEST,
                   message="Role 'service' is required to use arbitrary 'player_id'.")
 
-        # Map identity names to player ids
-        rows = []
-        if 'identity_names' in args and len(args['identity_names']):
-            rows += g.db.query(UserIdentity, CorePlayer) \
-                        .filter(UserIdentity.name.in_(args['identity_names']),
-                                CorePlayer.user_id == UserIdentity.user_id) \
-                        .all()
-
-        if 'player_ids' in args and len(args['player_ids']):
-            rows += g.db.query(UserIdentity, CorePlayer) \
-                        .filter(CorePlayer.player_id.in_(args['player_ids']),
-                                CorePlayer.user_id == UserIdentity.user_id) \
-                        .all()
-
-        # Populate a dict keyed to player_id to eliminate duplicates
-        player_group = {
-            player_row.player_id: {
-                "player_id": player_row.player_id,
-                "player_url": url_for("players.entry",
-                                      player_id=player_row.player_id,
-                                      _external=True),
-                "player_name": player_row.player_name,
-                "identity_name": user_row.name,
-            }
-            for user_row, player_row in rows
-        }
-        player_group = list(player_group.values())
+        player_group = _lookup_players(args.get('identity_names') or [],
+                                       args.get('player_ids') or [])
+        _add_player_urls(player_group)
         payload = {
             "group_name": group_name,
             "player_id": player_id,
@@ -127,3 +109,54 @@ class PlayerGroupsAPI(MethodView):
         log.info("Created user group %s for player %s", group_name, player_id)
         utils.get_appcontext().setdefault('headers', {}).update(response_header)
         return payload
+
+
+def _lookup_players(identity_names, player_ids):
+    """
+    Returns a list of players, ordered by player id, matching either one of the
+    identity names or one of the player id's. Each player is listed once, with the
+    matching identity if it was looked up by identity name.
+    """
+    players = {}
+    matched_by_name = set()
+    num_entries = max(len(identity_names), len(player_ids))
+    for i in range(0, num_entries, LOOKUP_CHUNK_SIZE):
+        names_chunk = identity_names[i:i + LOOKUP_CHUNK_SIZE]
+        ids_chunk = player_ids[i:i + LOOKUP_CHUNK_SIZE]
+        # IN predicates on empty lists are avoided
+        criteria = []
+        if names_chunk:
+            name_matches = UserIdentity.name.in_(names_chunk)
+            criteria.append(name_matches)
+        else:
+            name_matches = literal(False)
+        if ids_chunk:
+            criteria.append(CorePlayer.player_id.in_(ids_chunk))
+        rows = g.db.query(CorePlayer.player_id, CorePlayer.player_name, UserIdentity.name,
+                          name_matches) \
+                   .join(UserIdentity, UserIdentity.user_id == CorePlayer.user_id) \
+                   .filter(or_(*criteria)) \
+                   .order_by(CorePlayer.player_id, name_matches.desc(),
+                             UserIdentity.identity_id) \
+                   .distinct(CorePlayer.player_id)
+        for player_id, player_name, identity_name, by_name in rows:
+            if player_id in matched_by_name or (player_id in players and not by_name):
+                continue
+            players[player_id] = {
+                "player_id": player_id,
+                "player_name": player_name,
+                "identity_name": identity_name,
+            }
+            if by_name:
+                matched_by_name.add(player_id)
+    return sorted(players.values(), key=lambda player: player["player_id"])
+
+
+def _add_player_urls(players):
+    # the url is resolved once with a placeholder id which is then substituted for
+    # each player, groups can have thousands of players
+    placeholder = "/%s" % PLAYER_ID_PLACEHOLDER
+    url = url_for("players.entry", player_id=PLAYER_ID_PLACEHOLDER, _external=True)
+    head, tail = url.rsplit(placeholder, 1)
+    for player in players:
+        player["player_url"] = "%s/%s%s" % (head, player["player_id"], tail)
@@ -1,18 +1,31 @@
 import logging
+import uuid
 
-from flask import request, g, abort, jsonify
+import marshmallow as ma
+import redis
+from drift.orm import utc_now
+from flask import request, g, abort, jsonify, current_app
 from flask.views import MethodView
 from flask_smorest import Blueprint
 from marshmallow_sqlalchemy import ModelSchema
 from six.moves import http_client
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from driftbase.models.db import PlayerSummary, PlayerSummaryHistory, CorePlayer
-from driftbase.players import log_event, can_edit_player
+from driftbase.players import log_event, can_edit_player, get_playergroup_ids
 
 log = logging.getLogger(__name__)
 
 bp = Blueprint("player_summary", __name__, url_prefix='/players')
 
+MAX_SUMMARY_PLAYERS = 500
+# Summaries are only cached in Redis if this is set in the app config
+SUMMARY_CACHE_TTL_CONFIG = "player_summary_cache_ttl"
+# summary field names are never empty so the empty field marks a cached summary
+SUMMARY_CACHE_MARKER = b""
+# The generation of a summary changes each time it's invalidated. It must outlive any request.
+SUMMARY_GENERATION_TTL = 24 * 60 * 60
+
 
 class PlayerSummarySchema(ModelSchema):
     class Meta:
@@ -20,11 +33,135 @@ class PlayerSummarySchema(ModelSchema):
         #exclude = ('player_summary',)
 
 
+class SummariesArgs(ma.Schema):
+    class Meta:
+        strict = True
+
+    player_id = ma.fields.List(
+        ma.fields.Integer(), description="Player ID's to get summaries for"
+    )
+    player_group = ma.fields.String(
+        description="The player group to get summaries for (see player-group api)"
+    )
+    name = ma.fields.List(
+        ma.fields.String(), description="Only return these summary fields"
+    )
+
+
 def get_player(player_id):
     player = g.db.query(CorePlayer).get(player_id)
     return player
 
 
+def _summary_cache_key(player_id):
+    return g.redis.make_key("summary:%s" % player_id)
+
+
+def _summary_generation_key(player_id):
+    return g.redis.make_key("summary:%s:generation" % player_id)
+
+
+def _get_cached_summaries(player_ids):
+    """
+    Returns a dict of player id -> summary for each of 'player_ids' found in the
+    cache, and a dict of player id -> the current generation of each summary.
+    """
+    pipe = g.redis.conn.pipeline(transaction=False)
+    for player_id in player_ids:
+        pipe.hgetall(_summary_cache_key(player_id))
+        pipe.get(_summary_generation_key(player_id))
+    results = pipe.execute()
+    summaries = {}
+    generations = {}
+    for player_id, values, generation in zip(player_ids, results[::2], results[1::2]):
+        generations[player_id] = generation
+        if SUMMARY_CACHE_MARKER in values:
+            del values[SUMMARY_CACHE_MARKER]
+            summaries[player_id] = {k.decode("utf-8"): int(v) for k, v in values.items()}
+    return summaries, generations
+
+
+def _cache_summaries(summaries, generations, ttl):
+    """
+    Cache 'summaries' which were read from the DB when each summary was at the
+    generation in 'generations'. A summary which has been invalidated since is
+    not cached as the value read may predate the change.
+    """
+    player_ids = list(summaries.keys())
+    generation_keys = [_summary_generation_key(player_id) for player_id in player_ids]
+
+    def update(pipe):
+        current = pipe.mget(generation_keys)
+        pipe.multi()
+        for player_id, generation in zip(player_ids, current):
+            if generation != generations[player_id]:
+                continue
+            key = _summary_cache_key(player_id)
+            values = dict(summaries[player_id])
+            values[SUMMARY_CACHE_MARKER] = 1
+            pipe.hset(key, mapping=values)
+            pipe.expire(key, ttl)
+
+    try:
+        g.redis.conn.transaction(update, *generation_keys)
+    except redis.RedisError:
+        log.exception("Unable to cache the summaries of players %s", player_ids)
+
+
+def _invalidate_summary_cache(player_id):
+    if current_app.config.get(SUMMARY_CACHE_TTL_CONFIG):
+        pipe = g.redis.conn.pipeline()
+        pipe.set(_summary_generation_key(player_id), uuid.uuid4().hex, ex=SUMMARY_GENERATION_TTL)
+        pipe.delete(_summary_cache_key(player_id))
+        pipe.execute()
+
+
+def get_summaries(player_ids):
+    """Returns a dict of player id -> summary for each of 'player_ids'."""
+    ttl = current_app.config.get(SUMMARY_CACHE_TTL_CONFIG)
+    summaries, generations = _get_cached_summaries(player_ids) if ttl else ({}, {})
+    missing = [player_id for player_id in player_ids if player_id not in summaries]
+    if missing:
+        fetched = {player_id: {} for player_id in missing}
+        rows = g.db.query(PlayerSummary.player_id, PlayerSummary.name, PlayerSummary.value) \
+                   .filter(PlayerSummary.player_id.in_(missing))
+        for row in rows:
+            fetched[row.player_id][row.name] = row.value
+        if ttl:
+            _cache_summaries(fetched, generations, ttl)
+        summaries.update(fetched)
+    return summaries
+
+
+@bp.route("/summaries", endpoint="summaries")
+class SummariesAPI(MethodView):
+
+    @bp.arguments(SummariesArgs, location='query')
+    def get(self, args):
+        """
+        Get summaries for multiple players
+
+        Returns the summary fields of each player, optionally only those in 'name'.
+        """
+        if 'player_id' in args:
+            player_ids = args['player_id']
+        elif 'player_group' in args:
+            player_ids = get_playergroup_ids(args['player_group'], caress_in_predicate=False)
+        else:
+            abort(http_client.BAD_REQUEST)
+        player_ids = list(dict.fromkeys(player_ids))[:MAX_SUMMARY_PLAYERS]
+
+        summaries = get_summaries(player_ids)
+        names = args.get('name')
+        ret = []
+        for player_id in player_ids:
+            summary = summaries[player_id]
+            if names:
+                summary = {name: summary[name] for name in names if name in summary}
+            ret.append({"player_id": player_id, "summary": summary})
+        return jsonify(ret)
+
+
 @bp.route("/<int:player_id>/summary", endpoint="list")
 class Summary(MethodView):
 
@@ -57,47 +194,21 @@ class Summary(MethodView):
         if not get_player(player_id):
             abort(http_client.NOT_FOUND)
 
-        old_summary = g.db.query(PlayerSummary).filter(PlayerSummary.player_id == player_id).all()
-
-        new_summary = []
-        updated_ids = set()
-        for name, val in request.json.items():
-            for row in old_summary:
-                if row.name == name:
-                    updated_ids.add(row.id)
-                    if val != row.value:
-                        row.value = val
-                    break
-            else:
-                log.info("Adding a new summary field, '%s' with value '%s'", name, val)
-                summary_row = PlayerSummary(player_id=player_id, name=name, value=val)
-                g.db.add(summary_row)
-                g.db.flush()
-                updated_ids.add(summary_row.id)
-        g.db.commit()
+        old_summary = {row.name: row for row in _get_summary_rows(player_id)}
+        changes = _diff_summary(old_summary, request.json)
+        deleted = [name for name in old_summary if name not in request.json]
 
-        for row in old_summary:
-            if row.id not in updated_ids:
-                log.info("Deleting summary field '%s' with id %s which had the value '%s'",
-                         row.name, row.id, row.value)
-                g.db.delete(row)
+        _upsert_summary(player_id, changes)
+        if deleted:
+            g.db.query(PlayerSummary) \
+                .filter(PlayerSummary.player_id == player_id,
+                        PlayerSummary.name.in_(deleted)) \
+                .delete(synchronize_session=False)
         g.db.commit()
+        _invalidate_summary_cache(player_id)
 
-        new_summary = g.db.query(PlayerSummary).filter(PlayerSummary.player_id == player_id).all()
-
-        request_txt = ""
-        for k, v in request.json.items():
-            request_txt += "%s = %s, " % (k, v)
-        if request_txt:
-            request_txt = request_txt[:-2]
-
-        new_summary_txt = ""
-        for row in new_summary:
-            new_summary_txt += "%s = %s, " % (row.name, row.value)
-        if new_summary_txt:
-            new_summary_txt = new_summary_txt[:-2]
-        log.info("Updating summary for player %s. Request is '%s'. New summary is '%s'",
-                 player_id, request_txt, new_summary_txt)
+        log.debug("Updating summary for player %s. Changes are %s. Deleted fields are %s",
+                  player_id, changes, deleted)
 
         ret = []
         return jsonify(ret)
@@ -113,49 +224,61 @@ class Summary(MethodView):
 
         if not get_player(player_id):
             abort(http_client.NOT_FOUND)
-        old_summary = g.db.query(PlayerSummary).filter(PlayerSummary.player_id == player_id).all()
-        old_summary_txt = ""
-        for row in old_summary:
-            old_summary_txt += "%s = %s, " % (row.name, row.value)
-
-        changes = {}
-        for name, val in request.json.items():
-            for row in old_summary:
-                if row.name == name:
-                    if val != row.value:
-                        changes[name] = {"old": row.value, "new": val}
-                        row.value = val
-                    break
-            else:
-                log.info("Adding a new summary field, '%s' with value '%s'", name, val)
-                changes[name] = {"old": None, "new": val}
-                summary_row = PlayerSummary(player_id=player_id, name=name, value=val)
-                g.db.add(summary_row)
-
-            # if this summary stat changes we write it into our history log
-            if name in changes:
-                summaryhistory_row = PlayerSummaryHistory(player_id=player_id, name=name, value=val)
-                g.db.add(summaryhistory_row)
-
-            g.db.commit()
-
-        new_summary = g.db.query(PlayerSummary).filter(PlayerSummary.player_id == player_id).all()
+
+        old_summary = {row.name: row for row in _get_summary_rows(player_id)}
+        changes = _diff_summary(old_summary, request.json)
+
+        new_summary = {name: dict(row) for name, row in old_summary.items()}
+        for row in _upsert_summary(player_id, changes):
+            new_summary[row.name] = dict(row)
+
+        # if a summary stat changes we write it into our history log
+        if changes:
+            g.db.execute(PlayerSummaryHistory.__table__.insert().values([
+                {"player_id": player_id, "name": name, "value": change["new"]}
+                for name, change in changes.items()
+            ]))
 
         log_event(player_id, "event.player.summarychanged", changes)
-        request_txt = ""
-        for k, v in request.json.items():
-            request_txt += "%s = %s, " % (k, v)
-        if request_txt:
-            request_txt = request_txt[:-2]
-
-        if old_summary_txt:
-            old_summary_txt = old_summary_txt[:-2]
-        new_summary_txt = ""
-        for row in new_summary:
-            new_summary_txt += "%s = %s, " % (row.name, row.value)
-        if new_summary_txt:
-            new_summary_txt = new_summary_txt[:-2]
-        log.info("Updating summary. Request is '%s'. Old summary is '%s'. New summary is '%s'",
-                 request_txt, old_summary_txt, new_summary_txt)
-
-        return new_summary
+        g.db.commit()
+        _invalidate_summary_cache(player_id)
+
+        log.debug("Updating summary for player %s. Changes are %s", player_id, changes)
+
+        return list(new_summary.values())
+
+
+def _get_summary_rows(player_id):
+    table = PlayerSummary.__table__
+    return g.db.execute(table.select().where(table.c.player_id == player_id)).fetchall()
+
+
+def _diff_summary(old_summary, new_values):
+    """
+    Returns a dict of name -> {"old": old value, "new": new value} for every field in
+    'new_values' which is not already in 'old_summary' with the same value.
+    """
+    changes = {}
+    for name, val in new_values.items():
+        old_row = old_summary.get(name)
+        if old_row is None:
+            changes[name] = {"old": None, "new": val}
+        elif old_row.value != val:
+            changes[name] = {"old": old_row.value, "new": val}
+    return changes
+
+
+def _upsert_summary(player_id, changes):
+    """Write the new values in 'changes' in one statement. Returns the written rows."""
+    if not changes:
+        return []
+    table = PlayerSummary.__table__
+    insert = pg_insert(table).values([
+        {"player_id": player_id, "name": name, "value": change["new"]}
+        for name, change in changes.items()
+    ])
+    upsert = insert.on_conflict_do_update(
+        index_elements=[table.c.player_id, table.c.name],
+        set_={"value": insert.excluded.value, "modify_date": utc_now},
+    ).returning(*table.c)
+    return g.db.execute(upsert).fetchall()
@@ -164,7 +164,7 @@ class TicketEndpoint(MethodView):
 
         ticket.used_date = datetime.datetime.utcnow()
         ticket.journal_id = journal_id
+        log_event(player_id, "event.player.ticketclaimed", {"ticket_id": ticket_id})
         g.db.commit()
 
-        log_event(player_id, "event.player.ticketclaimed", {"ticket_id": ticket_id})
         return ticket
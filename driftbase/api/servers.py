@@ -1,5 +1,6 @@
 import logging
 import datetime
+import time
 import uuid
 
 from six.moves import http_client
@@ -15,6 +16,7 @@ from drift.core.extensions.schemachecker import simple_schema_request
 from drift.core.extensions.jwt import current_user, requires_roles
 
 from driftbase.models.db import Machine, Server, Match, ServerDaemonCommand
+from driftbase import heartbeats
 
 log = logging.getLogger(__name__)
 
@@ -29,12 +31,55 @@ def drift_init_extension(app, api, **kwargs):
 
 
 SECONDS_BETWEEN_HEARTBEAT = 30
+# Upper limit on how long the daemon can long-poll for new commands
+MAX_COMMANDS_WAIT_SECONDS = 60
 
 
 def utcnow():
     return datetime.datetime.utcnow()
 
 
+def _commands_channel(server_id):
+    return g.redis.make_key("servers:%s:commands" % server_id)
+
+
+def notify_pending_command(server_id, command_id):
+    """Wake up any daemon long-polling for commands on 'server_id'."""
+    g.redis.conn.publish(_commands_channel(server_id), command_id)
+
+
+def get_pending_commands(server_id):
+    return g.db.query(ServerDaemonCommand) \
+               .filter(ServerDaemonCommand.server_id == server_id,
+                       ServerDaemonCommand.status == "pending") \
+               .order_by(ServerDaemonCommand.command_id) \
+               .all()
+
+
+def wait_for_pending_commands(server_id, wait):
+    """
+    Returns pending commands for 'server_id', blocking for up to 'wait' seconds
+    until a new command is posted if there are none.
+    """
+    pubsub = g.redis.conn.pubsub(ignore_subscribe_messages=True)
+    # subscribe before checking the DB so a command posted in between is not missed
+    pubsub.subscribe(_commands_channel(server_id))
+    try:
+        rows = get_pending_commands(server_id)
+        deadline = time.time() + wait
+        while not rows:
+            # don't hold on to a DB connection while we wait
+            g.db.rollback()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if pubsub.get_message(timeout=remaining):
+                rows = get_pending_commands(server_id)
+    finally:
+        pubsub.close()
+    return rows
+
+
 @bp.route('', endpoint='list')
 class ServersAPI(MethodView):
     get_args = reqparse.RequestParser()
@@ -61,6 +106,7 @@ class ServersAPI(MethodView):
             record = row.as_dict()
             record["url"] = url_for("servers.entry", server_id=row.server_id, _external=True)
             ret.append(record)
+        heartbeats.apply_heartbeats(g.redis, heartbeats.SERVERS, ret, "server_id")
         return jsonify(ret)
 
     @requires_roles("service")
@@ -198,6 +244,7 @@ class ServerAPI(MethodView):
 
         machine_id = server.machine_id
         record = server.as_dict()
+        heartbeats.apply_heartbeats(g.redis, heartbeats.SERVERS, [record], "server_id")
         record["url"] = url_for("servers.entry", server_id=server_id, _external=True)
         record["heartbeat_url"] = url_for("servers.heartbeat", server_id=server_id, _external=True)
         record["commands_url"] = url_for("servers.commands", server_id=server_id, _external=True)
@@ -221,8 +268,7 @@ class ServerAPI(MethodView):
         record["matches"] = matches
 
         commands = []
-        rows = g.db.query(ServerDaemonCommand).filter(ServerDaemonCommand.server_id == server_id,
-                                                      ServerDaemonCommand.status == "pending").all()
+        rows = get_pending_commands(server_id)
         for row in rows:
             command = {"command_id": row.command_id,
                        "command": row.command,
@@ -303,10 +349,11 @@ class ServerHeartbeatAPI(MethodView):
         """
         log.debug("%s is heartbeating battleserver %s",
                   current_user.get("user_name", "unknown"), server_id)
-        server = g.db.query(Server).get(server_id)
-        server.heartbeat_count += 1
-        server.heartbeat_date = utcnow()
-        g.db.commit()
+        last_heartbeat = heartbeats.record_heartbeat(g.redis, heartbeats.SERVERS, server_id)
+        if last_heartbeat is None and not g.db.query(Server).get(server_id):
+            heartbeats.discard_heartbeat(g.redis, heartbeats.SERVERS, server_id)
+            abort(http_client.NOT_FOUND)
+        heartbeats.maybe_flush_heartbeats(g.redis, g.db)
 
         return jsonify({"next_heartbeat_seconds": SECONDS_BETWEEN_HEARTBEAT, }), http_client.OK, None
 
@@ -340,6 +387,7 @@ class ServerCommandsAPI(MethodView):
                                       )
         g.db.add(command)
         g.db.commit()
+        notify_pending_command(server_id, command.command_id)
 
         resource_url = url_for("servers.command", server_id=server_id,
                                command_id=command.command_id, _external=True)
@@ -348,11 +396,25 @@ class ServerCommandsAPI(MethodView):
                 "status": status,
                 }), http_client.CREATED, None
 
+    get_args = reqparse.RequestParser()
+    get_args.add_argument("wait", type=int, required=False)
+
     @requires_roles("service")
     def get(self, server_id):
-        rows = g.db.query(ServerDaemonCommand) \
-                   .filter(ServerDaemonCommand.server_id == server_id) \
-                   .all()
+        """
+        Get commands for the daemon
+
+        If 'wait' is specified only pending commands are returned, and if there
+        are none the call blocks for up to 'wait' seconds until one is added.
+        """
+        args = self.get_args.parse_args()
+        if args.get("wait") is None:
+            rows = g.db.query(ServerDaemonCommand) \
+                       .filter(ServerDaemonCommand.server_id == server_id) \
+                       .all()
+        else:
+            wait = max(0, min(args["wait"], MAX_COMMANDS_WAIT_SECONDS))
+            rows = wait_for_pending_commands(server_id, wait)
         ret = []
         for r in rows:
             command = r.as_dict()
@@ -397,6 +459,8 @@ class ServerCommandAPI(MethodView):
         if "details" in args:
             row.details = args["details"]
         g.db.commit()
+        if row.status == "pending":
+            notify_pending_command(server_id, row.command_id)
 
         ret = row.as_dict()
         ret["url"] = url_for("servers.command", server_id=server_id, command_id=row.command_id,
@@ -4,6 +4,8 @@ import functools
 from drift.utils import get_config
 from drift.core.extensions import jwt
 
+from driftbase.auth import passwords
+
 
 AUTH_MODULES = {
     'gamecenter': 'driftbase.auth.gamecenter',
@@ -27,6 +29,8 @@ def _authentication_thunker(module, func, *args, **kw):
 
 def drift_init_extension(app, api, **kwds):
 
+    passwords.check_config(app.config)
+
     # register authentication handlers
     for name, module in AUTH_MODULES.items():
         jwt.register_auth_provider(app, name, functools.partial(_authentication_thunker, module, 'authenticate'))
@@ -3,6 +3,8 @@ import logging
 from six.moves import http_client
 
 from flask import g, current_app
+from sqlalchemy import and_, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from flask_smorest import abort
 from click import secho
 
@@ -68,12 +70,6 @@ def authenticate(username, password, automatic_account_creation=True):
     else:
         log.info("Old-style authentication for '%s'", username)
 
-    identity_id = 0
-
-    my_identity = g.db.query(UserIdentity) \
-                      .filter(UserIdentity.name == username) \
-                      .first()
-
     try:
         service_user = g.conf.tier.get('service_user')
         if not service_user and g.conf.tenant:
@@ -85,6 +81,8 @@ def authenticate(username, password, automatic_account_creation=True):
     if not service_user:
         raise RuntimeError("service_user not found in config!")
 
+    my_identity, my_user, my_player, user_roles = _query_identity(username)
+
     # if we do not have an identity, create one along with a user and a player
     if my_identity is None:
         # if this is a service user make sure the password
@@ -98,45 +96,42 @@ def authenticate(username, password, automatic_account_creation=True):
             else:
                 create_roles.append("service")
 
-        my_identity = UserIdentity(name=username, identity_type=identity_type)
-        my_identity.set_password(password)
-        if is_old:
-            my_user = g.db.query(User) \
-                          .filter(User.user_name == username) \
-                          .first()
-            if my_user:
-                my_identity.user_id = my_user.user_id
-                log.info("Found an old-style user. Hacking it into identity")
-
-        g.db.add(my_identity)
-        g.db.flush()
-        log.info("User Identity '%s' has been created with id %s",
-                 username, my_identity.identity_id)
+        my_identity = _create_identity(username, identity_type, password)
+        if my_identity is None:
+            # a concurrent login created the identity first, carry on with that one
+            log.info("User Identity '%s' was created by a concurrent login", username)
+            my_identity, my_user, my_player, user_roles = _query_identity(username)
+            _check_password(my_identity, password)
+        else:
+            log.info("User Identity '%s' has been created with id %s",
+                     username, my_identity.identity_id)
+            if is_old:
+                my_user = g.db.query(User) \
+                              .filter(User.user_name == username) \
+                              .first()
+                if my_user:
+                    my_identity.user_id = my_user.user_id
+                    log.info("Found an old-style user. Hacking it into identity")
+                    if my_user.status != "active":
+                        my_user = None
+                    else:
+                        user_roles = [r.role for r in my_user.roles]
+                        my_player = g.db.query(CorePlayer) \
+                                        .filter(CorePlayer.user_id == my_user.user_id) \
+                                        .order_by(CorePlayer.player_id) \
+                                        .first()
     else:
-        if not my_identity.check_password(password):
-            abort(http_client.METHOD_NOT_ALLOWED, message="Incorrect password")
-            return
+        _check_password(my_identity, password)
 
-    if my_identity:
-        identity_id = my_identity.identity_id
+    identity_id = my_identity.identity_id
 
-    my_user = None
-    my_player = None
-    my_user_name = ""
-    user_id = 0
-    user_roles = []
-    player_id = 0
-    player_name = ""
-    if my_identity.user_id:
-        my_user = g.db.query(User).get(my_identity.user_id)
-        if my_user.status != "active":
-            log.info("Logon identity is using an inactive user %s, "
-                     "creating new one", my_user.user_id)
-            my_user = None
-        else:
-            user_id = my_user.user_id
+    if my_user is None and my_identity.user_id:
+        log.info("Logon identity is using an inactive user %s, "
+                 "creating new one", my_identity.user_id)
 
     if my_user is None:
+        my_player = None
+        user_roles = []
         if not automatic_account_creation:
             log.info("User Identity %s has no user but "
                      "automatic_account_creation is false so he "
@@ -147,23 +142,22 @@ def authenticate(username, password, automatic_account_creation=True):
             g.db.add(my_user)
             # this is so we can access the auto-increment key value
             g.db.flush()
-            user_id = my_user.user_id
             for role_name in create_roles:
-                role = UserRole(user_id=user_id, role=role_name)
+                role = UserRole(user_id=my_user.user_id, role=role_name)
                 g.db.add(role)
-            my_identity.user_id = user_id
+            user_roles = list(create_roles)
+            my_identity.user_id = my_user.user_id
             log.info("User '%s' has been created with user_id %s",
-                     username, user_id)
+                     username, my_user.user_id)
 
+    user_id = 0
+    my_user_name = ""
+    player_id = 0
+    player_name = ""
     if my_user:
-        user_roles = [r.role for r in my_user.roles]
         user_id = my_user.user_id
         my_user_name = my_user.user_name
 
-        my_player = g.db.query(CorePlayer) \
-                        .filter(CorePlayer.user_id == user_id) \
-                        .first()
-
         if my_player is None:
             my_player = CorePlayer(user_id=user_id, player_name=u"")
             g.db.add(my_player)
@@ -172,12 +166,11 @@ def authenticate(username, password, automatic_account_creation=True):
             log.info("Player for user %s has been created with player_id %s",
                      my_user.user_id, my_player.player_id)
 
-    if my_player:
         player_id = my_player.player_id
         player_name = my_player.player_name
 
-    if my_user and not my_user.default_player_id:
-        my_user.default_player_id = my_player.player_id
+        if not my_user.default_player_id:
+            my_user.default_player_id = my_player.player_id
 
     g.db.commit()
 
@@ -193,3 +186,54 @@ def authenticate(username, password, automatic_account_creation=True):
     cache = UserCache()
     cache.set_all(user_id, ret)
     return ret
+
+
+def _check_password(my_identity, password):
+    if not my_identity.check_password(password):
+        abort(http_client.METHOD_NOT_ALLOWED, message="Incorrect password")
+    if my_identity.password_needs_rehash():
+        # upgrade the hash while we have the password, it's committed with the login
+        my_identity.set_password(password)
+
+
+def _create_identity(username, identity_type, password):
+    """
+    Insert the identity 'username' unless it exists. Returns the new identity,
+    or None if another login created it first. Identity names are unique so
+    concurrent first logins can't create duplicates. The insert waits for a
+    concurrent one to commit or roll back before it decides.
+    """
+    my_identity = UserIdentity(name=username, identity_type=identity_type)
+    my_identity.set_password(password)
+    table = UserIdentity.__table__
+    stmt = pg_insert(table).values(name=my_identity.name,
+                                   identity_type=my_identity.identity_type,
+                                   password_hash=my_identity.password_hash) \
+        .on_conflict_do_nothing(index_elements=[table.c.name]) \
+        .returning(table.c.identity_id)
+    identity_id = g.db.execute(stmt).scalar()
+    if identity_id is None:
+        return None
+    return g.db.query(UserIdentity).get(identity_id)
+
+
+def _query_identity(username):
+    """
+    Fetch the identity 'username' along with its active user, the user's roles
+    and player in a single query. Returns a tuple of (identity, user, player, roles)
+    where all but the identity are None or empty if missing.
+    """
+    roles = select([func.array_agg(UserRole.role)]) \
+        .where(UserRole.user_id == User.user_id) \
+        .as_scalar()
+    row = g.db.query(UserIdentity, User, CorePlayer, roles) \
+              .outerjoin(User, and_(User.user_id == UserIdentity.user_id,
+                                    User.status == "active")) \
+              .outerjoin(CorePlayer, CorePlayer.user_id == User.user_id) \
+              .filter(UserIdentity.name == username) \
+              .order_by(UserIdentity.identity_id, CorePlayer.player_id) \
+              .first()
+    if row is None:
+        return None, None, None, []
+    my_identity, my_user, my_player, user_roles = row
+    return my_identity, my_user, my_player, list(user_roles or [])
@@ -1,6 +1,8 @@
 import OpenSSL
 import struct
 import base64
+import collections
+import datetime
 
 from six.moves import http_client
 from six.moves.urllib.parse import urlparse
@@ -18,6 +20,12 @@ from .authenticate import authenticate as base_authenticate
 # We make the assumption that a public key stored on this web site is a trusted one.
 TRUSTED_KEY_URL_HOST = ".apple.com"
 
+# Number of parsed certificates kept in process, keyed by url
+CERTIFICATE_CACHE_SIZE = 16
+
+# url -> (certificate, notAfter), most recently used last
+_certificates = collections.OrderedDict()
+
 
 def authenticate(auth_info):
     assert auth_info['provider'] == "gamecenter"
@@ -70,6 +78,28 @@ def validate_gamecenter_token(gc_token):
     return run_gamecenter_token_validation(gc_token=gc_token, app_bundles=app_bundles)
 
 
+def get_cached_certificate(url):
+    """Returns the parsed certificate for 'url' if it's cached and has not expired."""
+    entry = _certificates.get(url)
+    if entry is None:
+        return None
+    cert, not_after = entry
+    if datetime.datetime.utcnow() >= not_after:
+        del _certificates[url]
+        return None
+    _certificates.move_to_end(url)
+    return cert
+
+
+def cache_certificate(url, cert):
+    """Cache the parsed certificate 'cert' for 'url' until its 'notAfter' date."""
+    not_after = datetime.datetime.strptime(cert.get_notAfter().decode('ascii'), '%Y%m%d%H%M%SZ')
+    _certificates[url] = (cert, not_after)
+    _certificates.move_to_end(url)
+    while len(_certificates) > CERTIFICATE_CACHE_SIZE:
+        _certificates.popitem(last=False)
+
+
 def run_gamecenter_token_validation(gc_token, app_bundles):
     token_desc = dict(gc_token)
     token_desc["signature"] = token_desc.get("signature", "?")[:10]
@@ -94,21 +124,25 @@ def run_gamecenter_token_validation(gc_token, app_bundles):
     if not all([url_parts.scheme == "https", url_parts.hostname and url_parts.hostname.endswith(TRUSTED_KEY_URL_HOST)]):
         abort_unauthorized(error_title + ". Public key url points to unknown host: %s" % (gc_token['public_key_url']))
 
-    # Fetch public key, use cache if available.
-    try:
-        content = fetch_url(gc_token['public_key_url'], error_title)
-    except Exception as e:
-        abort_unauthorized(error_title + ". Can't fetch url '%s': %s" % (gc_token['public_key_url'], e))
-
-    # Load certificate
-    try:
-        cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, content)
-    except OpenSSL.crypto.Error as e:
-        abort_unauthorized(error_title + ". Can't load certificate: %s" % str(e))
-
-    # Verify that the certificate is not expired.
-    if cert.has_expired():
-        abort_unauthorized(error_title + ". Certificate is expired, 'notAfter' is '%s'" % cert.get_notAfter())
+    cert = get_cached_certificate(gc_token['public_key_url'])
+    if cert is None:
+        # Fetch public key, use cache if available.
+        try:
+            content = fetch_url(gc_token['public_key_url'], error_title)
+        except Exception as e:
+            abort_unauthorized(error_title + ". Can't fetch url '%s': %s" % (gc_token['public_key_url'], e))
+
+        # Load certificate
+        try:
+            cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, content)
+        except OpenSSL.crypto.Error as e:
+            abort_unauthorized(error_title + ". Can't load certificate: %s" % str(e))
+
+        # Verify that the certificate is not expired.
+        if cert.has_expired():
+            abort_unauthorized(error_title + ". Certificate is expired, 'notAfter' is '%s'" % cert.get_notAfter())
+
+        cache_certificate(gc_token['public_key_url'], cert)
 
     # Check signature
     salt_decoded = base64.b64decode(gc_token["salt"])
@@ -8,6 +8,7 @@ from werkzeug.exceptions import Unauthorized
 from flask import request
 from flask_smorest import abort
 from driftbase.auth import get_provider_config
+from driftbase.auth.util import http_post, cached_ticket_validation
 
 from drift.core.extensions.schemachecker import check_schema
 from .authenticate import authenticate as base_authenticate
@@ -66,10 +67,13 @@ def validate_googleplay_token():
     app_client_ids = gp_config.get("client_ids", None)
 
     # Call validation and authenticate if token is good
-    identity_id = run_token_validation(
-        user_id=provider_details['user_id'],
-        id_token=provider_details['id_token'],
-        app_client_ids=app_client_ids
+    identity_id = cached_ticket_validation(
+        'googleplay', [provider_details['user_id'], provider_details['id_token']],
+        lambda: run_token_validation(
+            user_id=provider_details['user_id'],
+            id_token=provider_details['id_token'],
+            app_client_ids=app_client_ids
+        )
     )
 
     return identity_id
@@ -85,7 +89,7 @@ def run_token_validation(user_id, id_token, app_client_ids):
     url = token_check_url.format(id_token=id_token)
 
     try:
-        ret = requests.post(url, headers={'Accept': 'application/json'})
+        ret = http_post('googleplay', url, headers={'Accept': 'application/json'})
     except requests.exceptions.RequestException as e:
         log.warning("Google Play authentication request failed: %s", e)
         abort_unauthorized("Google Play token validation failed. Can't reach Google Play platform.")
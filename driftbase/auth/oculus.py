@@ -8,6 +8,7 @@ from werkzeug.exceptions import Unauthorized
 from flask import request
 from flask_smorest import abort
 from driftbase.auth import get_provider_config
+from driftbase.auth.util import http_post
 
 from drift.core.extensions.schemachecker import check_schema
 
@@ -64,7 +65,8 @@ def validate_oculus_ticket():
     if not oculus_config:
         abort(http_client.SERVICE_UNAVAILABLE, description="Oculus authentication not configured for current tenant")
 
-    # Call validation and authenticate if ticket is good
+    # Call validation and authenticate if ticket is good. The nonce is single use
+    # so the validation isn't cached.
     identity_id = run_ticket_validation(
         user_id=provider_details['user_id'],
         access_token=oculus_config['access_token'],
@@ -84,7 +86,7 @@ def run_ticket_validation(user_id, access_token, nonce):
     url = token_check_url.format(user_id=user_id, access_token=access_token, nonce=nonce)
 
     try:
-        ret = requests.post(url, headers={'Accept': 'application/json'})
+        ret = http_post('oculus', url, headers={'Accept': 'application/json'})
     except requests.exceptions.RequestException as e:
         log.warning("Oculus authentication request failed: %s", e)
         abort_unauthorized("Oculus ticket validation failed. Can't reach Oculus platform.")
@@ -0,0 +1,148 @@
+"""
+    Password hashing for user identities.
+
+    The hashing scheme is picked per identity type:
+
+    hmac        Keyed HMAC-SHA256. Meant for high entropy secrets such as the
+                ones generated by devices for 'device_id' and 'uuid' logins, where
+                a slow hash buys nothing. Requires an HMAC key in the app config,
+                otherwise 'pbkdf2' is used instead.
+    scrypt      Memory-hard KDF for passwords chosen by people. A login costs about
+                5 times as much CPU as with 'pbkdf2'.
+    pbkdf2      The werkzeug 'pbkdf2:sha1:25000' hash all identities used to get.
+
+    The defaults in DEFAULT_SCHEMES can be overridden with the 'password_hash_schemes'
+    app config, a dict of identity type -> scheme. Identity types which aren't listed
+    use 'pbkdf2'. Old style logins without an identity type, such as the service user
+    and test logins, stay on 'pbkdf2' unless configured otherwise.
+
+    The HMAC keys are configured with 'password_hmac_keys', a dict of key id -> key,
+    and 'password_hmac_key_id', the id of the key new hashes are made with. The key id
+    is stored with the hash, so to rotate the key add a new one and point
+    'password_hmac_key_id' at it. Keep the previous keys until the hashes made with
+    them have been replaced, or their owners can't log in.
+
+    The scheme and parameters are stored with the hash so existing hashes keep working
+    when the config changes. A hash made with another scheme or other parameters than
+    the current ones is replaced when its owner logs in.
+"""
+import hashlib
+import hmac
+import logging
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, gen_salt
+
+log = logging.getLogger(__name__)
+
+HMAC = "hmac"
+SCRYPT = "scrypt"
+PBKDF2 = "pbkdf2"
+
+DEFAULT_SCHEMES = {
+    "device_id": HMAC,
+    "uuid": HMAC,
+    "": PBKDF2,
+    "user+pass": SCRYPT,
+    "viveport": SCRYPT,
+    "hypereal": SCRYPT,
+    "7663": SCRYPT,
+}
+
+PBKDF2_METHOD = "pbkdf2:sha1:25000"
+HMAC_METHOD = "hmac:sha256"
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_METHOD = "scrypt:%s:%s:%s" % (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+SALT_LENGTH = 16
+
+
+def _hmac_hash(key, salt, password):
+    return hmac.new(key.encode("utf-8"), (salt + password).encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def _scrypt_hash(salt, password, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt.encode("utf-8"),
+                          n=n, r=r, p=p, maxmem=256 * n * r, dklen=32).hex()
+
+
+def _hmac_method(key_id):
+    return "%s:%s" % (HMAC_METHOD, key_id)
+
+
+def hash_password(password, scheme, hmac_keys=None, hmac_key_id=None):
+    """Returns a hash of 'password' using 'scheme'."""
+    salt = gen_salt(SALT_LENGTH)
+    if scheme == HMAC:
+        hmac_key = (hmac_keys or {}).get(hmac_key_id)
+        if not hmac_key:
+            raise ValueError("The 'hmac' scheme requires a key")
+        return "%s$%s$%s" % (_hmac_method(hmac_key_id), salt, _hmac_hash(hmac_key, salt, password))
+    elif scheme == SCRYPT:
+        return "%s$%s$%s" % (SCRYPT_METHOD, salt,
+                             _scrypt_hash(salt, password, SCRYPT_N, SCRYPT_R, SCRYPT_P))
+    elif scheme == PBKDF2:
+        return generate_password_hash(password, method=PBKDF2_METHOD)
+    raise ValueError("Unknown password hashing scheme '%s'" % scheme)
+
+
+def check_password(pwhash, password, hmac_keys=None):
+    """Returns True if 'password' matches 'pwhash', whichever scheme or key made it."""
+    if not pwhash or pwhash.count("$") < 2:
+        return False
+    method, salt, hashval = pwhash.split("$", 2)
+    if method.startswith(HMAC + ":"):
+        key_id = method[len(HMAC_METHOD) + 1:]
+        hmac_key = (hmac_keys or {}).get(key_id)
+        if not hmac_key:
+            log.error("Can't check an 'hmac' password hash as key '%s' is not in 'password_hmac_keys'",
+                      key_id)
+            return False
+        actual = _hmac_hash(hmac_key, salt, password)
+    elif method.startswith(SCRYPT + ":"):
+        try:
+            n, r, p = (int(v) for v in method.split(":")[1:])
+        except ValueError:
+            return False
+        actual = _scrypt_hash(salt, password, n, r, p)
+    else:
+        return check_password_hash(pwhash, password)
+    return hmac.compare_digest(actual, hashval)
+
+
+def needs_rehash(pwhash, scheme, hmac_key_id=None):
+    """
+    Returns True if 'pwhash' wasn't made with 'scheme' and its current parameters,
+    or with the current HMAC key.
+    """
+    method = {HMAC: _hmac_method(hmac_key_id), SCRYPT: SCRYPT_METHOD, PBKDF2: PBKDF2_METHOD}[scheme]
+    return not pwhash or pwhash.split("$", 1)[0] != method
+
+
+def check_config(config):
+    """Raises RuntimeError if the HMAC keys in 'config' are not usable."""
+    hmac_keys = config.get("password_hmac_keys") or {}
+    hmac_key_id = config.get("password_hmac_key_id")
+    if (hmac_keys or hmac_key_id is not None) and not hmac_keys.get(hmac_key_id):
+        raise RuntimeError("'password_hmac_key_id' must be the id of a key in 'password_hmac_keys'")
+    for key_id in hmac_keys:
+        if not isinstance(key_id, str) or "$" in key_id:
+            raise RuntimeError("Invalid key id '%s' in 'password_hmac_keys'" % key_id)
+
+
+def get_hmac_keys():
+    return current_app.config.get("password_hmac_keys") or {}
+
+
+def get_hmac_key_id():
+    return current_app.config.get("password_hmac_key_id")
+
+
+def get_scheme(identity_type):
+    """Returns the hashing scheme to use for identities of 'identity_type'."""
+    schemes = dict(DEFAULT_SCHEMES, **current_app.config.get("password_hash_schemes", {}))
+    scheme = schemes.get(identity_type or "", PBKDF2)
+    if scheme == HMAC and not get_hmac_keys().get(get_hmac_key_id()):
+        scheme = PBKDF2
+    return scheme
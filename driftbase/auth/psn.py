@@ -7,6 +7,7 @@ from werkzeug.exceptions import Unauthorized
 from flask import request, escape
 from flask_smorest import abort
 from driftbase.auth import get_provider_config
+from driftbase.auth.util import http_get, http_post
 from base64 import urlsafe_b64encode
 
 from drift.core.extensions.schemachecker import check_schema
@@ -64,7 +65,8 @@ def validate_psn_ticket():
     if not psn_config:
         abort(http_client.SERVICE_UNAVAILABLE, description="PSN authentication not configured for current tenant")
 
-    # Call validation and authenticate if ticket is good
+    # Call validation and authenticate if ticket is good. The auth code is single
+    # use so the validation isn't cached.
     identity_id = run_ticket_validation(
         user_id=provider_details['psn_id'],
         auth_code=provider_details['auth_code'],
@@ -100,7 +102,7 @@ def run_ticket_validation(user_id, auth_code, issuer, client_id, client_secret):
     )
 
     try:
-        ret = requests.post(url, data=payload, headers=headers)
+        ret = http_post('psn', url, data=payload, headers=headers)
     except requests.exceptions.RequestException as e:
         log.warning("PSN authentication request failed: %s", e)
         abort_unauthorized("PSN authentication failed. Can't reach PSN platform.")
@@ -132,7 +134,7 @@ def run_ticket_validation(user_id, auth_code, issuer, client_id, client_secret):
         token=token
     )
     try:
-        ret = requests.get(validation_url, headers=headers)
+        ret = http_get('psn', validation_url, headers=headers)
     except requests.exceptions.RequestException as e:
         log.warning("PSN authentication request failed: %s", e)
         abort_unauthorized("PSN auth token validation failed. Can't reach PSN platform.")
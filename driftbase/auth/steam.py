@@ -9,7 +9,7 @@ from flask import request
 from flask_smorest import abort
 
 from driftbase.auth import get_provider_config
-from driftbase.auth.util import fetch_url
+from driftbase.auth.util import fetch_url, http_get, cached_ticket_validation
 from drift.core.extensions.schemachecker import check_schema
 from .authenticate import authenticate as base_authenticate
 
@@ -76,18 +76,21 @@ def validate_steam_ticket():
         abort(http_client.SERVICE_UNAVAILABLE, description="Steam tickets cannot be validated at the moment.")
 
     # Call validation and authenticate if ticket is good
-    identity_id = run_ticket_validation(provider_details, key_url=key_url, key=key, appid=appid)
+    identity_id = cached_ticket_validation(
+        'steam', [appid, provider_details['ticket'], provider_details.get('steamid')],
+        lambda: run_ticket_validation(provider_details, key_url=key_url, key=key, appid=appid)
+    )
     return identity_id
 
 
 # for mocking
 def _call_authenticate_user_ticket(url):
-    return requests.get(url)
+    return http_get('steam', url)
 
 
 # for mocking
 def _call_check_app_ownership(url):
-    return requests.get(url)
+    return http_get('steam', url)
 
 
 def run_ticket_validation(provider_details, key_url=None, key=None, appid=None):
@@ -1,15 +1,82 @@
+import hashlib
+import json
 import logging
 
 from six.moves.urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import boto3
 from werkzeug.exceptions import ServiceUnavailable
-from flask import g
+from flask import g, current_app
 from flask.globals import _app_ctx_stack
 
 log = logging.getLogger(__name__)
 
+# (connect, read) timeouts for calls to the platform APIs
+HTTP_TIMEOUT = (3.05, 10)
+# Connection failures are retried for all requests, failed responses only for GET
+HTTP_RETRIES = 2
+HTTP_POOL_SIZE = 20
+
+DEFAULT_TICKET_CACHE_TTL = 60
+
+_http_sessions = {}
+
+
+def get_http_session(provider):
+    """
+    Returns a requests session for calls to 'provider'. The session is shared
+    by all requests in the process so connections to the provider are kept
+    alive and reused.
+    """
+    session = _http_sessions.get(provider)
+    if session is None:
+        retry = Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=1, status=1,
+                      status_forcelist=(502, 503, 504), backoff_factor=0.1,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _http_sessions[provider] = session
+    return session
+
+
+def http_get(provider, url, **kwargs):
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return get_http_session(provider).get(url, **kwargs)
+
+
+def http_post(provider, url, **kwargs):
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return get_http_session(provider).post(url, **kwargs)
+
+
+def cached_ticket_validation(provider, ticket, validate):
+    """
+    Returns the identity that 'validate' returns for 'ticket', a list of the
+    values that make up the ticket. Successful validations are cached in Redis for
+    'auth_ticket_cache_ttl' seconds, keyed on a hash of the ticket, so a client
+    retrying its login doesn't hit the provider again. Failures are not cached.
+
+    Only use this for providers whose tickets can be validated more than once
+    until they expire. Caching single use tickets, such as Oculus nonces or PSN
+    auth codes, would let a ticket be replayed within the cache ttl.
+    """
+    ttl = current_app.config.get("auth_ticket_cache_ttl", DEFAULT_TICKET_CACHE_TTL)
+    if not ttl or not hasattr(g, "redis"):
+        return validate()
+    ticket_hash = hashlib.sha256(json.dumps([provider] + list(ticket)).encode("utf-8")).hexdigest()
+    key = "authticket:%s:%s" % (provider, ticket_hash)
+    identity = g.redis.get(key)
+    if identity is not None:
+        return json.loads(identity)
+    identity = validate()
+    g.redis.set(key, json.dumps(identity), expire=ttl)
+    return identity
+
 
 def fetch_url(url, error_title, expire=None):
     """
@@ -36,7 +103,7 @@ def fetch_url(url, error_title, expire=None):
         signed_url = _aws_s3_sign_url(url)
 
         try:
-            ret = requests.get(signed_url)
+            ret = http_get("urlget", signed_url)
         except requests.exceptions.RequestException as e:
             log.warning(error_title + "Url '%s' can't be fetched. %s", signed_url, e)
             raise ServiceUnavailable()
@@ -0,0 +1,41 @@
+"""
+    Buffering of event rows written as part of a transaction.
+
+    Player and match events are queued on the DB session instead of being added
+    as ORM objects, and written with one multi-row INSERT per table when the
+    session commits. The events are therefore written in the same transaction
+    as the change they describe and are discarded if it is rolled back.
+"""
+import collections
+
+from sqlalchemy import event, Sequence
+from sqlalchemy.orm import Session
+
+PENDING_EVENTS_KEY = "driftbase.pending_events"
+
+
+def queue_event(db_session, model, **values):
+    """Queue a row for 'model' to be inserted when 'db_session' commits."""
+    db_session.info.setdefault(PENDING_EVENTS_KEY, []).append((model.__table__, values))
+
+
+@event.listens_for(Session, "before_commit")
+def _write_pending_events(session):
+    pending = session.info.pop(PENDING_EVENTS_KEY, None)
+    if not pending:
+        return
+    rows_by_table = collections.OrderedDict()
+    for table, values in pending:
+        rows_by_table.setdefault(table, []).append(values)
+    for table, rows in rows_by_table.items():
+        # a multi-row insert only applies sequence defaults to the first row
+        sequences = {c.name: c.default for c in table.primary_key if isinstance(c.default, Sequence)}
+        if sequences:
+            rows = [dict({name: seq.next_value() for name, seq in sequences.items()}, **row)
+                    for row in rows]
+        session.execute(table.insert().values(rows))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_events(session):
+    session.info.pop(PENDING_EVENTS_KEY, None)
@@ -0,0 +1,191 @@
+"""
+    Friendship graph cache.
+
+    The friends of each player are kept in a Redis set, 'friends:<player_id>',
+    holding the player id's of every active friend. The empty member marks that
+    the set has been loaded from the DB, an unmarked or missing set is rebuilt
+    from the Friendship table on first use.
+
+    The sets are updated after the DB write is committed. Rebuilds watch the set
+    so a rebuild which read the DB before a concurrent write was committed is
+    retried instead of overwriting the newer contents.
+
+    The sets expire after 'friends_cache_ttl' seconds of not being written to.
+
+    Friend invites are stored in the DB unless the tenant enables 'invites_in_redis'
+    in its 'friends' config, in which case they are kept in Redis keys which expire
+    along with the invite. Expired DB invites are reaped in batches by the
+    'reap-friend-invites' task, see driftbase.tasks.
+"""
+import datetime
+import logging
+
+import redis as redis_lib
+from flask import current_app
+from sqlalchemy import or_
+
+from driftbase.models.db import Friendship, FriendInvite
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FRIENDS_CACHE_TTL = 60 * 60 * 24
+# player id's are never empty so the empty member is free for the loaded marker
+LOADED_MEMBER = b""
+
+# Expired invites are kept around for this long so redeeming them reports that they expired
+DEFAULT_INVITE_RETENTION_SECONDS = 60 * 60 * 24
+INVITE_REAP_BATCH_SIZE = 1000
+
+
+# for mocking
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def _ttl():
+    return current_app.config.get("friends_cache_ttl", DEFAULT_FRIENDS_CACHE_TTL)
+
+
+def _key(redis, player_id):
+    return redis.make_key("friends:%s" % player_id)
+
+
+def query_friend_ids(db_session, player_id):
+    """Returns the set of player id's of the active friends of a player, read from the DB."""
+    rows = db_session.query(Friendship.player1_id, Friendship.player2_id) \
+                     .filter(or_(Friendship.player1_id == player_id,
+                                 Friendship.player2_id == player_id),
+                             Friendship.status == "active")
+    return set(p2 if p1 == player_id else p1 for p1, p2 in rows)
+
+
+def rebuild_friends(redis, db_session, player_id):
+    """Load the friends of a player from the DB into the cache. Returns the set of friend id's."""
+    key = _key(redis, player_id)
+    friend_ids = set()
+
+    def rebuild(pipe):
+        friend_ids.clear()
+        friend_ids.update(query_friend_ids(db_session, player_id))
+        pipe.multi()
+        pipe.delete(key)
+        pipe.sadd(key, LOADED_MEMBER, *friend_ids)
+        pipe.expire(key, _ttl())
+
+    redis.conn.transaction(rebuild, key)
+    return friend_ids
+
+
+def _ensure_loaded(redis, db_session, *player_ids):
+    pipe = redis.conn.pipeline(transaction=False)
+    for player_id in player_ids:
+        pipe.sismember(_key(redis, player_id), LOADED_MEMBER)
+    for player_id, is_loaded in zip(player_ids, pipe.execute()):
+        if not is_loaded:
+            rebuild_friends(redis, db_session, player_id)
+
+
+def get_friend_ids(redis, db_session, player_id):
+    """Returns the set of player id's of the active friends of a player."""
+    key = _key(redis, player_id)
+    members = redis.conn.smembers(key)
+    if LOADED_MEMBER not in members:
+        return rebuild_friends(redis, db_session, player_id)
+    members.discard(LOADED_MEMBER)
+    return set(int(m) for m in members)
+
+
+def are_friends(redis, db_session, player_id, other_player_id):
+    """Returns True if the two players are friends."""
+    key = _key(redis, player_id)
+    pipe = redis.conn.pipeline(transaction=False)
+    pipe.sismember(key, LOADED_MEMBER)
+    pipe.sismember(key, other_player_id)
+    is_loaded, is_friend = pipe.execute()
+    if not is_loaded:
+        return other_player_id in rebuild_friends(redis, db_session, player_id)
+    return bool(is_friend)
+
+
+def get_mutual_friend_ids(redis, db_session, player_id, other_player_id):
+    """Returns the set of player id's of the friends the two players have in common."""
+    _ensure_loaded(redis, db_session, player_id, other_player_id)
+    members = redis.conn.sinter(_key(redis, player_id), _key(redis, other_player_id))
+    members.discard(LOADED_MEMBER)
+    return set(int(m) for m in members)
+
+
+def _update(redis, player_id, friend_id, add):
+    keys = [_key(redis, player_id), _key(redis, friend_id)]
+    try:
+        pipe = redis.conn.pipeline()
+        for key, member in zip(keys, [friend_id, player_id]):
+            if add:
+                pipe.sadd(key, member)
+            else:
+                pipe.srem(key, member)
+            pipe.expire(key, _ttl())
+        pipe.execute()
+    except redis_lib.RedisError:
+        log.exception("Unable to update the friends cache for players %s and %s, dropping it",
+                      player_id, friend_id)
+        # the sets are rebuilt from the DB on next use
+        redis.conn.delete(*keys)
+
+
+def add_friendship(redis, player_id, friend_id):
+    """Record a new friendship in the cache. Call after the friendship has been committed."""
+    _update(redis, player_id, friend_id, add=True)
+
+
+def remove_friendship(redis, player_id, friend_id):
+    """Remove a friendship from the cache. Call after the deletion has been committed."""
+    _update(redis, player_id, friend_id, add=False)
+
+
+def _invite_key(redis, token):
+    return redis.make_key("friendinvite:%s" % token)
+
+
+def create_redis_invite(redis, token, player_id, expires_seconds):
+    """Store an invite from 'player_id' which expires in 'expires_seconds'."""
+    redis.conn.set(_invite_key(redis, token), player_id, ex=expires_seconds)
+
+
+def get_redis_invite(redis, token):
+    """Returns the id of the player who issued the invite or None if it does not exist."""
+    player_id = redis.conn.get(_invite_key(redis, token))
+    if player_id is None:
+        return None
+    return int(player_id)
+
+
+def delete_redis_invite(redis, token):
+    redis.conn.delete(_invite_key(redis, token))
+
+
+def reap_friend_invites(db_session, batch_size=INVITE_REAP_BATCH_SIZE):
+    """
+    Delete invites which expired more than 'friend_invite_retention_seconds' ago.
+    Deleted invites are expired when they are deleted. Each batch is committed
+    separately. Returns the number of invites deleted.
+    """
+    retention = current_app.config.get("friend_invite_retention_seconds",
+                                       DEFAULT_INVITE_RETENTION_SECONDS)
+    cutoff = utcnow() - datetime.timedelta(seconds=retention)
+    num_rows = 0
+    while True:
+        batch = db_session.query(FriendInvite.id) \
+                          .filter(FriendInvite.expiry_date < cutoff) \
+                          .limit(batch_size)
+        deleted = db_session.query(FriendInvite) \
+                            .filter(FriendInvite.id.in_(batch)) \
+                            .delete(synchronize_session=False)
+        db_session.commit()
+        num_rows += deleted
+        if deleted < batch_size:
+            break
+    if num_rows:
+        log.info("Reaped %s expired friend invites", num_rows)
+    return num_rows
+
@@ -0,0 +1,332 @@
+"""
+    Storage of gamestates and gamestate history
+
+    Each history row is stored either as a keyframe, holding the full gamestate,
+    or as a delta, holding a JSON patch against the previous history row of the
+    same gamestate. The payload is zlib compressed JSON in 'packed_data'. Rows
+    written before this scheme was introduced keep the full gamestate in 'data'.
+
+    History is pruned according to a retention policy which keeps the last
+    'gamestate_history_keep_versions' versions of each gamestate as well as the
+    last version of each day for 'gamestate_history_keep_days' days. Gamestates
+    are queued for pruning when they are saved. The queue is processed in batches
+    of 'gamestate_history_prune_batch_size' gamestates by the scheduled
+    'prune-gamestate-history' task, see driftbase.tasks. The queue can be filled
+    with every existing gamestate with the 'backfill-gamestate-history-prune' task.
+"""
+import datetime
+import json
+import logging
+import zlib
+
+from drift.orm import utc_now
+from flask import current_app
+from sqlalchemy import select, and_, true, func, Sequence
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from driftbase.models.db import GameState, GameStateHistory
+from driftbase.utils.jsonpatch import make_patch, apply_patch
+
+log = logging.getLogger(__name__)
+
+# Write a full copy of the gamestate every this many versions
+DEFAULT_HISTORY_KEYFRAME_INTERVAL = 20
+
+DEFAULT_HISTORY_KEEP_VERSIONS = 100
+DEFAULT_HISTORY_KEEP_DAYS = 30
+# Number of gamestates pruned in each transaction
+DEFAULT_HISTORY_PRUNE_BATCH_SIZE = 500
+HISTORY_DELETE_BATCH_SIZE = 1000
+# Range of player id's scanned in each query when backfilling the prune queue
+HISTORY_BACKFILL_BATCH_SIZE = 1000
+
+HISTORY_ID_SEQUENCE = Sequence("ck_gamestateshistory_gamestatehistory_id_seq")
+
+
+# for mocking
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def _pack(obj):
+    return zlib.compress(json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+
+def _unpack(packed_data):
+    return json.loads(zlib.decompress(packed_data).decode("utf-8"))
+
+
+def make_history_row(gamestate, previous_data=None, base_gamestatehistory_id=None):
+    """
+    Returns a new GameStateHistory row for the current contents of 'gamestate'.
+    'previous_data' is the gamestate data as it was in history row
+    'base_gamestatehistory_id', if any. The row is stored as a delta against it
+    unless a keyframe is due.
+    """
+    row = GameStateHistory(player_id=gamestate.player_id,
+                           version=gamestate.version,
+                           namespace=gamestate.namespace,
+                           journal_id=gamestate.journal_id)
+    interval = current_app.config.get("gamestate_history_keyframe_interval",
+                                      DEFAULT_HISTORY_KEYFRAME_INTERVAL)
+    is_keyframe = previous_data is None \
+        or base_gamestatehistory_id is None \
+        or (gamestate.version - 1) % interval == 0
+    if is_keyframe:
+        row.is_delta = False
+        row.packed_data = _pack(gamestate.data)
+    else:
+        row.is_delta = True
+        row.base_gamestatehistory_id = base_gamestatehistory_id
+        row.packed_data = _pack(make_patch(previous_data, gamestate.data))
+    return row
+
+
+def save_gamestate(db_session, player_id, namespace, data, journal_id=None):
+    """
+    Insert or update a gamestate and write the new version to the history table.
+
+    The gamestate is upserted in a single statement which also allocates the id of
+    the new history row and returns the previous contents needed for the delta.
+    Returns a transient GameState holding the stored values. The caller must commit.
+    """
+    table = GameState.__table__
+    # the CTE reads the row as it was before the upsert
+    current = select([table.c.version, table.c.journal_id, table.c.data,
+                      table.c.gamestatehistory_id]) \
+        .where(and_(table.c.player_id == player_id, table.c.namespace == namespace)) \
+        .cte("current")
+    insert = pg_insert(table).values(player_id=player_id,
+                                     namespace=namespace,
+                                     version=1,
+                                     data=data,
+                                     journal_id=journal_id,
+                                     gamestatehistory_id=HISTORY_ID_SEQUENCE.next_value())
+    upsert = insert.on_conflict_do_update(
+        index_elements=[table.c.player_id, table.c.namespace],
+        set_={
+            "version": table.c.version + 1,
+            "data": insert.excluded.data,
+            "journal_id": insert.excluded.journal_id,
+            "gamestatehistory_id": insert.excluded.gamestatehistory_id,
+            "modify_date": utc_now,
+        }
+    ).returning(*table.c).cte("upsert")
+    stmt = select([upsert,
+                   current.c.version.label("previous_version"),
+                   current.c.journal_id.label("previous_journal_id"),
+                   current.c.data.label("previous_data"),
+                   current.c.gamestatehistory_id.label("previous_gamestatehistory_id")]) \
+        .select_from(upsert.outerjoin(current, true()))
+    result = db_session.execute(stmt).first()
+
+    gamestate = GameState(**{c.name: result[c.name] for c in table.c})
+    if result["previous_journal_id"] and journal_id and journal_id <= result["previous_journal_id"]:
+        # TODO: Raise here?
+        log.warning("Writing a new gamestate with an older journal_id, %s "
+                    "than the current one", journal_id, extra=gamestate.as_dict())
+
+    # write new gamestate to the history table for safe keeping. If another write
+    # got in between the snapshot and the upsert the delta base is stale so a
+    # keyframe is written instead.
+    previous_data = None
+    if result["previous_version"] == gamestate.version - 1:
+        previous_data = result["previous_data"]
+    history_row = make_history_row(gamestate, previous_data,
+                                   result["previous_gamestatehistory_id"])
+    history_row.gamestatehistory_id = gamestate.gamestatehistory_id
+    db_session.add(history_row)
+    return gamestate
+
+
+def _row_data(row, base_data):
+    if row.packed_data is None:
+        return row.data
+    if row.is_delta:
+        return apply_patch(base_data, _unpack(row.packed_data))
+    return _unpack(row.packed_data)
+
+
+def load_history_data(db_session, rows):
+    """
+    Returns a dict of history id -> full gamestate data for each of 'rows', which
+    must all belong to the same gamestate.
+    """
+    if not rows:
+        return {}
+    first_row = min(rows, key=lambda r: r.gamestatehistory_id)
+    last_id = max(r.gamestatehistory_id for r in rows)
+    start_id = first_row.gamestatehistory_id
+    if first_row.is_delta:
+        # the chain of the oldest row starts at the nearest keyframe before it
+        start_id = db_session.query(GameStateHistory.gamestatehistory_id) \
+                             .filter(GameStateHistory.player_id == first_row.player_id,
+                                     GameStateHistory.namespace == first_row.namespace,
+                                     GameStateHistory.gamestatehistory_id < start_id,
+                                     GameStateHistory.is_delta.isnot(True)) \
+                             .order_by(GameStateHistory.gamestatehistory_id.desc()) \
+                             .limit(1) \
+                             .scalar()
+        if start_id is None:
+            raise RuntimeError("Gamestate history row %s has no keyframe" %
+                               first_row.gamestatehistory_id)
+    chain_rows = db_session.query(GameStateHistory) \
+                           .filter(GameStateHistory.player_id == first_row.player_id,
+                                   GameStateHistory.namespace == first_row.namespace,
+                                   GameStateHistory.gamestatehistory_id >= start_id,
+                                   GameStateHistory.gamestatehistory_id <= last_id) \
+                           .order_by(GameStateHistory.gamestatehistory_id) \
+                           .all()
+    data_by_id = dict(zip([r.gamestatehistory_id for r in chain_rows],
+                          get_history_data_list(chain_rows)))
+    return {r.gamestatehistory_id: data_by_id[r.gamestatehistory_id] for r in rows}
+
+
+def get_history_data(db_session, row):
+    """Returns the full gamestate data stored in history row 'row'."""
+    if not row.is_delta:
+        return _row_data(row, None)
+    return load_history_data(db_session, [row])[row.gamestatehistory_id]
+
+
+def get_history_data_list(rows):
+    """
+    Returns the full gamestate data for each of 'rows', which must be every
+    history row of a single gamestate in ascending order, starting with a keyframe.
+    """
+    ret = []
+    data_by_id = {}
+    for row in rows:
+        if row.is_delta and row.base_gamestatehistory_id not in data_by_id:
+            raise RuntimeError("Gamestate history row %s is missing its base row %s" %
+                               (row.gamestatehistory_id, row.base_gamestatehistory_id))
+        data = _row_data(row, data_by_id.get(row.base_gamestatehistory_id))
+        data_by_id[row.gamestatehistory_id] = data
+        ret.append(data)
+    return ret
+
+
+def prune_history(db_session, player_id, namespace, keep_versions, keep_days):
+    """
+    Delete history rows of a gamestate which fall outside of the retention policy.
+    Kept rows whose delta chain runs through a deleted row are rewritten as
+    keyframes. Returns the number of rows deleted. The caller must commit.
+    """
+    rows = db_session.query(GameStateHistory.gamestatehistory_id,
+                            GameStateHistory.create_date,
+                            GameStateHistory.is_delta,
+                            GameStateHistory.base_gamestatehistory_id) \
+                     .filter(GameStateHistory.player_id == player_id,
+                             GameStateHistory.namespace == namespace) \
+                     .order_by(GameStateHistory.gamestatehistory_id) \
+                     .all()
+    recent = rows[max(len(rows) - keep_versions, 0):] if keep_versions > 0 else []
+    keep = set(r.gamestatehistory_id for r in recent)
+    cutoff = utcnow() - datetime.timedelta(days=keep_days)
+    last_of_day = {}
+    for r in rows:
+        if r.create_date and r.create_date >= cutoff:
+            last_of_day[r.create_date.date()] = r.gamestatehistory_id
+    keep.update(last_of_day.values())
+    delete_ids = [r.gamestatehistory_id for r in rows if r.gamestatehistory_id not in keep]
+    if not delete_ids:
+        return 0
+
+    rekey_ids = [r.gamestatehistory_id for r in rows
+                 if r.gamestatehistory_id in keep and r.is_delta
+                 and r.base_gamestatehistory_id not in keep]
+    if rekey_ids:
+        rekey_rows = db_session.query(GameStateHistory) \
+                               .filter(GameStateHistory.gamestatehistory_id.in_(rekey_ids)) \
+                               .all()
+        data_by_id = load_history_data(db_session, rekey_rows)
+        for row in rekey_rows:
+            row.packed_data = _pack(data_by_id[row.gamestatehistory_id])
+            row.is_delta = False
+            row.base_gamestatehistory_id = None
+        db_session.flush()
+
+    for i in range(0, len(delete_ids), HISTORY_DELETE_BATCH_SIZE):
+        batch = delete_ids[i:i + HISTORY_DELETE_BATCH_SIZE]
+        db_session.query(GameStateHistory) \
+                  .filter(GameStateHistory.gamestatehistory_id.in_(batch)) \
+                  .delete(synchronize_session=False)
+    log.info("Pruned %s history rows of gamestate '%s' for player %s, rewrote %s as keyframes",
+             len(delete_ids), namespace, player_id, len(rekey_ids))
+    return len(delete_ids)
+
+
+def _prune_queue_key(redis):
+    return redis.make_key("gamestatehistory:prune")
+
+
+def schedule_history_prune(redis, player_id, namespace):
+    """Queue the history of a gamestate for pruning."""
+    redis.conn.sadd(_prune_queue_key(redis), "%s:%s" % (player_id, namespace))
+
+
+def schedule_all_history_prune(redis, db_session, batch_size=HISTORY_BACKFILL_BATCH_SIZE):
+    """
+    Queue the history of every gamestate for pruning, including deleted gamestates
+    which still have history. Returns the number of gamestates queued.
+    """
+    max_player_id = db_session.query(func.max(GameStateHistory.player_id)).scalar()
+    num_gamestates = 0
+    for first_player_id in range(0, (max_player_id or 0) + 1, batch_size):
+        rows = db_session.query(GameStateHistory.player_id, GameStateHistory.namespace) \
+                         .filter(GameStateHistory.player_id >= first_player_id,
+                                 GameStateHistory.player_id < first_player_id + batch_size) \
+                         .distinct() \
+                         .all()
+        # don't keep a transaction open while the queue is filled
+        db_session.rollback()
+        if rows:
+            redis.conn.sadd(_prune_queue_key(redis),
+                            *["%s:%s" % (player_id, namespace) for player_id, namespace in rows])
+            num_gamestates += len(rows)
+    return num_gamestates
+
+
+def prune_scheduled_history(redis, db_session, batch_size):
+    """
+    Prune the history of up to 'batch_size' queued gamestates.
+    Returns a tuple of the number of gamestates and history rows pruned.
+    """
+    keep_versions = current_app.config.get("gamestate_history_keep_versions",
+                                           DEFAULT_HISTORY_KEEP_VERSIONS)
+    keep_days = current_app.config.get("gamestate_history_keep_days",
+                                       DEFAULT_HISTORY_KEEP_DAYS)
+    queue_key = _prune_queue_key(redis)
+    entries = redis.conn.spop(queue_key, batch_size) or []
+    num_rows = 0
+    for i, entry in enumerate(entries):
+        player_id, namespace = entry.decode("utf-8").split(":", 1)
+        try:
+            num_rows += prune_history(db_session, int(player_id), namespace,
+                                      keep_versions, keep_days)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            # requeue the gamestates that were not pruned
+            redis.conn.sadd(queue_key, *entries[i:])
+            raise
+    return len(entries), num_rows
+
+
+def prune_all_scheduled_history(redis, db_session, batch_size=None, max_batches=None):
+    """
+    Prune queued gamestate history in batches until the queue is empty or
+    'max_batches' batches have been pruned. Returns a tuple of the number of
+    gamestates and history rows pruned.
+    """
+    batch_size = batch_size or current_app.config.get("gamestate_history_prune_batch_size",
+                                                      DEFAULT_HISTORY_PRUNE_BATCH_SIZE)
+    num_gamestates = num_rows = num_batches = 0
+    while max_batches is None or num_batches < max_batches:
+        batch_gamestates, batch_rows = prune_scheduled_history(redis, db_session, batch_size)
+        if not batch_gamestates:
+            break
+        num_gamestates += batch_gamestates
+        num_rows += batch_rows
+        num_batches += 1
+    return num_gamestates, num_rows
@@ -0,0 +1,147 @@
+"""
+    Read-through cache of serialized gamestates.
+
+    The gamestates of each player are kept in a Redis hash, 'gamestates:<player_id>',
+    mapping namespace -> b"<gamestate_id> <version> <json>". The JSON is the
+    serialized gamestate without its urls, which are appended when the response
+    is built so cached documents are served without being parsed.
+
+    An entry is only ever replaced by a newer (gamestate_id, version) so a slow
+    writer cannot overwrite a newer gamestate with an older one. Deleted
+    gamestates are replaced by a tombstone which outranks every version of the
+    deleted gamestate. The empty hash field marks that the hash holds every
+    gamestate of the player, which is what the gamestate list requires.
+
+    Redis errors are logged and treated as cache misses so the gamestates are
+    served from the DB. The cache is disabled if 'gamestate_cache_ttl' is set to 0.
+"""
+import logging
+
+import redis as redis_lib
+from flask import current_app
+
+log = logging.getLogger(__name__)
+
+DEFAULT_GAMESTATE_CACHE_TTL = 60 * 60
+# namespaces are never empty so the empty field name is free for the completeness marker
+COMPLETE_FIELD = b""
+TOMBSTONE_VERSION = 2 ** 31
+
+
+def _ttl():
+    return current_app.config.get("gamestate_cache_ttl", DEFAULT_GAMESTATE_CACHE_TTL)
+
+
+def _key(redis, player_id):
+    return redis.make_key("gamestates:%s" % player_id)
+
+
+def _pack(gamestate_id, version, body):
+    return b"%d %d " % (gamestate_id, version) + body
+
+
+def _unpack(value):
+    gamestate_id, version, body = value.split(b" ", 2)
+    return int(gamestate_id), int(version), body
+
+
+def _is_newer(value, gamestate_id, version):
+    if value is None:
+        return True
+    cached_id, cached_version, _ = _unpack(value)
+    return (gamestate_id, version) > (cached_id, cached_version)
+
+
+def _set_if_newer(redis, player_id, entries, complete=False):
+    """
+    Store each of 'entries', a list of (namespace, gamestate_id, version, body),
+    unless the cache already holds a newer version of the gamestate.
+    """
+    key = _key(redis, player_id)
+    namespaces = [namespace.encode("utf-8") for namespace, _, _, _ in entries]
+
+    def update(pipe):
+        current = pipe.hmget(key, namespaces) if namespaces else []
+        values = {}
+        for namespace, value, (_, gamestate_id, version, body) in zip(namespaces, current, entries):
+            if _is_newer(value, gamestate_id, version):
+                values[namespace] = _pack(gamestate_id, version, body)
+        if complete:
+            values[COMPLETE_FIELD] = b"1"
+        pipe.multi()
+        if values:
+            pipe.hset(key, mapping=values)
+        pipe.expire(key, _ttl())
+
+    try:
+        redis.conn.transaction(update, key)
+    except redis_lib.RedisError:
+        log.exception("Unable to update the gamestate cache for player %s", player_id)
+
+
+def cache_gamestate(redis, player_id, namespace, gamestate_id, version, body):
+    """Cache the serialized gamestate 'body' unless a newer version is already cached."""
+    if not _ttl():
+        return
+    _set_if_newer(redis, player_id, [(namespace, gamestate_id, version, body)])
+
+
+def cache_gamestates(redis, player_id, entries):
+    """
+    Cache every gamestate of a player. 'entries' is a list of
+    (namespace, gamestate_id, version, body).
+    """
+    if not _ttl():
+        return
+    _set_if_newer(redis, player_id, entries, complete=True)
+
+
+def uncache_gamestate(redis, player_id, namespace, gamestate_id):
+    """Mark a deleted gamestate in the cache."""
+    if not _ttl():
+        return
+    _set_if_newer(redis, player_id, [(namespace, gamestate_id, TOMBSTONE_VERSION, b"")])
+
+
+def get_cached_gamestate(redis, player_id, namespace):
+    """
+    Returns (gamestate_id, version, body) for a cached gamestate, (None, None, None)
+    if the gamestate is known to have been deleted, or None on a cache miss.
+    """
+    if not _ttl():
+        return None
+    try:
+        value = redis.conn.hget(_key(redis, player_id), namespace)
+    except redis_lib.RedisError:
+        log.exception("Unable to read the gamestate cache for player %s", player_id)
+        return None
+    if value is None:
+        return None
+    gamestate_id, version, body = _unpack(value)
+    if version == TOMBSTONE_VERSION:
+        return None, None, None
+    return gamestate_id, version, body
+
+
+def get_cached_gamestates(redis, player_id):
+    """
+    Returns a list of (namespace, gamestate_id, version, body) for every gamestate
+    of the player, ordered by namespace, or None if the cache does not hold them all.
+    """
+    if not _ttl():
+        return None
+    try:
+        values = redis.conn.hgetall(_key(redis, player_id))
+    except redis_lib.RedisError:
+        log.exception("Unable to read the gamestate cache for player %s", player_id)
+        return None
+    if COMPLETE_FIELD not in values:
+        return None
+    del values[COMPLETE_FIELD]
+    ret = []
+    for namespace, value in values.items():
+        gamestate_id, version, body = _unpack(value)
+        if version != TOMBSTONE_VERSION:
+            ret.append((namespace.decode("utf-8"), gamestate_id, version, body))
+    ret.sort()
+    return ret
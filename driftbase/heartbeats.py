@@ -0,0 +1,190 @@
+"""
+    Write-behind store for battleserver and machine heartbeats.
+
+    Heartbeats are recorded in Redis and written to the DB in bulk. For each
+    kind of object ('servers' or 'machines') we keep two keys:
+
+    heartbeats:<kind>           Sorted set of object id's scored on the timestamp
+                                of the last heartbeat.
+    heartbeats:<kind>:pending   Hash of object id -> number of heartbeats which
+                                have not yet been written to the DB.
+
+    The flush is piggybacked on heartbeat requests and runs at most once every
+    'heartbeat_flush_interval' seconds across all workers.
+"""
+import datetime
+import logging
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+from driftbase.models.db import Server, Machine
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HEARTBEAT_FLUSH_INTERVAL = 10
+# Heartbeats older than this are dropped from the sorted set once flushed
+HEARTBEAT_RETENTION_SECONDS = 60 * 60
+
+SERVERS = "servers"
+MACHINES = "machines"
+
+_models = {
+    SERVERS: (Server, Server.server_id),
+    MACHINES: (Machine, Machine.machine_id),
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# for mocking
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def _to_timestamp(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def _from_timestamp(ts):
+    return EPOCH + datetime.timedelta(seconds=float(ts))
+
+
+def _keys(redis, kind):
+    return (redis.make_key("heartbeats:%s" % kind),
+            redis.make_key("heartbeats:%s:pending" % kind))
+
+
+def record_heartbeat(redis, kind, object_id):
+    """
+    Record a heartbeat for 'object_id' in the fast store.
+    Returns the timestamp of the previous heartbeat or None if the object
+    has not heartbeated since it was last evicted from the store.
+    """
+    dates_key, pending_key = _keys(redis, kind)
+    pipe = redis.conn.pipeline()
+    pipe.zscore(dates_key, object_id)
+    pipe.zadd(dates_key, {object_id: _to_timestamp(utcnow())})
+    pipe.hincrby(pending_key, object_id, 1)
+    last_heartbeat, _, _ = pipe.execute()
+    if last_heartbeat is None:
+        return None
+    return _from_timestamp(last_heartbeat)
+
+
+def discard_heartbeat(redis, kind, object_id):
+    """Remove any trace of 'object_id' from the fast store."""
+    dates_key, pending_key = _keys(redis, kind)
+    pipe = redis.conn.pipeline()
+    pipe.zrem(dates_key, object_id)
+    pipe.hdel(pending_key, object_id)
+    pipe.execute()
+
+
+def get_heartbeats(redis, kind, object_ids):
+    """
+    Returns a dict of object id -> (heartbeat_date, num_pending) for each of
+    'object_ids' that is found in the fast store.
+    """
+    if not object_ids:
+        return {}
+    dates_key, pending_key = _keys(redis, kind)
+    pipe = redis.conn.pipeline(transaction=False)
+    for object_id in object_ids:
+        pipe.zscore(dates_key, object_id)
+    pipe.hmget(pending_key, object_ids)
+    results = pipe.execute()
+    pending = results.pop()
+    ret = {}
+    for object_id, score, num_pending in zip(object_ids, results, pending):
+        if score is not None:
+            ret[object_id] = (_from_timestamp(score), int(num_pending or 0))
+    return ret
+
+
+def apply_heartbeats(redis, kind, records, key):
+    """
+    Overlay heartbeat info from the fast store onto 'records', a list of dicts
+    as returned from 'as_dict()'. 'key' is the name of the primary key field.
+    """
+    heartbeats = get_heartbeats(redis, kind, [r[key] for r in records])
+    for record in records:
+        if record[key] not in heartbeats:
+            continue
+        heartbeat_date, num_pending = heartbeats[record[key]]
+        record["heartbeat_date"] = heartbeat_date
+        if "heartbeat_count" in record:
+            record["heartbeat_count"] = (record["heartbeat_count"] or 0) + num_pending
+    return records
+
+
+def flush_heartbeats(redis, db_session, kinds=(SERVERS, MACHINES)):
+    """Write all pending heartbeats of 'kinds' into the DB in bulk."""
+    num_rows = 0
+    for kind in kinds:
+        num_rows += _flush(redis, db_session, kind)
+    return num_rows
+
+
+def _flush(redis, db_session, kind):
+    dates_key, pending_key = _keys(redis, kind)
+    pipe = redis.conn.pipeline()
+    pipe.hgetall(pending_key)
+    pipe.delete(pending_key)
+    pending, _ = pipe.execute()
+    if not pending:
+        return 0
+
+    object_ids = list(pending.keys())
+    pipe = redis.conn.pipeline(transaction=False)
+    for object_id in object_ids:
+        pipe.zscore(dates_key, object_id)
+    scores = pipe.execute()
+
+    rows = []
+    for object_id, score in zip(object_ids, scores):
+        if score is None:
+            continue
+        rows.append({
+            "_id": int(object_id),
+            "_date": _from_timestamp(score),
+            "_count": int(pending[object_id]),
+        })
+
+    model, pk = _models[kind]
+    values = {"heartbeat_date": bindparam("_date")}
+    if kind == SERVERS:
+        values["heartbeat_count"] = Server.heartbeat_count + bindparam("_count")
+    stmt = model.__table__.update().where(pk == bindparam("_id")).values(values)
+    try:
+        if rows:
+            db_session.execute(stmt, rows)
+            db_session.commit()
+    except Exception:
+        db_session.rollback()
+        # put the pending counts back so they are picked up by the next flush
+        pipe = redis.conn.pipeline()
+        for object_id, num in pending.items():
+            pipe.hincrby(pending_key, object_id, int(num))
+        pipe.execute()
+        raise
+
+    cutoff = utcnow() - datetime.timedelta(seconds=HEARTBEAT_RETENTION_SECONDS)
+    redis.conn.zremrangebyscore(dates_key, "-inf", _to_timestamp(cutoff))
+    log.debug("Flushed %s %s heartbeats into the DB", len(rows), kind)
+    return len(rows)
+
+
+def maybe_flush_heartbeats(redis, db_session):
+    """
+    Flush pending heartbeats into the DB unless another worker has done so
+    within the last 'heartbeat_flush_interval' seconds.
+    """
+    interval = current_app.config.get("heartbeat_flush_interval",
+                                      DEFAULT_HEARTBEAT_FLUSH_INTERVAL)
+    if not redis.conn.set(redis.make_key("heartbeats:flush"), 1, nx=True, ex=interval):
+        return
+    try:
+        flush_heartbeats(redis, db_session)
+    except Exception:
+        log.exception("Unable to flush heartbeats into the DB")
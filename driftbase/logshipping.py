@@ -0,0 +1,295 @@
+"""
+    Asynchronous shipping of client logs and events.
+
+    The /events and /clientlogs endpoints queue incoming events in a bounded
+    in-process buffer and return immediately. A background greenlet drains the
+    buffer in batches and hands each batch to a sink:
+
+    logging     Emit each event on the 'eventlog' or 'clientlog' logger (default).
+    file        Append NDJSON to '<path>/<tenant>.<kind>.ndjson', rotated at 'max_bytes'.
+    redis       XADD each event to the tenant's '<kind>' stream, trimmed to 'maxlen'.
+    http        POST each batch as NDJSON to 'url'.
+
+    Sinks are written to outside of the request, so the tenant and user of the
+    request are captured when events are queued and passed to the sink with
+    each event. The 'logging' sink adds them to the log record.
+
+    The sink and buffer sizes are configured in the 'log_shipping' app config.
+    The buffer is flushed early once it holds a full batch. When the buffer is
+    full new events are dropped rather than blocking the request, and events are
+    also dropped if the sink fails. Drops are counted and logged so lost data is
+    visible.
+
+    The buffers are flushed when the process exits. Events which can't be shipped
+    then are counted as dropped.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import time
+
+import gevent
+import gevent.event
+import requests
+from drift.core.extensions.logging import get_user_context
+from drift.utils import get_tier_name
+from flask import current_app, g, has_request_context
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+log = logging.getLogger(__name__)
+
+EVENTLOG = "eventlog"
+CLIENTLOG = "clientlog"
+
+DEFAULT_CONFIG = {
+    "sink": "logging",
+    "buffer_size": 10000,
+    "batch_size": 500,
+    "flush_interval": 1.0,
+    "path": "/var/log/driftbase",
+    "max_bytes": 100 * 1024 * 1024,
+    "backup_count": 5,
+    "maxlen": 100000,
+    "url": None,
+    "timeout": 5.0,
+}
+
+# Log the drop counters at most this often
+DROP_REPORT_INTERVAL = 60.0
+
+_shippers = {}
+
+
+def _dumps(event):
+    return json.dumps(event, default=str, separators=(",", ":"))
+
+
+class LoggingSink(object):
+    def __init__(self, kind):
+        self.logger = logging.getLogger(kind)
+        self.kind = kind
+
+    def write(self, entries):
+        for event, context in entries:
+            self.logger.info(self.kind, extra={"extra": dict(event, **(context or {}))})
+
+
+class FileSink(object):
+    def __init__(self, filename, max_bytes, backup_count):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%s" % (self.filename, i)
+            if os.path.exists(src):
+                os.replace(src, "%s.%s" % (self.filename, i + 1))
+        if self.backup_count:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+
+    def write(self, entries):
+        data = "".join(_dumps(event) + "\n" for event, _ in entries)
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.filename, "a") as f:
+            f.write(data)
+
+
+class RedisStreamSink(object):
+    def __init__(self, conn, stream_key, maxlen):
+        self.conn = conn
+        self.stream_key = stream_key
+        self.maxlen = maxlen
+
+    def write(self, entries):
+        pipe = self.conn.pipeline(transaction=False)
+        for event, _ in entries:
+            pipe.xadd(self.stream_key, {"event": _dumps(event)}, maxlen=self.maxlen, approximate=True)
+        pipe.execute()
+
+
+class HttpSink(object):
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def write(self, entries):
+        data = "".join(_dumps(event) + "\n" for event, _ in entries)
+        r = self.session.post(self.url, data=data, timeout=self.timeout,
+                              headers={"Content-Type": "application/x-ndjson"})
+        r.raise_for_status()
+
+
+class LogShipper(object):
+    """
+    Bounded buffer of events drained into 'sink' by a background greenlet.
+    The sink is given a list of (event, context) tuples, where context is the
+    log context of the request which queued the event, or None.
+    """
+    def __init__(self, name, sink, buffer_size, batch_size, flush_interval):
+        self.name = name
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque()
+        self.wakeup = gevent.event.Event()
+        self.greenlet = None
+        self.pid = None
+        self.shipped = 0
+        self.dropped_full = 0
+        self.dropped_failed = 0
+        self._reported_drops = 0
+        self._last_report = 0.0
+
+    def put(self, events):
+        """Queue 'events' for shipping. Returns the number of events that were dropped."""
+        room = self.buffer_size - len(self.buffer)
+        accepted = events[:max(room, 0)]
+        context = get_log_context() if has_request_context() else None
+        self.buffer.extend((event, context) for event in accepted)
+        dropped = len(events) - len(accepted)
+        self.dropped_full += dropped
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+        self._ensure_running()
+        return dropped
+
+    def flush(self):
+        """Ship everything in the buffer from the calling greenlet."""
+        while self.buffer:
+            self._ship_batch()
+
+    def stats(self):
+        return {
+            "buffered": len(self.buffer),
+            "shipped": self.shipped,
+            "dropped_full": self.dropped_full,
+            "dropped_failed": self.dropped_failed,
+        }
+
+    def _ensure_running(self):
+        # greenlets don't survive a fork so each worker process starts its own
+        if self.greenlet is None or self.greenlet.dead or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                self._report_drops()
+            except Exception:
+                log.exception("Log shipper '%s' failed", self.name)
+
+    def _ship_batch(self):
+        batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+        try:
+            self.sink.write(batch)
+            self.shipped += len(batch)
+        except Exception:
+            self.dropped_failed += len(batch)
+            log.exception("Log shipper '%s' dropped %s events its sink failed to write",
+                          self.name, len(batch))
+
+    def _report_drops(self):
+        dropped = self.dropped_full + self.dropped_failed
+        now = time.monotonic()
+        if dropped != self._reported_drops and now - self._last_report >= DROP_REPORT_INTERVAL:
+            log.warning("Log shipper '%s' has dropped %s events: %s",
+                        self.name, dropped, self.stats())
+            self._reported_drops = dropped
+            self._last_report = now
+
+
+def get_log_context():
+    """Returns the tenant and user of the current request, for log records."""
+    tenant_name = g.conf.tenant_name["tenant_name"] if g.conf.tenant_name else None
+    context = {"tenant": "%s.%s" % (get_tier_name(fail_hard=False), tenant_name)}
+    user = get_user_context()
+    if user:
+        context["user"] = user
+    return context
+
+
+def _make_sink(kind, tenant_name, config):
+    sink = config["sink"]
+    if sink == "logging":
+        return LoggingSink(kind)
+    elif sink == "file":
+        filename = os.path.join(config["path"], "%s.%s.ndjson" % (tenant_name, kind))
+        return FileSink(filename, config["max_bytes"], config["backup_count"])
+    elif sink == "redis":
+        return RedisStreamSink(g.redis.conn, g.redis.make_key(kind), config["maxlen"])
+    elif sink == "http":
+        return HttpSink(config["url"], config["timeout"])
+    raise RuntimeError("Unknown log shipping sink '%s'" % sink)
+
+
+def get_shipper(kind):
+    """Returns the shipper for 'kind' events of the current tenant. Must be called in a request."""
+    tenant_name = g.conf.tenant_name["tenant_name"] if g.conf.tenant_name else None
+    shipper = _shippers.get((kind, tenant_name))
+    if shipper is None:
+        config = dict(DEFAULT_CONFIG, **current_app.config.get("log_shipping", {}))
+        sink = _make_sink(kind, tenant_name, config)
+        shipper = LogShipper("%s.%s" % (tenant_name, kind), sink, config["buffer_size"],
+                             config["batch_size"], config["flush_interval"])
+        _shippers[(kind, tenant_name)] = shipper
+    return shipper
+
+
+def ship_events(kind, events):
+    """Queue 'events' for shipping. Returns the number of events that were dropped."""
+    return get_shipper(kind).put(events)
+
+
+def flush_all():
+    """
+    Ship what is left in the buffers of this process's shippers. Anything that
+    can't be shipped is counted as dropped.
+    """
+    for shipper in list(_shippers.values()):
+        # a buffer inherited from the parent process is the parent's to ship
+        if shipper.pid != os.getpid():
+            continue
+        try:
+            shipper.flush()
+        except Exception:
+            log.exception("Log shipper '%s' failed to flush", shipper.name)
+        if shipper.buffer:
+            shipper.dropped_failed += len(shipper.buffer)
+            shipper.buffer.clear()
+        if shipper.dropped_full + shipper.dropped_failed:
+            log.warning("Log shipper '%s' has dropped %s events: %s", shipper.name,
+                        shipper.dropped_full + shipper.dropped_failed, shipper.stats())
+
+
+def _register_exit_hook():
+    # uWSGI workers don't run the atexit handlers
+    if uwsgi is not None:
+        previous = getattr(uwsgi, "atexit", None)
+
+        def uwsgi_atexit():
+            flush_all()
+            if previous:
+                previous()
+        uwsgi.atexit = uwsgi_atexit
+    else:
+        atexit.register(flush_all)
+
+
+_register_exit_hook()
@@ -1,9 +1,11 @@
 import datetime
 import collections
 
-from flask import g
+import redis as redis_lib
+from flask import g, current_app
 
 from driftbase.models.db import Match, MatchQueuePlayer, Client, Server, Machine
+from driftbase.heartbeats import get_heartbeats, SERVERS, DEFAULT_HEARTBEAT_FLUSH_INTERVAL
 
 import logging
 log = logging.getLogger(__name__)
@@ -30,6 +32,44 @@ def check_ref_and_placement(player, match, server, machine):
     return True
 
 
+def server_may_be_alive(since):
+    """
+    Returns a filter criterion for servers that may have heartbeated after 'since'.
+    Heartbeats are written to the DB up to 'heartbeat_flush_interval' seconds late
+    so this lets through some dead servers. Narrow the rows down with
+    'filter_alive_servers'.
+    """
+    interval = current_app.config.get("heartbeat_flush_interval",
+                                      DEFAULT_HEARTBEAT_FLUSH_INTERVAL)
+    return Server.heartbeat_date >= since - datetime.timedelta(seconds=interval)
+
+
+def filter_alive_servers(redis, rows, since, server_index, server_heartbeats=None):
+    """
+    Returns the rows in 'rows' whose server, at 'server_index' in the row, has
+    heartbeated after 'since'. The last heartbeat is read from the fast store,
+    falling back on the DB heartbeat date for servers that aren't in it.
+    'server_heartbeats' can be passed in if the caller has already read them
+    with 'get_heartbeats'.
+    """
+    if server_heartbeats is None:
+        server_ids = [row[server_index].server_id for row in rows]
+        try:
+            server_heartbeats = get_heartbeats(redis, SERVERS, server_ids)
+        except redis_lib.RedisError:
+            log.exception("Unable to read server heartbeats, using the DB heartbeat dates")
+            server_heartbeats = {}
+    ret = []
+    for row in rows:
+        server = row[server_index]
+        heartbeat_date = server.heartbeat_date
+        if server.server_id in server_heartbeats:
+            heartbeat_date = server_heartbeats[server.server_id][0]
+        if heartbeat_date and heartbeat_date >= since:
+            ret.append(row)
+    return ret
+
+
 def process_match_queue(redis=None, db_session=None):
     log.info("process_match_queue...")
     if redis is None:
@@ -37,6 +77,7 @@ def process_match_queue(redis=None, db_session=None):
     if db_session is None:
         db_session = g.db
     with lock(redis):
+        since = utcnow() - datetime.timedelta(seconds=60)
         # find all valid players waiting in the queue
         queued_players = db_session.query(MatchQueuePlayer, Client) \
                                    .filter(Client.client_id == MatchQueuePlayer.client_id,
@@ -50,8 +91,8 @@ def process_match_queue(redis=None, db_session=None):
                              Match.num_players == 0,
                              Match.status == "idle",
                              Server.server_id == Match.server_id,
-                             Server.heartbeat_date >= utcnow() - datetime.timedelta(seconds=60))
-        idle_matches = query.all()
+                             server_may_be_alive(since))
+        idle_matches = filter_alive_servers(redis, query.all(), since, server_index=1)
 
         eligible_players = []
         challenge_players = collections.defaultdict(list)
@@ -10,15 +10,16 @@ from sqlalchemy import (
     BigInteger,
     Float,
     Boolean,
+    LargeBinary,
 )
 from sqlalchemy import CheckConstraint
-from sqlalchemy.dialects.postgresql import ENUM, INET, JSON
+from sqlalchemy.dialects.postgresql import ENUM, INET, JSON, UUID
 from sqlalchemy.schema import Sequence, Index
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import DDL, event
 
-from werkzeug.security import generate_password_hash, check_password_hash
+from driftbase.auth import passwords
 
 from flask import current_app
 
@@ -28,6 +29,14 @@ DEFAULT_HEARTBEAT_PERIOD = 30
 DEFAULT_HEARTBEAT_TIMEOUT = 300
 
 
+def event_partition_key():
+    """
+    The event tables are partitioned by month on create_date, see driftbase.partitions.
+    The partition key must be a part of the primary key.
+    """
+    return Column(DateTime, primary_key=True, nullable=False, server_default=utc_now)
+
+
 def utcnow():
     return datetime.datetime.utcnow()
 
@@ -96,7 +105,7 @@ class UserIdentity(ModelBase):
     __tablename__ = "ck_user_identities"
 
     identity_id = Column(Integer, primary_key=True)
-    name = Column(String(200), index=True)
+    name = Column(String(200), index=True, unique=True)
     identity_type = Column(String(50), index=True)
     password_hash = Column(String(200))
     user_id = Column(Integer, ForeignKey("ck_users.user_id"), index=True)
@@ -107,12 +116,17 @@ class UserIdentity(ModelBase):
     last_ip_address = Column(INET, nullable=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(
-            password, method="pbkdf2:sha1:25000"
+        self.password_hash = passwords.hash_password(
+            password, passwords.get_scheme(self.identity_type),
+            passwords.get_hmac_keys(), passwords.get_hmac_key_id()
         )
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.check_password(self.password_hash, password, passwords.get_hmac_keys())
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash, passwords.get_scheme(self.identity_type),
+                                      passwords.get_hmac_key_id())
 
 
 class CorePlayer(ModelBase):
@@ -202,15 +216,18 @@ class UserEvent(ModelBase):
     __tablename__ = "ck_user_events"
     __table_args__ = (
         Index("ix_ckuserevent_user_id_event_date", "user_id", "event_date"),
+        Index("ix_ck_user_events_create_date", "create_date", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (create_date)"},
     )
 
     event_id = Column(BigInteger, Sequence("ck_event_id_seq"), primary_key=True)
     event_date = Column(DateTime, nullable=False, server_default=utc_now)
     event_type_id = Column(Integer, nullable=False)
     user_id = Column(
-        Integer, ForeignKey("ck_users.user_id"), nullable=False, index=True
+        Integer, ForeignKey("ck_users.user_id"), nullable=False
     )
     data = Column(String(500))
+    create_date = event_partition_key()
 
 
 class Counter(ModelBase):
@@ -324,8 +341,12 @@ class Server(ModelBase):
 
 class ServerDaemonCommand(ModelBase):
     __tablename__ = "gs_serverdaemoncommands"
+    __table_args__ = (
+        Index("ix_gs_serverdaemoncommands_server_id_status", "server_id", "status"),
+    )
+
     command_id = Column(Integer, primary_key=True)
-    server_id = Column(Integer, index=True)
+    server_id = Column(Integer)
     command = Column(String(50), nullable=False)
     arguments = Column(JSON, nullable=True)
     status = Column(String(50), nullable=True)
@@ -378,13 +399,18 @@ class MatchTeam(ModelBase):
 
 class MatchEvent(ModelBase):
     __tablename__ = "gs_matchevents"
+    __table_args__ = (
+        Index("ix_gs_matchevents_create_date", "create_date", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (create_date)"},
+    )
 
-    event_id = Column(BigInteger, primary_key=True)
+    event_id = Column(BigInteger, primary_key=True, autoincrement=True)
     event_type_id = Column(Integer, nullable=True)
     event_type_name = Column(String(50), nullable=False)
     match_id = Column(Integer, nullable=False, index=True)
     player_id = Column(Integer, nullable=True, index=True)
     details = Column(JSON, nullable=True)
+    create_date = event_partition_key()
 
 
 class RunConfig(ModelBase):
@@ -411,12 +437,17 @@ class MachineGroup(ModelBase):
 
 class MachineEvent(ModelBase):
     __tablename__ = "gs_machine_events"
+    __table_args__ = (
+        Index("ix_gs_machine_events_create_date", "create_date", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (create_date)"},
+    )
 
-    event_id = Column(Integer, primary_key=True)
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
     event_type_name = Column(String(50), nullable=False)
     machine_id = Column(Integer, nullable=False, index=True)
     details = Column(JSON, nullable=True)
     status = Column(JSON, nullable=True)
+    create_date = event_partition_key()
 
 
 class MatchQueuePlayer(ModelBase):
@@ -438,10 +469,13 @@ class MatchQueuePlayer(ModelBase):
 
 class GameState(ModelBase):
     __tablename__ = "ck_gamestates"
+    __table_args__ = (
+        Index("ix_ck_gamestates_player_id_namespace", "player_id", "namespace", unique=True),
+    )
 
     gamestate_id = Column(BigInteger, primary_key=True)
     player_id = Column(
-        Integer, ForeignKey("ck_players.player_id"), nullable=False, index=True
+        Integer, ForeignKey("ck_players.player_id"), nullable=False
     )
     namespace = Column(String(255), nullable=False, index=True)
     version = Column(Integer, nullable=False, default=1)
@@ -462,8 +496,13 @@ class GameStateHistory(ModelBase):
     namespace = Column(String(255), nullable=False, index=True)
     version = Column(Integer, nullable=False)
     journal_id = Column(Integer, nullable=True)
-    data = Column(JSON, nullable=False)
+    # full gamestate, only set on rows written before 'packed_data' was introduced
+    data = Column(JSON, nullable=True)
     is_valid = Column(Boolean, nullable=True)
+    # zlib compressed JSON, either the full gamestate or a JSON patch against the base row
+    packed_data = Column(LargeBinary, nullable=True)
+    is_delta = Column(Boolean, nullable=True, server_default="false")
+    base_gamestatehistory_id = Column(BigInteger, nullable=True)
 
 
 class PlayerJournal(ModelBase):
@@ -482,6 +521,11 @@ class PlayerJournal(ModelBase):
     steps = Column(JSON, nullable=True)
     deleted = Column(Boolean, nullable=True, default=False)
 
+    __table_args__ = (
+        Index("ix_ck_playerjournal_player_id_deleted_journal_id",
+              player_id, deleted, journal_id.desc(), sequence_id.desc()),
+    )
+
 
 class Ticket(ModelBase):
     __tablename__ = "ck_tickets"
@@ -503,19 +547,25 @@ class PlayerEvent(ModelBase):
     __tablename__ = "ck_player_events"
     __table_args__ = (
         Index("ix_ckplayerevent_player_id_create_date", "player_id", "create_date"),
+        Index("ix_ck_player_events_create_date", "create_date", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (create_date)"},
     )
 
     event_id = Column(BigInteger, Sequence("ck_event_id_seq"), primary_key=True)
     event_type_id = Column(Integer, nullable=True)
     event_type_name = Column(String(50), nullable=False)
     player_id = Column(
-        Integer, ForeignKey("ck_players.player_id"), nullable=False, index=True
+        Integer, ForeignKey("ck_players.player_id"), nullable=False
     )
     details = Column(JSON, nullable=True)
+    create_date = event_partition_key()
 
 
 class PlayerSummary(ModelBase):
     __tablename__ = "ck_player_summary"
+    __table_args__ = (
+        Index("ix_ck_player_summary_player_id_name", "player_id", "name", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     player_id = Column(
@@ -560,11 +610,19 @@ class FriendInvite(ModelBase):
     issued_by_player_id = Column(
         Integer, ForeignKey("ck_players.player_id"), nullable=False, index=True
     )
-    token = Column(String(50), nullable=False, index=True)
-    expiry_date = Column(DateTime, nullable=False)
+    token = Column(UUID(as_uuid=True), nullable=False, index=True, unique=True)
+    expiry_date = Column(DateTime, nullable=False, index=True)
     deleted = Column(Boolean, nullable=True, default=False)
 
 
+for _event_table in (UserEvent.__table__, MatchEvent.__table__,
+                     MachineEvent.__table__, PlayerEvent.__table__):
+    event.listen(
+        _event_table,
+        "after_create",
+        DDL("CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT;"),
+    )
+
 event.listen(
     CorePlayer.__table__,
     "after_create",
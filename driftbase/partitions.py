@@ -0,0 +1,173 @@
+"""
+    Monthly partitions of the event tables.
+
+    The event tables are range partitioned on 'create_date' with one partition per
+    month, named '<table>_pYYYYMM', and a default partition catching anything
+    outside of them. Partitions are created 'event_partition_months_ahead' months
+    in advance so the default partition stays empty.
+
+    Old events are removed by detaching and dropping whole partitions, which is
+    far cheaper than deleting rows. Partitions which ended more than
+    'event_retention_months' months ago are dropped. Retention is disabled unless
+    that config value is set.
+
+    Partitions are maintained by the 'maintain-event-partitions' task, which should
+    be run at least daily, see driftbase.tasks. Partitioning requires Postgres 11
+    or later.
+
+    The partitioning migration leaves the existing events in '<table>_old'. They
+    are moved over in batches by the 'move-old-events' task.
+"""
+import datetime
+import logging
+import re
+
+from flask import current_app
+from sqlalchemy import text
+
+log = logging.getLogger(__name__)
+
+EVENT_TABLES = ["ck_player_events", "gs_matchevents", "gs_machine_events", "ck_user_events"]
+
+DEFAULT_PARTITION_MONTHS_AHEAD = 2
+DEFAULT_MOVE_BATCH_SIZE = 10000
+
+OLD_TABLE_SUFFIX = "_old"
+
+PARTITION_NAME_REGEX = re.compile(r"^(?P<table>.+)_p(?P<year>\d{4})(?P<month>\d{2})$")
+
+
+# for mocking
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def month_start(dt):
+    return datetime.datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, months):
+    """Returns the first day of the month 'months' months from the month of 'dt'."""
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table_name, month):
+    return "%s_p%04d%02d" % (table_name, month.year, month.month)
+
+
+def get_partitions(db_session, table_name):
+    """Returns a dict of partition name -> first day of month for the monthly partitions of a table."""
+    rows = db_session.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :table_name"
+    ), {"table_name": table_name})
+    ret = {}
+    for name, in rows:
+        m = PARTITION_NAME_REGEX.match(name)
+        if m and m.group("table") == table_name:
+            ret[name] = datetime.datetime(int(m.group("year")), int(m.group("month")), 1)
+    return ret
+
+
+def create_partitions(db_session, table_name, start, months_ahead):
+    """
+    Create the monthly partitions from the month of 'start' up to 'months_ahead'
+    months after it, skipping those that exist. Returns the names of the new partitions.
+    """
+    existing = get_partitions(db_session, table_name)
+    created = []
+    for i in range(months_ahead + 1):
+        month = add_months(start, i)
+        name = partition_name(table_name, month)
+        if name in existing:
+            continue
+        # a savepoint so a month which already has rows in the default partition
+        # doesn't abort the others
+        savepoint = db_session.begin_nested()
+        try:
+            db_session.execute(
+                "CREATE TABLE %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" %
+                (name, table_name, month.isoformat(), add_months(month, 1).isoformat())
+            )
+            savepoint.commit()
+            created.append(name)
+        except Exception:
+            savepoint.rollback()
+            log.exception("Unable to create partition %s", name)
+    return created
+
+
+def drop_partitions(db_session, table_name, before):
+    """
+    Detach and drop the monthly partitions which end on or before 'before'.
+    Returns the names of the dropped partitions.
+    """
+    dropped = []
+    for name, month in sorted(get_partitions(db_session, table_name).items()):
+        if add_months(month, 1) > before:
+            continue
+        db_session.execute("ALTER TABLE %s DETACH PARTITION %s" % (table_name, name))
+        db_session.execute("DROP TABLE %s" % name)
+        dropped.append(name)
+    return dropped
+
+
+def maintain_event_partitions(db_session):
+    """
+    Create upcoming partitions and drop expired ones for all event tables.
+    Returns a dict of table name -> (created partitions, dropped partitions).
+    """
+    months_ahead = current_app.config.get("event_partition_months_ahead",
+                                          DEFAULT_PARTITION_MONTHS_AHEAD)
+    retention_months = current_app.config.get("event_retention_months")
+    this_month = month_start(utcnow())
+    ret = {}
+    for table_name in EVENT_TABLES:
+        created = create_partitions(db_session, table_name, this_month, months_ahead)
+        dropped = []
+        if retention_months:
+            dropped = drop_partitions(db_session, table_name,
+                                      add_months(this_month, -retention_months))
+        db_session.commit()
+        if created or dropped:
+            log.info("Partitions of %s created: %s, dropped: %s", table_name, created, dropped)
+        ret[table_name] = (created, dropped)
+    return ret
+
+
+def move_old_events(db_session, table_name, batch_size=DEFAULT_MOVE_BATCH_SIZE):
+    """
+    Move the events the partitioning migration left in the old, unpartitioned
+    table into 'table_name', one transaction per batch, and drop the old table
+    once it's empty. Returns the number of events moved.
+    """
+    old_name = table_name + OLD_TABLE_SUFFIX
+    if not db_session.execute(text("SELECT to_regclass(:name)"), {"name": old_name}).scalar():
+        return 0
+    first_date = db_session.execute("SELECT min(create_date) FROM %s" % old_name).scalar()
+    if first_date:
+        this_month = month_start(utcnow())
+        months = (this_month.year - first_date.year) * 12 + this_month.month - first_date.month
+        create_partitions(db_session, table_name, first_date, max(months, 0))
+    db_session.commit()
+
+    num_rows = 0
+    while True:
+        moved = db_session.execute(text(
+            "WITH moved AS ("
+            "    DELETE FROM {old} WHERE event_id IN ("
+            "        SELECT event_id FROM {old} ORDER BY event_id LIMIT :batch_size"
+            "    ) RETURNING *"
+            ") INSERT INTO {table} SELECT * FROM moved".format(old=old_name, table=table_name)
+        ), {"batch_size": batch_size}).rowcount
+        db_session.commit()
+        num_rows += moved
+        if moved < batch_size:
+            break
+    db_session.execute("DROP TABLE %s" % old_name)
+    db_session.commit()
+    log.info("Moved %s events from %s to %s", num_rows, old_name, table_name)
+    return num_rows
@@ -6,12 +6,14 @@ import logging
 
 from flask import g, request
 from flask_smorest import abort
+from sqlalchemy import func
 
 from drift.core.extensions.jwt import current_user
 
 from driftbase.models.db import CorePlayer, PlayerEvent
-from driftbase.models.db import PlayerJournal
+from driftbase.models.db import PlayerJournal, GameState
 from driftbase.models.db import Ticket
+from driftbase.eventbuffer import queue_event
 
 PLAYER_GROUP_NAME_REGEX = '^[a-z_]{1,15}?$'
 RETENTION_IN_SEC = 60 * 60 * 24 * 2  # Store each group for 48 hours.
@@ -38,17 +40,19 @@ def can_edit_player(player_id):
 
 
 def log_event(player_id, event_type_name, details=None, db_session=None):
-
+    """
+    Log a player event. The event is written when the session is committed,
+    which is up to the caller.
+    """
     if not db_session:
         db_session = g.db
 
     log.info("Logging player event to DB: player_id=%s, event=%s", player_id, event_type_name)
-    event = PlayerEvent(event_type_id=None,
-                        event_type_name=event_type_name,
-                        player_id=player_id,
-                        details=details)
-    db_session.add(event)
-    db_session.commit()
+    queue_event(db_session, PlayerEvent,
+                event_type_id=None,
+                event_type_name=event_type_name,
+                player_id=player_id,
+                details=details)
 
 
 def get_playergroup(group_name, player_id=None):
@@ -57,13 +61,25 @@ def get_playergroup(group_name, player_id=None):
     Raises 404 if group is not found.
     """
     player_id = player_id or current_user['player_id']
-    key = _get_playergroup_key(group_name, player_id)
-    pg = g.redis.get(key)
-    if pg:
-        return json.loads(pg)
-    else:
-        abort(http_client.NOT_FOUND,
-              message="No player group named '%s' exists for player %s." % (group_name, player_id))
+    key, players_key, _ = _get_playergroup_keys(group_name, player_id)
+    pipe = g.redis.conn.pipeline(transaction=False)
+    pipe.hgetall(key)
+    pipe.hgetall(players_key)
+    attributes, players = pipe.execute()
+    if not attributes:
+        legacy = _get_legacy_playergroup(group_name, player_id)
+        if legacy:
+            return legacy
+        _abort_playergroup_not_found(group_name, player_id)
+    players = [dict(json.loads(info), player_id=int(member_id))
+               for member_id, info in players.items()]
+    players.sort(key=lambda player: player['player_id'])
+    return {
+        "group_name": attributes[b'group_name'].decode("utf-8"),
+        "player_id": int(attributes[b'player_id']),
+        "players": players,
+        "secret": attributes[b'secret'].decode("utf-8"),
+    }
 
 
 def get_playergroup_ids(group_name, player_id=None, caress_in_predicate=True):
@@ -73,31 +89,89 @@ def get_playergroup_ids(group_name, player_id=None, caress_in_predicate=True):
     Can be used freely within a Flask request context.
     Raises 404 if group is not found.
     """
-    pg = get_playergroup(group_name, player_id)
-    player_ids = [player['player_id'] for player in pg['players']]
+    player_id = player_id or current_user['player_id']
+    key, _, members_key = _get_playergroup_keys(group_name, player_id)
+    pipe = g.redis.conn.pipeline(transaction=False)
+    pipe.exists(key)
+    pipe.smembers(members_key)
+    exists, members = pipe.execute()
+    if exists:
+        player_ids = sorted(int(member_id) for member_id in members)
+    else:
+        legacy = _get_legacy_playergroup(group_name, player_id)
+        if not legacy:
+            _abort_playergroup_not_found(group_name, player_id)
+        player_ids = [player['player_id'] for player in legacy['players']]
     if not player_ids and caress_in_predicate:
         player_ids = [-1]
     return player_ids
 
 
 def set_playergroup(group_name, player_id, payload):
-    key = _get_playergroup_key(group_name, player_id)
-    g.redis.set(key, json.dumps(payload), expire=RETENTION_IN_SEC)
+    key, players_key, members_key = _get_playergroup_keys(group_name, player_id)
+    players = {
+        player['player_id']: json.dumps({'player_name': player['player_name'],
+                                         'identity_name': player['identity_name']})
+        for player in payload['players']
+    }
+    pipe = g.redis.conn.pipeline()
+    pipe.delete(key, players_key, members_key,
+                g.redis.make_key(_get_legacy_playergroup_key(group_name, player_id)))
+    pipe.hset(key, mapping={
+        'group_name': payload['group_name'],
+        'player_id': payload['player_id'],
+        'secret': payload['secret'],
+    })
+    if players:
+        pipe.hset(players_key, mapping=players)
+        pipe.sadd(members_key, *players.keys())
+    for k in (key, players_key, members_key):
+        pipe.expire(k, RETENTION_IN_SEC)
+    pipe.execute()
+
+
+def _get_legacy_playergroup(group_name, player_id):
+    """
+    Returns a group stored by an earlier version as a single json blob, or None.
+    The blobs expire after RETENTION_IN_SEC so this fallback can be removed once
+    that long has passed since the cutover to the current layout.
+    """
+    pg = g.redis.get(_get_legacy_playergroup_key(group_name, player_id))
+    if pg:
+        return json.loads(pg)
+    return None
+
+
+def _get_legacy_playergroup_key(group_name, player_id):
+    return "playergroup:{}.{}".format(player_id, group_name)
+
+
+def _abort_playergroup_not_found(group_name, player_id):
+    abort(http_client.NOT_FOUND,
+          message="No player group named '%s' exists for player %s." % (group_name, player_id))
+
 
+def _get_playergroup_keys(group_name, player_id):
+    """
+    Returns the redis keys for player group. Throw exception if group name is invalid.
 
-def _get_playergroup_key(group_name, player_id):
-    """Returns redis key for player group. Throw exception if group name is invalid."""
+    Each group is stored in three keys, a hash of the group attributes, a hash of
+    player id -> display info and a set of the player id's in the group.
+    """
     # Verify group name
     if not re.match(PLAYER_GROUP_NAME_REGEX, group_name):
         abort(http_client.BAD_REQUEST,
               message="'group_name' must match regex '{}'".format(PLAYER_GROUP_NAME_REGEX))
 
-    key = "playergroup:{}.{}".format(player_id, group_name)
-    return key
+    key = g.redis.make_key("playergroups:{}.{}".format(player_id, group_name))
+    return key, key + ":players", key + ":members"
 
 
 class JournalError(Exception):
-    pass
+    def __init__(self, message, accepted=None):
+        super().__init__(message)
+        # entries which were written before the error occurred
+        self.accepted = accepted or []
 
 
 def validate_journal_details(details):
@@ -116,58 +190,127 @@ def validate_journal_steps(steps):
         return None
 
 
-def get_latest_journal(player_id, db_session=None):
-    if not db_session:
-        db_session = g.db
-    journal_entry = db_session.query(PlayerJournal) \
-                              .filter(PlayerJournal.player_id == player_id) \
-                              .order_by(-PlayerJournal.journal_id) \
-                              .first()
-    return journal_entry
-
-
 def write_journal(player_id, action, journal_id=None, timestamp=None,
                   details=None, steps=None, actor_id=None, db_session=None):
     """Write a new journal entry into the DB. This should only ever be called from the client
     """
-    if not db_session:
-        db_session = g.db
-
-    if journal_id is not None and journal_id <= 0:
-        raise JournalError("Invalid journal_id %s" % journal_id)
+    entry = {
+        "action": action,
+        "journal_id": journal_id,
+        "timestamp": timestamp,
+        "details": details,
+        "steps": steps,
+    }
+    return write_journal_entries(player_id, [entry], actor_id, db_session)[0]
 
-    details = validate_journal_details(details)
-    steps = validate_journal_steps(steps)
 
-    if details and not isinstance(details, dict):
-        raise JournalError("Journal details must be a dict, not %s" % type(details))
-
-    if steps and not isinstance(steps, list):
-        raise JournalError("Journal steps must be a list, not %s" % type(steps))
-
-    # validate that the journal_id has not been used before
-    if journal_id:
-        prev_journal = get_latest_journal(player_id, db_session)
-        if prev_journal:
-            if prev_journal.journal_id >= journal_id:
-                raise JournalError("Attempting to write journal entry %s out of sequence. "
-                                   "Expected %s" % (journal_id, prev_journal.journal_id + 1))
+def _rollback_journal(player_id, to_journal_id, db_session):
+    """
+    Mark all journal entries after 'to_journal_id' as deleted, unless they have
+    already been persisted into a gamestate.
+    """
+    gamestate_journal_id = db_session.query(func.max(GameState.journal_id)) \
+                                     .filter(GameState.player_id == player_id) \
+                                     .scalar()
+    if gamestate_journal_id is None:
+        log.warning("Player is rebasing journal entries but doesn't"
+                    "have any gamestate.")
+    elif gamestate_journal_id > to_journal_id:
+        raise JournalError("Journal has already been persisted into home base!")
+
+    entry = db_session.query(PlayerJournal.deleted) \
+                      .filter(PlayerJournal.player_id == player_id,
+                              PlayerJournal.journal_id == to_journal_id) \
+                      .first()
+    if not entry:
+        log.warning("Rolling back to journal entry %s which doesn't exist", to_journal_id)
+    elif entry.deleted:
+        log.warning("Rolling back to journal entry %s which has been rolled back", to_journal_id)
+
+    db_session.query(PlayerJournal).filter(PlayerJournal.player_id == player_id,
+                                           PlayerJournal.journal_id > to_journal_id) \
+                                   .update({"deleted": True}, synchronize_session=False)
+
+
+def write_journal_entries(player_id, entries, actor_id=None, db_session=None):
+    """
+    Write a batch of journal entries into the DB in a single transaction.
+
+    'entries' is a list of dicts with 'action', 'journal_id', 'timestamp' and optionally
+    'details', 'steps' and 'rollback_to_journal_id', in ascending journal_id order.
+    The sequence is validated against the latest journal_id once and the entries are
+    written with a multi-row insert. If an entry is rejected the entries before it are
+    still written and JournalError is raised with them in 'accepted'.
+    Returns the written entries as dicts.
+    """
+    if not db_session:
+        db_session = g.db
 
     # if the player is the actor, we don't double-log it and leave actor_id as null
     if actor_id == player_id:
         actor_id = None
-    journal = PlayerJournal(player_id=player_id,
-                            journal_id=journal_id,
-                            action_type_name=action,
-                            details=details,
-                            actor_id=actor_id,
-                            timestamp=timestamp,
-                            steps=steps)
-    db_session.add(journal)
+
+    table = PlayerJournal.__table__
+    last_journal_id = db_session.query(func.max(PlayerJournal.journal_id)) \
+                                .filter(PlayerJournal.player_id == player_id) \
+                                .scalar()
+    written = []
+    rows = []
+
+    def insert_rows():
+        if rows:
+            result = db_session.execute(table.insert().values(rows).returning(*table.c))
+            written.extend(dict(row) for row in result)
+            del rows[:]
+
+    try:
+        for entry in entries:
+            journal_id = entry.get("journal_id")
+            if journal_id is not None and journal_id <= 0:
+                raise JournalError("Invalid journal_id %s" % journal_id)
+
+            details = validate_journal_details(entry.get("details"))
+            steps = validate_journal_steps(entry.get("steps"))
+
+            if details and not isinstance(details, dict):
+                raise JournalError("Journal details must be a dict, not %s" % type(details))
+
+            if steps and not isinstance(steps, list):
+                raise JournalError("Journal steps must be a list, not %s" % type(steps))
+
+            # validate that the journal_id has not been used before
+            if journal_id:
+                if last_journal_id is not None and last_journal_id >= journal_id:
+                    raise JournalError("Attempting to write journal entry %s out of sequence. "
+                                       "Expected %s" % (journal_id, last_journal_id + 1))
+                last_journal_id = journal_id
+
+            # A rollback marks all journal entries higher than the one to roll back to
+            # as deleted, including those written earlier in this batch.
+            if entry.get("rollback_to_journal_id") is not None:
+                insert_rows()
+                _rollback_journal(player_id, int(entry["rollback_to_journal_id"]), db_session)
+
+            rows.append({
+                "player_id": player_id,
+                "journal_id": journal_id,
+                "action_type_name": entry["action"],
+                "details": details,
+                "actor_id": actor_id,
+                "timestamp": entry.get("timestamp"),
+                "steps": steps,
+            })
+    except JournalError as e:
+        insert_rows()
+        db_session.commit()
+        e.accepted = written
+        raise
+
+    insert_rows()
     db_session.commit()
 
-    log.debug("Journal entry %s (%s) added to player %s", journal_id, action, player_id)
-    return journal.as_dict()
+    log.debug("%s journal entries added to player %s", len(written), player_id)
+    return written
 
 
 def create_ticket(player_id, issuer_id, ticket_type, details, external_id, db_session=None):
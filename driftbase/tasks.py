@@ -0,0 +1,104 @@
+"""
+    Maintenance tasks which are run on a schedule rather than as a part of
+    request handling. They are registered as flask commands under 'tasks':
+
+        flask tasks --tenant <tenant> prune-gamestate-history
+        flask tasks --tenant <tenant> backfill-gamestate-history-prune
+        flask tasks --tenant <tenant> reap-friend-invites
+        flask tasks --tenant <tenant> maintain-event-partitions
+        flask tasks --tenant <tenant> move-old-events
+
+    The tenant can also be specified with the 'DRIFT_DEFAULT_TENANT' environment
+    variable. Each task runs in a request context for the tenant so 'g.conf',
+    'g.db' and 'g.redis' are set up the same way as for API requests.
+"""
+import functools
+import logging
+
+import click
+from flask import current_app, g
+from flask.cli import with_appcontext
+
+from driftbase import friendships, gamestate, partitions
+
+log = logging.getLogger(__name__)
+
+
+@click.group()
+@click.option("--tenant", envvar="DRIFT_DEFAULT_TENANT", required=True,
+              help="The tenant to run the task for.")
+@click.pass_context
+def cli(ctx, tenant):
+    """Scheduled maintenance tasks."""
+    ctx.obj = tenant
+
+
+def tenant_task(f):
+    """Run the command 'f' in a request context for the tenant given to the 'tasks' group."""
+    @functools.wraps(f)
+    @with_appcontext
+    @click.pass_context
+    def wrapper(ctx, *args, **kwargs):
+        app = current_app._get_current_object()
+        with app.test_request_context(headers={"Drift-Tenant": ctx.obj}):
+            app.preprocess_request()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                app.do_teardown_request()
+    return wrapper
+
+
+@cli.command("prune-gamestate-history")
+@click.option("--batch-size", type=int, default=None,
+              help="Number of gamestates pruned per transaction. "
+                   "Defaults to 'gamestate_history_prune_batch_size'.")
+@click.option("--max-batches", type=int, default=None,
+              help="Stop after this many batches. Runs until the queue is empty by default.")
+@tenant_task
+def prune_gamestate_history(batch_size, max_batches):
+    """Prune the history of gamestates queued for pruning."""
+    num_gamestates, num_rows = gamestate.prune_all_scheduled_history(
+        g.redis, g.db, batch_size=batch_size, max_batches=max_batches)
+    click.echo("Pruned %s history rows of %s gamestates" % (num_rows, num_gamestates))
+
+
+@cli.command("backfill-gamestate-history-prune")
+@tenant_task
+def backfill_gamestate_history_prune():
+    """Queue the history of every gamestate for pruning."""
+    num_gamestates = gamestate.schedule_all_history_prune(g.redis, g.db)
+    click.echo("Queued %s gamestates for pruning" % num_gamestates)
+
+
+@cli.command("reap-friend-invites")
+@click.option("--batch-size", type=int, default=friendships.INVITE_REAP_BATCH_SIZE,
+              help="Number of invites deleted per transaction.")
+@tenant_task
+def reap_friend_invites(batch_size):
+    """Delete friend invites which expired more than 'friend_invite_retention_seconds' ago."""
+    num_rows = friendships.reap_friend_invites(g.db, batch_size)
+    click.echo("Reaped %s expired friend invites" % num_rows)
+
+
+@cli.command("maintain-event-partitions")
+@tenant_task
+def maintain_event_partitions():
+    """Create upcoming event partitions and drop expired ones."""
+    for table_name, (created, dropped) in partitions.maintain_event_partitions(g.db).items():
+        click.echo("%s: created %s, dropped %s" % (table_name, created, dropped))
+
+
+@cli.command("move-old-events")
+@click.option("--batch-size", type=int, default=partitions.DEFAULT_MOVE_BATCH_SIZE,
+              help="Number of events moved per transaction.")
+@tenant_task
+def move_old_events(batch_size):
+    """Move the events left in the old tables by the partitioning migration."""
+    for table_name in partitions.EVENT_TABLES:
+        num_rows = partitions.move_old_events(g.db, table_name, batch_size)
+        click.echo("Moved %s events into %s" % (num_rows, table_name))
+
+
+def drift_init_extension(app, **kwargs):
+    app.cli.add_command(cli, "tasks")
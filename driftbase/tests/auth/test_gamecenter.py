@@ -3,9 +3,11 @@ import collections
 import mock
 import datetime
 
+import OpenSSL
 import requests
 from werkzeug.exceptions import Unauthorized
 
+from driftbase.auth import gamecenter
 from driftbase.auth.gamecenter import run_gamecenter_token_validation
 
 
@@ -79,7 +81,7 @@ class GameCenterCase(unittest.TestCase):
 
     def setUp(self):
 
-        def requests_get_mock(url, *args, **kw):
+        def requests_get_mock(session, url, *args, **kw):
             if url == 'broken url':
                 raise requests.exceptions.RequestException('Url broken - unittest.')
             elif url == 'broken cert':
@@ -96,13 +98,15 @@ class GameCenterCase(unittest.TestCase):
                 self.assertTrue(False, "Unexpected url fetch: %s" % url)
 
         self.patchers = [
-            mock.patch('requests.get', requests_get_mock),
+            mock.patch('requests.Session.get', requests_get_mock),
             mock.patch('datetime.datetime', DateInside),
         ]
 
         for patcher in self.patchers:
             patcher.start()
 
+        gamecenter._certificates.clear()
+
     def tearDown(self):
         for patcher in self.patchers:
             patcher.stop()
@@ -177,6 +181,21 @@ class GameCenterCase(unittest.TestCase):
             self.assertIn("Can't verify signature:", context.exception.description)
             self.assertIn("'bad signature'", context.exception.description)
 
+    def test_certificate_cache(self):
+        cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, gc_prod_2_cer)
+        gamecenter.cache_certificate(template['public_key_url'], cert)
+        self.assertIs(gamecenter.get_cached_certificate(template['public_key_url']), cert)
+
+        # A cached certificate is used without fetching it again
+        with mock.patch('driftbase.auth.gamecenter.fetch_url') as fetch_url:
+            run_gamecenter_token_validation(template, app_bundles=app_bundles)
+            fetch_url.assert_not_called()
+
+        # and is evicted once it expires
+        with mock.patch('datetime.datetime', DateOutside):
+            self.assertIsNone(gamecenter.get_cached_certificate(template['public_key_url']))
+        self.assertNotIn(template['public_key_url'], gamecenter._certificates)
+
     # For requests library mock
     def requests_get(self, url, *args, **kw):
         if url == 'broken':
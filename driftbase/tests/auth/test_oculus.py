@@ -14,7 +14,7 @@ def setUpModule():
 
     original_post = requests.post
 
-    def requests_post_mock(url, *args, **kw):
+    def requests_post_mock(session, url, *args, **kw):
 
         class Response(object):
             def json(self):
@@ -39,7 +39,7 @@ def setUpModule():
         return response
 
     global patcher
-    patcher = mock.patch('requests.post', requests_post_mock)
+    patcher = mock.patch('requests.Session.post', requests_post_mock)
     patcher.start()
 
 
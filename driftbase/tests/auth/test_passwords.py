@@ -0,0 +1,78 @@
+import unittest
+
+from flask import Flask
+
+from driftbase.auth import passwords
+
+KEYS = {"1": "key"}
+
+
+class PasswordsCase(unittest.TestCase):
+
+    def test_schemes(self):
+        for scheme in [passwords.HMAC, passwords.SCRYPT, passwords.PBKDF2]:
+            pwhash = passwords.hash_password("secret", scheme, KEYS, "1")
+            self.assertTrue(passwords.check_password(pwhash, "secret", KEYS), scheme)
+            self.assertFalse(passwords.check_password(pwhash, "Secret", KEYS), scheme)
+            self.assertFalse(passwords.needs_rehash(pwhash, scheme, "1"), scheme)
+
+        # each hash is salted
+        self.assertNotEqual(passwords.hash_password("secret", passwords.HMAC, KEYS, "1"),
+                            passwords.hash_password("secret", passwords.HMAC, KEYS, "1"))
+
+    def test_hmac_key(self):
+        pwhash = passwords.hash_password("secret", passwords.HMAC, KEYS, "1")
+        self.assertTrue(pwhash.startswith("hmac:sha256:1$"))
+        self.assertFalse(passwords.check_password(pwhash, "secret", {"1": "other key"}))
+        self.assertFalse(passwords.check_password(pwhash, "secret"))
+        with self.assertRaises(ValueError):
+            passwords.hash_password("secret", passwords.HMAC)
+        with self.assertRaises(ValueError):
+            passwords.hash_password("secret", passwords.HMAC, KEYS, "2")
+
+    def test_hmac_key_rotation(self):
+        pwhash = passwords.hash_password("secret", passwords.HMAC, KEYS, "1")
+        # hashes made with the previous key still work, but are replaced on login
+        keys = dict(KEYS, **{"2": "new key"})
+        self.assertTrue(passwords.check_password(pwhash, "secret", keys))
+        self.assertTrue(passwords.needs_rehash(pwhash, passwords.HMAC, "2"))
+        pwhash = passwords.hash_password("secret", passwords.HMAC, keys, "2")
+        self.assertTrue(passwords.check_password(pwhash, "secret", {"2": "new key"}))
+        self.assertFalse(passwords.needs_rehash(pwhash, passwords.HMAC, "2"))
+
+    def test_check_config(self):
+        passwords.check_config({})
+        passwords.check_config({"password_hmac_keys": KEYS, "password_hmac_key_id": "1"})
+        for config in [
+            {"password_hmac_keys": KEYS},
+            {"password_hmac_key_id": "1"},
+            {"password_hmac_keys": KEYS, "password_hmac_key_id": "2"},
+            {"password_hmac_keys": {"1": "key", "2$": "key"}, "password_hmac_key_id": "1"},
+        ]:
+            with self.assertRaises(RuntimeError):
+                passwords.check_config(config)
+
+    def test_legacy_hash(self):
+        # hashes made before the scheme was configurable
+        pwhash = passwords.hash_password("secret", passwords.PBKDF2)
+        self.assertTrue(pwhash.startswith("pbkdf2:sha1:25000$"))
+        self.assertTrue(passwords.check_password(pwhash, "secret"))
+        self.assertTrue(passwords.needs_rehash(pwhash, passwords.HMAC, "1"))
+        self.assertTrue(passwords.needs_rehash(pwhash, passwords.SCRYPT))
+
+    def test_get_scheme(self):
+        app = Flask(__name__)
+        with app.app_context():
+            # hmac needs a key
+            self.assertEqual(passwords.get_scheme("device_id"), passwords.PBKDF2)
+            app.config["password_hmac_keys"] = KEYS
+            app.config["password_hmac_key_id"] = "1"
+            self.assertEqual(passwords.get_scheme("device_id"), passwords.HMAC)
+            # old style logins such as the service user stay on the cheaper hash
+            self.assertEqual(passwords.get_scheme(""), passwords.PBKDF2)
+            self.assertEqual(passwords.get_scheme(None), passwords.PBKDF2)
+            self.assertEqual(passwords.get_scheme("user+pass"), passwords.SCRYPT)
+            self.assertEqual(passwords.get_scheme("steam"), passwords.PBKDF2)
+            app.config["password_hash_schemes"] = {"steam": passwords.HMAC, "": passwords.SCRYPT}
+            self.assertEqual(passwords.get_scheme("steam"), passwords.HMAC)
+            self.assertEqual(passwords.get_scheme(""), passwords.SCRYPT)
@@ -11,7 +11,7 @@ patcher = None
 
 def setUpModule():
 
-    def requests_post_mock(url, *args, **kw):
+    def requests_post_mock(session, url, *args, **kw):
 
         class Response(object):
             def json(self):
@@ -48,7 +48,7 @@ def setUpModule():
 
         return response
 
-    def requests_get_mock(url, *args, **kw):
+    def requests_get_mock(session, url, *args, **kw):
 
         class Response(object):
             def json(self):
@@ -91,11 +91,11 @@ def setUpModule():
         return response
 
     global patcher_post
-    patcher_post = mock.patch('requests.post', requests_post_mock)
+    patcher_post = mock.patch('requests.Session.post', requests_post_mock)
     patcher_post.start()
 
     global patcher_get
-    patcher_get = mock.patch('requests.get', requests_get_mock)
+    patcher_get = mock.patch('requests.Session.get', requests_get_mock)
     patcher_get.start()
 
 
@@ -14,7 +14,7 @@ def setUpModule():
 
     original_get = requests.get
 
-    def requests_get_mock(url, *args, **kw):
+    def requests_get_mock(session, url, *args, **kw):
 
         class Response(object):
             def json(self):
@@ -55,7 +55,7 @@ def setUpModule():
         return response
 
     global patcher
-    patcher = mock.patch('requests.get', requests_get_mock)
+    patcher = mock.patch('requests.Session.get', requests_get_mock)
     patcher.start()
 
 
@@ -0,0 +1,57 @@
+import unittest
+
+import mock
+from flask import Flask, g
+from werkzeug.exceptions import Unauthorized
+
+from driftbase.auth.util import cached_ticket_validation
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, expire=-1):
+        self.values[key] = value
+
+
+class CachedTicketValidationCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        ctx = self.app.test_request_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        g.redis = FakeRedis()
+
+    def test_second_login_skips_provider(self):
+        validate = mock.Mock(return_value={"steam_id": "123"})
+        for _ in range(2):
+            self.assertEqual(cached_ticket_validation("steam", [1, "ticket"], validate), {"steam_id": "123"})
+        self.assertEqual(validate.call_count, 1)
+
+        # other tickets and providers are validated separately
+        cached_ticket_validation("steam", [1, "other ticket"], validate)
+        cached_ticket_validation("googleplay", [1, "ticket"], validate)
+        self.assertEqual(validate.call_count, 3)
+
+    def test_failed_validation_is_not_cached(self):
+        validate = mock.Mock(side_effect=Unauthorized())
+        for _ in range(2):
+            with self.assertRaises(Unauthorized):
+                cached_ticket_validation("steam", [1, "ticket"], validate)
+        self.assertEqual(validate.call_count, 2)
+
+        validate.side_effect = None
+        validate.return_value = {"steam_id": "123"}
+        self.assertEqual(cached_ticket_validation("steam", [1, "ticket"], validate), {"steam_id": "123"})
+
+    def test_cache_disabled(self):
+        self.app.config["auth_ticket_cache_ttl"] = 0
+        validate = mock.Mock(return_value={"steam_id": "123"})
+        for _ in range(2):
+            cached_ticket_validation("steam", [1, "ticket"], validate)
+        self.assertEqual(validate.call_count, 2)
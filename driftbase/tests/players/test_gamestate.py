@@ -2,8 +2,14 @@ import unittest
 import datetime
 import json
 
+import mock
+import redis
+from flask import Flask
 from six.moves import http_client
 
+from driftbase.gamestate import prune_history
+from driftbase.gamestatecache import get_cached_gamestate, get_cached_gamestates
+
 from drift.systesthelper import setup_tenant, remove_tenant, uuid_string, DriftBaseTestCase
 
 
@@ -205,6 +211,105 @@ class GameStateTests(DriftBaseTestCase):
         self.assertEqual(r.json()["data"], new_gamestate_data)
         self.assertEqual(r.json()["version"], old_version + 1)
 
+    def _with_headers(self, headers, method, *args, **kw):
+        old_headers = self.headers
+        self.headers = dict(old_headers, **headers)
+        try:
+            return method(*args, **kw)
+        finally:
+            self.headers = old_headers
+
+    def test_gamestate_etag(self):
+        self.auth(username=uuid_string())
+        player_url = self.endpoints["my_player"]
+        resp = self.get(player_url)
+        gamestate_url = resp.json()["gamestates_url"] + "/test"
+        r = self.put(gamestate_url, data={"gamestate": {"hello": "world"}})
+        etag = r.headers["ETag"]
+
+        r = self.get(gamestate_url)
+        self.assertEqual(r.headers["ETag"], etag)
+        r = self._with_headers({"If-None-Match": etag}, self.get, gamestate_url,
+                               expected_status_code=http_client.NOT_MODIFIED)
+        self.assertEqual(r.headers["ETag"], etag)
+
+        # a stale ETag is rejected on upload and a fresh one is issued on success
+        r = self._with_headers({"If-Match": etag}, self.put, gamestate_url,
+                               data={"gamestate": {"hello": "again"}})
+        new_etag = r.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+        self._with_headers({"If-Match": etag}, self.put, gamestate_url,
+                           data={"gamestate": {"hello": "stale"}},
+                           expected_status_code=http_client.PRECONDITION_FAILED)
+        r = self._with_headers({"If-None-Match": etag}, self.get, gamestate_url)
+        self.assertEqual(r.json()["data"], {"hello": "again"})
+
+    def test_gamestate_cache(self):
+        self.auth(username=uuid_string())
+        player_url = self.endpoints["my_player"]
+        resp = self.get(player_url)
+        gamestates_url = resp.json()["gamestates_url"]
+        gamestate_url = gamestates_url + "/test"
+        self.put(gamestate_url, data={"gamestate": {"hello": "world"}})
+        self.put(gamestates_url + "/other", data={"gamestate": {"other": True}})
+
+        # read twice so the second read is served from the cache
+        for _ in range(2):
+            r = self.get(gamestates_url)
+            self.assertEqual([gs["namespace"] for gs in r.json()], ["other", "test"])
+            self.assertEqual(r.json()[1]["data"], {"hello": "world"})
+            self.assertEqual(r.json()[1]["gamestate_url"], gamestate_url)
+            r = self.get(gamestate_url)
+            self.assertEqual(r.json()["data"], {"hello": "world"})
+
+        self.put(gamestate_url, data={"gamestate": {"hello": "again"}})
+        r = self.get(gamestate_url)
+        self.assertEqual(r.json()["data"], {"hello": "again"})
+        self.assertEqual(r.json()["version"], 2)
+
+        self.delete(gamestate_url)
+        self.get(gamestate_url, expected_status_code=http_client.NOT_FOUND)
+        r = self.get(gamestates_url)
+        self.assertEqual([gs["namespace"] for gs in r.json()], ["other"])
+
+        self.put(gamestate_url, data={"gamestate": {"hello": "new"}})
+        r = self.get(gamestate_url)
+        self.assertEqual(r.json()["data"], {"hello": "new"})
+        self.assertEqual(r.json()["version"], 1)
+
+    def test_gamestate_patch(self):
+        self.auth(username=uuid_string())
+        player_url = self.endpoints["my_player"]
+        resp = self.get(player_url)
+        gamestate_url = resp.json()["gamestates_url"] + "/test"
+        self.patch(gamestate_url, data=[{"op": "add", "path": "/a", "value": 1}],
+                   expected_status_code=http_client.NOT_FOUND)
+
+        r = self.put(gamestate_url, data={"gamestate": {"a": 1, "b": {"c": [1, 2]}}})
+        etag = r.headers["ETag"]
+        patch = [
+            {"op": "replace", "path": "/a", "value": 2},
+            {"op": "add", "path": "/b/c/-", "value": 3},
+            {"op": "add", "path": "/d", "value": "new"},
+        ]
+        r = self._with_headers({"If-Match": etag}, self.patch, gamestate_url, data=patch)
+        self.assertEqual(r.json()["data"], {"a": 2, "b": {"c": [1, 2, 3]}, "d": "new"})
+        self.assertEqual(r.json()["version"], 2)
+
+        # the old ETag no longer matches
+        self._with_headers({"If-Match": etag}, self.patch, gamestate_url, data=patch,
+                           expected_status_code=http_client.PRECONDITION_FAILED)
+        # failing 'test' operations and bad paths leave the gamestate untouched
+        self.patch(gamestate_url, data=[{"op": "test", "path": "/a", "value": 1}],
+                   expected_status_code=http_client.UNPROCESSABLE_ENTITY)
+        self.patch(gamestate_url, data=[{"op": "remove", "path": "/nope"}],
+                   expected_status_code=http_client.UNPROCESSABLE_ENTITY)
+        r = self.get(gamestate_url)
+        self.assertEqual(r.json()["version"], 2)
+
+        history_list = self.get(r.json()["gamestatehistory_url"] + "?include_data=true").json()
+        self.assertEqual(history_list[0]["data"], r.json()["data"])
+
     def test_gamestate_history(self):
         self.auth(username=uuid_string())
         player_url = self.endpoints["my_player"]
@@ -240,6 +345,72 @@ class GameStateTests(DriftBaseTestCase):
         r = self.get(history_list[1]["gamestatehistoryentry_url"])
         self.assertEqual(r.json()["data"], first_data)
 
+    def test_gamestate_history_deltas(self):
+        self.auth(username=uuid_string())
+        player_url = self.endpoints["my_player"]
+        resp = self.get(player_url)
+        gamestate_url = resp.json()["gamestates_url"] + "/test"
+
+        # write enough versions to span more than one keyframe
+        versions = []
+        for i in range(45):
+            gamestate_data = {"counter": i, "static": {"a": [1, 2, 3]}, "items": list(range(i % 5))}
+            if i % 3:
+                gamestate_data["sometimes"] = "here"
+            versions.append(gamestate_data)
+            self.put(gamestate_url, data={"gamestate": gamestate_data})
+
+        r = self.get(gamestate_url)
+        self.assertEqual(r.json()["data"], versions[-1])
+        history_url = r.json()["gamestatehistory_url"]
+        history_list = self.get(history_url + "?include_data=true").json()
+        self.assertEqual(len(history_list), len(versions))
+        self.assertEqual([h["data"] for h in history_list], list(reversed(versions)))
+        for i in (0, 1, 19, 20, 21, 44):
+            entry = history_list[len(versions) - 1 - i]
+            r = self.get(entry["gamestatehistoryentry_url"])
+            self.assertEqual(r.json()["data"], versions[i])
+            self.assertEqual(r.json()["version"], i + 1)
+            self.assertNotIn("packed_data", r.json())
+
+        # pages continue where the last one ended and only include data when asked to
+        page = self.get(history_url, params={"rows": 10, "before_gamestatehistory_id":
+                                             history_list[4]["gamestatehistory_id"]}).json()
+        self.assertEqual([h["gamestatehistory_id"] for h in page],
+                         [h["gamestatehistory_id"] for h in history_list[5:15]])
+        self.assertNotIn("data", page[0])
+        page = self.get(history_url, params={"rows": 10, "include_data": "true",
+                                             "before_gamestatehistory_id":
+                                             history_list[4]["gamestatehistory_id"]}).json()
+        self.assertEqual([h["data"] for h in page], [h["data"] for h in history_list[5:15]])
+
+
+class GameStateCacheTests(unittest.TestCase):
+    def test_redis_errors_are_cache_misses(self):
+        cache = mock.Mock()
+        cache.conn.hget.side_effect = redis.ConnectionError("unittest")
+        cache.conn.hgetall.side_effect = redis.ConnectionError("unittest")
+        with Flask(__name__).app_context():
+            self.assertIsNone(get_cached_gamestate(cache, 1, "test"))
+            self.assertIsNone(get_cached_gamestates(cache, 1))
+
+
+class PruneHistoryTests(unittest.TestCase):
+    def prune(self, num_rows, keep_versions):
+        create_date = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+        rows = [mock.Mock(gamestatehistory_id=i, create_date=create_date, is_delta=False,
+                          base_gamestatehistory_id=None)
+                for i in range(num_rows)]
+        db_session = mock.Mock()
+        db_session.query.return_value.filter.return_value.order_by.return_value.all.return_value = rows
+        return prune_history(db_session, 1, "test", keep_versions, keep_days=7)
+
+    def test_keep_versions(self):
+        self.assertEqual(self.prune(5, keep_versions=2), 3)
+        self.assertEqual(self.prune(5, keep_versions=10), 0)
+        # keeping no versions prunes every row outside of 'keep_days'
+        self.assertEqual(self.prune(5, keep_versions=0), 5)
+
 
 if __name__ == '__main__':
     unittest.main()
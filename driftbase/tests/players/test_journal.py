@@ -226,6 +226,43 @@ class JournalTests(DriftBaseTestCase):
         r = self.get(self.journal_url + "?rows=1000")
         self.assertEqual(len(r.json()), NUM_ENTRIES * 2 + MIN_ENTRIES)
 
+    def test_journal_partial_batch(self):
+        self.init_player()
+
+        # a batch which fails part of the way through keeps the entries before the failure
+        journal_id = self.get_latest_journal_id() + 1
+        data = [self.get_journal_entry("partial.%s" % i, journal_id + i) for i in range(3)]
+        data.append(self.get_journal_entry("partial.duplicate", journal_id + 2))
+        r = self.post(self.journal_url, data, expected_status_code=http_client.BAD_REQUEST)
+        self.assertIn("out of sequence", r.json()["error"]["description"])
+        accepted = [entry["journal_id"] for entry in r.json()["error"]["accepted"]]
+        self.assertEqual(accepted, [journal_id, journal_id + 1, journal_id + 2])
+        self.assertEqual(self.get_latest_journal_id(), journal_id + 2)
+
+    def test_journal_paging_and_export(self):
+        self.init_player()
+
+        journal_id = self.get_latest_journal_id() + 1
+        data = [self.get_journal_entry("paging.%s" % i, journal_id + i) for i in range(25)]
+        self.post(self.journal_url, data, expected_status_code=http_client.CREATED)
+
+        # page through the journal, newest first
+        journal_ids = []
+        params = {"rows": 10}
+        while True:
+            page = self.get(self.journal_url, params=params).json()
+            if not page:
+                break
+            journal_ids += [entry["journal_id"] for entry in page]
+            params["before_journal_id"] = page[-1]["journal_id"]
+        self.assertEqual(journal_ids, sorted(journal_ids, reverse=True))
+        self.assertEqual(len(journal_ids), len(set(journal_ids)))
+        self.assertTrue(set(range(journal_id, journal_id + 25)) <= set(journal_ids))
+
+        # the export holds the whole journal, oldest first
+        r = self.get(self.journal_url + "/export")
+        self.assertEqual([entry["journal_id"] for entry in r.json()], sorted(journal_ids))
+
     def test_journal_journalid(self):
         self.init_player()
 
@@ -1,7 +1,12 @@
+import contextlib
+import json
+
+from flask import g
 from six.moves import http_client
 
 from drift.systesthelper import setup_tenant, remove_tenant
 
+from driftbase.players import RETENTION_IN_SEC
 from driftbase.utils.test_utils import BaseCloudkitTest
 
 
@@ -77,6 +82,8 @@ class PlayerGroupsTest(BaseCloudkitTest):
         # Fetch the data again and compare
         r = self.get(pg_url('my_friends'))
         self.assertEqual(r.json(), pg)
+        for row in pg['players']:
+            self.assertTrue(row['player_url'].endswith('/players/%s' % row['player_id']))
 
         # Make sure duplicates are eliminated
         data = {
@@ -122,3 +129,65 @@ class PlayerGroupsTest(BaseCloudkitTest):
         self.put(pg_url, data={'player_ids': [123456]}, expected_status_code=http_client.OK)
         players = self.get(self.endpoints["players"] + "?player_group=empty_group").json()
         self.assertEqual(len(players), 0)
+
+    def test_playergroup_storage(self):
+        self.make_player(username="Number one user")
+        p1 = self.player_id
+        self.make_player(username="Number two user")
+        p2 = self.player_id
+
+        pg_url = self.endpoints["my_player_groups"].replace('{group_name}', 'stored')
+        self.put(pg_url, data={'player_ids': [p1, p2]}, expected_status_code=http_client.OK)
+
+        # the group is a hash of attributes, a hash of player info and a set of player ids
+        with self.redis_context():
+            key = g.redis.make_key("playergroups:{}.stored".format(p2))
+            conn = g.redis.conn
+            self.assertEqual(conn.type(key), b"hash")
+            self.assertEqual(int(conn.hget(key, "player_id")), p2)
+            self.assertEqual(conn.type(key + ":players"), b"hash")
+            info = json.loads(conn.hget(key + ":players", p1))
+            self.assertEqual(info["identity_name"], "Number one user")
+            self.assertEqual(conn.smembers(key + ":members"), {str(p1).encode(), str(p2).encode()})
+            for k in (key, key + ":players", key + ":members"):
+                self.assertGreater(conn.ttl(k), 0)
+
+    def test_legacy_playergroup(self):
+        self.make_player(username="Number one user")
+        p1 = self.player_id
+        self.make_player(username="Number two user")
+
+        # groups stored as a single blob by earlier versions are still readable
+        legacy = {
+            "group_name": "legacy",
+            "player_id": self.player_id,
+            "players": [{"player_id": p1, "player_name": "", "identity_name": "Number one user"}],
+            "secret": "abc",
+        }
+        with self.redis_context():
+            g.redis.set("playergroup:{}.legacy".format(self.player_id), json.dumps(legacy),
+                        expire=RETENTION_IN_SEC)
+
+        pg_url = self.endpoints["my_player_groups"].replace('{group_name}', 'legacy')
+        pg = self.get(pg_url).json()
+        self.assertEqual([player["player_id"] for player in pg["players"]], [p1])
+        self.assertIn("player_url", pg["players"][0])
+        players = self.get(self.endpoints["players"] + "?player_group=legacy").json()
+        self.assertEqual([player["player_id"] for player in players], [p1])
+
+        # and are replaced when the group is stored again
+        self.put(pg_url, data={'player_ids': [self.player_id]}, expected_status_code=http_client.OK)
+        with self.redis_context():
+            self.assertIsNone(g.redis.get("playergroup:{}.legacy".format(self.player_id)))
+        players = self.get(self.endpoints["players"] + "?player_group=legacy").json()
+        self.assertEqual([player["player_id"] for player in players], [self.player_id])
+
+    @contextlib.contextmanager
+    def redis_context(self):
+        app = self.app.application
+        with app.test_request_context():
+            app.preprocess_request()
+            try:
+                yield
+            finally:
+                app.do_teardown_request()
@@ -1,5 +1,6 @@
 import copy
 
+import mock
 from six.moves import http_client
 
 from drift.systesthelper import setup_tenant, remove_tenant
@@ -27,10 +28,11 @@ class SummaryTests(BaseCloudkitTest):
 
         new_summary = copy.copy(summary)
         summary = {"gold": 200}
-        self.patch(summary_url, data=summary)
-        r = self.get(summary_url)
+        r = self.patch(summary_url, data=summary)
         # the summary should now be the same as before with the addition of the new data
         new_summary.update(summary)
+        self.assertEqual({row["name"]: row["value"] for row in r.json()}, new_summary)
+        r = self.get(summary_url)
         self.assertEqual(r.json(), new_summary)
 
         # check that we get a 404 if the player doesn't exist
@@ -41,3 +43,46 @@ class SummaryTests(BaseCloudkitTest):
         summary_url = self.endpoints["my_summary"]
         summary = {"gold": 100, "cement": 200, "happiness": -1, "oranges": 1}
         self.put(summary_url, data=summary)
+
+    def test_summaries(self):
+        self.make_player()
+        other_player_id = self.player_id
+        self.patch(self.endpoints["my_summary"], data={"gold": 10, "silver": 20})
+        self.make_player()
+        self.patch(self.endpoints["my_summary"], data={"gold": 30})
+
+        r = self.get("/players/summaries",
+                     params={"player_id": [other_player_id, self.player_id, 999999]})
+        self.assertEqual(r.json(), [
+            {"player_id": other_player_id, "summary": {"gold": 10, "silver": 20}},
+            {"player_id": self.player_id, "summary": {"gold": 30}},
+            {"player_id": 999999, "summary": {}},
+        ])
+
+        r = self.get("/players/summaries",
+                     params={"player_id": [other_player_id, self.player_id], "name": "silver"})
+        self.assertEqual([entry["summary"] for entry in r.json()], [{"silver": 20}, {}])
+
+        self.get("/players/summaries", expected_status_code=http_client.BAD_REQUEST)
+
+    def test_summaries_of_player_group(self):
+        self.make_player()
+        other_player_id = self.player_id
+        self.patch(self.endpoints["my_summary"], data={"gold": 10})
+        self.make_player()
+        self.patch(self.endpoints["my_summary"], data={"gold": 30})
+        group_url = self.endpoints["my_player_groups"].replace("{group_name}", "summarygroup")
+        self.put(group_url, data={"player_ids": [other_player_id, self.player_id]})
+
+        with mock.patch.dict(self.app.application.config, {"player_summary_cache_ttl": 60}):
+            for _ in range(2):
+                # the second time around the summaries are served from the cache
+                r = self.get("/players/summaries", params={"player_group": "summarygroup"})
+                self.assertEqual(sorted((e["player_id"], e["summary"]["gold"]) for e in r.json()),
+                                 sorted([(other_player_id, 10), (self.player_id, 30)]))
+
+            # a change is visible right away
+            self.patch(self.endpoints["my_summary"], data={"gold": 40})
+            r = self.get("/players/summaries", params={"player_group": "summarygroup"})
+            self.assertEqual(sorted((e["player_id"], e["summary"]["gold"]) for e in r.json()),
+                             sorted([(other_player_id, 10), (self.player_id, 40)]))
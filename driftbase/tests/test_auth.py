@@ -1,9 +1,13 @@
+from flask import g
 from mock import patch, MagicMock
 from six.moves import http_client
 
 from drift.systesthelper import setup_tenant, remove_tenant, DriftBaseTestCase
 from drift.utils import get_config
 
+from driftbase.auth import authenticate
+from driftbase.models.db import User, CorePlayer, UserIdentity
+
 
 def setUpModule():
     setup_tenant()
@@ -77,3 +81,40 @@ class AuthTests(DriftBaseTestCase):
             with patch('driftbase.auth.steam._call_check_app_ownership') as mock_own:
                 mock_own.return_value.status_code = 200
                 self.post('/auth', data=data)
+
+    def test_login_loses_identity_creation_race(self):
+        self.auth(username="racing user")
+        user_id, player_id = self.user_id, self.player_id
+
+        # a concurrent login creates the identity between the lookup and the insert
+        query_identity = authenticate._query_identity
+        lookups = []
+
+        def lost_race(username):
+            lookups.append(username)
+            if len(lookups) == 1:
+                return None, None, None, []
+            return query_identity(username)
+
+        with patch('driftbase.auth.authenticate._query_identity', side_effect=lost_race), \
+                patch('driftbase.auth.authenticate._create_identity', return_value=None) as create:
+            self.auth(username="racing user")
+            self.assertEqual(create.call_count, 1)
+            self.assertEqual((self.user_id, self.player_id), (user_id, player_id))
+
+            # the password of the identity created by the other login is checked
+            del lookups[:]
+            data = {"provider": self.auth_provider, "username": "racing user", "password": "wrong"}
+            self.post('/auth', data=data, expected_status_code=http_client.METHOD_NOT_ALLOWED)
+
+        # no duplicate user or player was created
+        app = self.app.application
+        with app.test_request_context():
+            app.preprocess_request()
+            try:
+                self.assertEqual(g.db.query(UserIdentity).filter(UserIdentity.name == "racing user").count(), 1)
+                self.assertEqual(g.db.query(User).filter(User.user_name == "racing user").count(), 1)
+                self.assertEqual(g.db.query(CorePlayer).filter(CorePlayer.user_id == user_id).count(), 1)
+            finally:
+                app.do_teardown_request()
+
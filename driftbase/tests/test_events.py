@@ -1,11 +1,18 @@
 import datetime
+import os
+import unittest
 
 import mock
+from flask import Flask, request
 from six.moves import http_client
 
 from drift.systesthelper import DriftBaseTestCase
 from drift.core.extensions.jwt import current_user
 
+from driftbase import logshipping
+from driftbase.logshipping import LogShipper
+from driftbase.utils import parse_timestamp, verify_log_request
+
 
 class EventsTest(DriftBaseTestCase):
     """
@@ -46,6 +53,13 @@ class EventsTest(DriftBaseTestCase):
         )
         self.assertIn("Invalid timestamp", r.json()["error"]["description"])
 
+        r = self.post(
+            endpoint,
+            data=[{"hello": "world", "event_name": "dummy", "timestamp": 12345}],
+            expected_status_code=http_client.METHOD_NOT_ALLOWED,
+        )
+        self.assertIn("Invalid timestamp", r.json()["error"]["description"])
+
         ts = datetime.datetime.utcnow().isoformat() + "Z"
         r = self.post(
             endpoint,
@@ -53,16 +67,25 @@ class EventsTest(DriftBaseTestCase):
             expected_status_code=http_client.CREATED,
         )
 
+        # Formats datetime.fromisoformat can't handle are still accepted
+        r = self.post(
+            endpoint,
+            data=[{"hello": "world", "event_name": "dummy", "timestamp": "2015-01-01T10:00:00.1234Z"}],
+            expected_status_code=http_client.CREATED,
+        )
+
     def test_events_from_server(self):
         # The event log API should enforce the player_id to the current player, unless
         # the user has role "service" in which case it should only set the player_id if
         # it's not passed in the event.
 
-        def eventlog(message, extra):
+        def eventlog(kind, events):
             expect_player_id = self.expect_player_id or current_user["player_id"]
-            self.assertEqual(extra["extra"]["player_id"], expect_player_id)
+            for event in events:
+                self.assertEqual(event["player_id"], expect_player_id)
+            return 0
 
-        with mock.patch("driftbase.api.events.eventlogger.info", eventlog):
+        with mock.patch("driftbase.api.events.ship_events", eventlog):
             self.auth()
             endpoint = self.endpoints["eventlogs"]
             ts = datetime.datetime.utcnow().isoformat() + "Z"
@@ -83,6 +106,21 @@ class EventsTest(DriftBaseTestCase):
             self.expect_player_id = 88888
             self.post(endpoint, data=[event], expected_status_code=http_client.CREATED)
 
+    def test_shipped_events_carry_request_context(self):
+        # events are logged from the shipper's greenlet, outside of the request
+        self.auth()
+        ts = datetime.datetime.utcnow().isoformat() + "Z"
+        with self.assertLogs("eventlog") as logs:
+            self.post(self.endpoints["eventlogs"], data=[{"event_name": "context_test", "timestamp": ts}],
+                      expected_status_code=http_client.CREATED)
+            for shipper in list(logshipping._shippers.values()):
+                shipper.flush()
+        records = [r for r in logs.records if r.extra.get("event_name") == "context_test"]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].extra["player_id"], self.player_id)
+        self.assertEqual(records[0].extra["user"]["player_id"], self.player_id)
+        self.assertTrue(records[0].extra["tenant"].endswith("." + os.environ["DRIFT_DEFAULT_TENANT"]))
+
     def test_clientlogs(self):
         self.auth()
         self.assertIn("clientlogs", self.endpoints)
@@ -117,3 +155,73 @@ class EventsTest(DriftBaseTestCase):
             data=[{"hello": "world"}],
             expected_status_code=http_client.CREATED,
         )
+
+
+class LogShipperTest(unittest.TestCase):
+
+    def test_batches_and_drops(self):
+        batches = []
+        sink = mock.Mock()
+        sink.write.side_effect = lambda events: batches.append(list(events))
+        shipper = LogShipper("test", sink, buffer_size=5, batch_size=2, flush_interval=60)
+
+        self.assertEqual(shipper.put([{"n": i} for i in range(3)]), 0)
+        # the buffer is bounded, what doesn't fit is dropped
+        self.assertEqual(shipper.put([{"n": i} for i in range(3, 7)]), 2)
+        shipper.flush()
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual([event["n"] for batch in batches for event, _ in batch], [0, 1, 2, 3, 4])
+
+        # events a failing sink can't write are counted as dropped
+        sink.write.side_effect = RuntimeError("sink is down")
+        shipper.put([{"n": 7}])
+        shipper.flush()
+        self.assertEqual(shipper.stats(), {
+            "buffered": 0,
+            "shipped": 5,
+            "dropped_full": 2,
+            "dropped_failed": 1,
+        })
+
+    def test_flush_at_exit(self):
+        sink = mock.Mock()
+        shipper = LogShipper("test", sink, buffer_size=10, batch_size=5, flush_interval=60)
+        with mock.patch.dict(logshipping._shippers, {("test", None): shipper}):
+            shipper.put([{"n": 1}])
+            logshipping.flush_all()
+            self.assertEqual(shipper.stats()["shipped"], 1)
+
+            # what can't be shipped at exit is counted as dropped
+            sink.write.side_effect = RuntimeError("sink is down")
+            shipper.put([{"n": 2}, {"n": 3}])
+            logshipping.flush_all()
+        self.assertEqual(shipper.stats(), {
+            "buffered": 0,
+            "shipped": 1,
+            "dropped_full": 0,
+            "dropped_failed": 2,
+        })
+
+
+class ParseTimestampTest(unittest.TestCase):
+
+    def test_parse_timestamp(self):
+        utc = datetime.timezone.utc
+        self.assertEqual(parse_timestamp("2015-01-01T10:00:00.000Z"),
+                         datetime.datetime(2015, 1, 1, 10, tzinfo=utc))
+        self.assertEqual(parse_timestamp("2015-01-01T10:00:00"),
+                         datetime.datetime(2015, 1, 1, 10))
+        # falls back to dateutil
+        self.assertEqual(parse_timestamp("2015-01-01 10:00:00.5 UTC"),
+                         datetime.datetime(2015, 1, 1, 10, 0, 0, 500000, tzinfo=utc))
+        for timestamp in ["dummy", 12345, None]:
+            with self.assertRaises(ValueError):
+                parse_timestamp(timestamp)
+
+    def test_verify_log_request_keeps_timestamp(self):
+        # the timestamp is validated but shipped the way the client sent it
+        events = [{"event_name": "dummy", "timestamp": "2015-01-01T10:00:00.1234Z"}]
+        with Flask(__name__).test_request_context(json=events):
+            verify_log_request(request, ["event_name", "timestamp"])
+            self.assertEqual(request.json[0]["timestamp"], "2015-01-01T10:00:00.1234Z")
+
@@ -1,8 +1,13 @@
+import datetime
 import re
 import uuid
 
+from flask import g
+from mock import patch
 from six.moves import http_client
 
+from driftbase import friendships
+from driftbase.models.db import FriendInvite
 from driftbase.utils.test_utils import BaseCloudkitTest
 
 
@@ -106,6 +111,32 @@ class FriendsTest(BaseCloudkitTest):
         self.assertEqual(len(friends), 1)
         self.assertEqual(friends[0]["friend_id"], player_id)
 
+    def test_expand_friends(self):
+        # Create players for test
+        self.auth(username="Number one user")
+        p1 = self.player_id
+        token = self.make_token()
+
+        self.auth(username="Number two user")
+        self.post(self.endpoints["my_friends"], data={"token": token}, expected_status_code=http_client.CREATED)
+
+        # friends are not expanded unless asked for
+        friends = self.get(self.endpoints["my_friends"]).json()
+        self.assertNotIn("player", friends[0])
+        self.assertNotIn("presence", friends[0])
+
+        friends = self.get(self.endpoints["my_friends"] + "?expand=player,presence").json()
+        self.assertEqual(len(friends), 1)
+        self.assertEqual(friends[0]["friend_id"], p1)
+        self.assertIn("player_name", friends[0]["player"])
+        self.assertIn("is_online", friends[0]["presence"])
+
+        friends = self.get(self.endpoints["my_friends"] + "?expand=presence").json()
+        self.assertNotIn("player", friends[0])
+        self.assertIn("is_online", friends[0]["presence"])
+
+        self.get(self.endpoints["my_friends"] + "?expand=whatever", expected_status_code=http_client.BAD_REQUEST)
+
     def test_delete_friend(self):
         # Create players for test
         self.auth(username="Number seven user")
@@ -145,6 +176,37 @@ class FriendsTest(BaseCloudkitTest):
         self.assertIsInstance(friends, list)
         self.assertEqual(len(friends), 1)
 
+    def test_mutual_friends(self):
+        # Create players for test
+        self.auth(username="Number eight user")
+        p1 = self.player_id
+        token1 = self.make_token()
+
+        self.auth(username="Number nine user")
+        p2 = self.player_id
+        token2 = self.make_token()
+
+        self.auth(username="Number ten user")
+        p3 = self.player_id
+        self.post(self.endpoints["my_friends"], data={"token": token1}, expected_status_code=http_client.CREATED)
+        result = self.post(self.endpoints["my_friends"], data={"token": token2},
+                           expected_status_code=http_client.CREATED).json()
+
+        self.auth(username="Number eight user")
+        mutual_url = self.endpoints["my_friends"] + "/mutual/%s" % p2
+        friends = self.get(mutual_url).json()
+        self.assertEqual([f["friend_id"] for f in friends], [p3])
+
+        # the cache follows deleted friendships
+        self.auth(username="Number ten user")
+        self.delete(result["url"], expected_status_code=http_client.NO_CONTENT)
+
+        self.auth(username="Number eight user")
+        friends = self.get(mutual_url).json()
+        self.assertEqual(friends, [])
+        self.get(self.endpoints["my_friends"].rsplit("/", 1)[0] + "/%s/mutual/%s" % (p2, p1),
+                 expected_status_code=http_client.FORBIDDEN)
+
     def test_cannot_add_self_as_friend(self):
 
         # Create player for test
@@ -171,6 +233,20 @@ class FriendsTest(BaseCloudkitTest):
         self.assertEqual(response['error']['code'], "user_error")
         self.assertEqual(response['error']['description'], "The invite was not found!")
 
+    def test_cannot_add_player_as_friend_with_deleted_token(self):
+        self.auth(username="Number one user")
+        result = self.post(self.endpoints["friend_invites"], expected_status_code=http_client.CREATED).json()
+        self.delete(result["url"], expected_status_code=http_client.NO_CONTENT)
+
+        self.auth(username="Number four user")
+        result = self.post(self.endpoints["my_friends"], data={"token": result["token"]},
+                           expected_status_code=http_client.FORBIDDEN)
+        self.assertEqual(result.json()['error']['description'], "The invite has been deleted!")
+
+        # tokens which aren't uuids can't be invites
+        self.post(self.endpoints["my_friends"], data={"token": "not-a-token"},
+                  expected_status_code=http_client.NOT_FOUND)
+
     def test_adding_same_friend_twice_changes_nothing(self):
         # Create players for test
         self.auth(username="Number one user")
@@ -191,3 +267,81 @@ class FriendsTest(BaseCloudkitTest):
 
     def make_token(self):
         return self.post(self.endpoints["friend_invites"], expected_status_code=http_client.CREATED).json()["token"]
+
+
+class FriendRedisInvitesTest(BaseCloudkitTest):
+    """
+    Tests for invites with 'invites_in_redis' enabled for the tenant
+    """
+    def setUp(self):
+        super(FriendRedisInvitesTest, self).setUp()
+        patcher = patch("driftbase.api.friendships._invites_in_redis", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_add_friend(self):
+        self.auth(username="Number one user")
+        p1 = self.player_id
+        result = self.post(self.endpoints["friend_invites"], expected_status_code=http_client.CREATED).json()
+        self.assertTrue(result["url"].endswith("/invites/%s" % result["token"]))
+
+        self.auth(username="Number two user")
+        self.post(self.endpoints["my_friends"], data={"token": result["token"]},
+                  expected_status_code=http_client.CREATED)
+        friends = self.get(self.endpoints["my_friends"]).json()
+        self.assertEqual(len(friends), 1)
+        self.assertEqual(friends[0]["friend_id"], p1)
+
+    def test_delete_invite(self):
+        self.auth(username="Number one user")
+        result = self.post(self.endpoints["friend_invites"], expected_status_code=http_client.CREATED).json()
+
+        self.auth(username="Number two user")
+        self.delete(result["url"], expected_status_code=http_client.FORBIDDEN)
+
+        self.auth(username="Number one user")
+        self.delete(result["url"], expected_status_code=http_client.NO_CONTENT)
+        self.delete(result["url"], expected_status_code=http_client.NOT_FOUND)
+
+        self.auth(username="Number two user")
+        response = self.post(self.endpoints["my_friends"], data={"token": result["token"]},
+                             expected_status_code=http_client.NOT_FOUND).json()
+        self.assertEqual(response['error']['description'], "The invite was not found!")
+
+
+class FriendInviteReaperTest(BaseCloudkitTest):
+    """
+    Tests for reaping expired friend invites from the db
+    """
+    def test_reap_friend_invites(self):
+        self.auth(username="Number one user")
+        live = self.post(self.endpoints["friend_invites"], expected_status_code=http_client.CREATED).json()
+        deleted = self.post(self.endpoints["friend_invites"], expected_status_code=http_client.CREATED).json()
+        self.delete(deleted["url"], expected_status_code=http_client.NO_CONTENT)
+        expired = self.post(self.endpoints["friend_invites"], expected_status_code=http_client.CREATED).json()
+
+        app = self.app.application
+        with app.test_request_context():
+            app.preprocess_request()
+            try:
+                invite = g.db.query(FriendInvite).filter(FriendInvite.token == expired["token"]).one()
+                invite.expiry_date = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+                g.db.commit()
+
+                with patch.dict(app.config, {"friend_invite_retention_seconds": 0}):
+                    self.assertEqual(friendships.reap_friend_invites(g.db, batch_size=1), 2)
+
+                tokens = [invite.token for invite in g.db.query(FriendInvite).filter(
+                    FriendInvite.issued_by_player_id == self.player_id)]
+                self.assertEqual(tokens, [uuid.UUID(live["token"])])
+            finally:
+                app.do_teardown_request()
+
+        # reaped invites are gone rather than deleted or expired
+        self.auth(username="Number two user")
+        for invite in [deleted, expired]:
+            response = self.post(self.endpoints["my_friends"], data={"token": invite["token"]},
+                                 expected_status_code=http_client.NOT_FOUND).json()
+            self.assertEqual(response['error']['description'], "The invite was not found!")
+        self.post(self.endpoints["my_friends"], data={"token": live["token"]},
+                  expected_status_code=http_client.CREATED)
@@ -42,7 +42,16 @@ class MachinesTest(DriftBaseTestCase):
         self.assertEqual(resp.json()["realm"], data["realm"])
         self.assertEqual(resp.json()["instance_name"], data["instance_name"])
         resp.json()["machine_id"]
-        # ! TODO: System tests are currently offline. Will continue this later and add PUT tests
+
+        resp = self.put(url, data={"status": {"state": "running"}})
+        self.assertIn("last_heartbeat", resp.json())
+        events = [{"event": "server_started", "timestamp": "2020-01-01T10:00:00.000Z"},
+                  {"event": "server_stopped", "timestamp": "2020-01-01T10:01:00.000Z"}]
+        resp = self.put(url, data={"events": events})
+        resp = self.get(url)
+        self.assertEqual(resp.json()["status"], {"state": "running"})
+
+        self.put("/machines/9999999", data={}, expected_status_code=http_client.NOT_FOUND)
 
     def test_get_awsmachine(self):
         self.auth_service()
@@ -1,8 +1,12 @@
 import collections
 import datetime
+import unittest
+
+import redis
 from six.moves import http_client
-from mock import patch
+from mock import patch, MagicMock
 from drift.systesthelper import uuid_string
+from driftbase.matchqueue import filter_alive_servers
 from driftbase.utils.test_utils import BaseMatchTest
 
 
@@ -581,3 +585,31 @@ class MatchQueueTest(BaseMatchTest):
         r = self.get(matchqueueplayer2_url)
         self.assertEqual(r.json()["status"], "matched")
         self.assertEqual(r.json()["match_id"], match["match_id"])
+
+
+class FilterAliveServersTest(unittest.TestCase):
+
+    def test_filter_alive_servers(self):
+        now = datetime.datetime.utcnow()
+        since = now - datetime.timedelta(seconds=60)
+        recent, old = now - datetime.timedelta(seconds=5), now - datetime.timedelta(seconds=90)
+
+        def server(server_id, heartbeat_date):
+            return MagicMock(server_id=server_id, heartbeat_date=heartbeat_date)
+
+        rows = [
+            ("match", server(1, old)),     # heartbeated since the last flush
+            ("match", server(2, recent)),  # stopped heartbeating, the fast store is authoritative
+            ("match", server(3, recent)),  # not in the fast store
+            ("match", server(4, None)),
+        ]
+        fast_store = {1: (recent, 1), 2: (old, 0)}
+        with patch("driftbase.matchqueue.get_heartbeats", return_value=fast_store):
+            alive = filter_alive_servers(None, rows, since, server_index=1)
+        self.assertEqual([row[1].server_id for row in alive], [1, 3])
+
+        # the DB heartbeat dates are used if the fast store can't be read
+        with patch("driftbase.matchqueue.get_heartbeats", side_effect=redis.ConnectionError()):
+            alive = filter_alive_servers(None, rows, since, server_index=1)
+        self.assertEqual([row[1].server_id for row in alive], [2, 3])
+
@@ -161,6 +161,13 @@ class ServersTest(DriftBaseTestCase):
         self.assertEqual(resp.json()["heartbeat_count"], 1)
         self.assertTrue(resp.json()["heartbeat_date"] > heartbeat_date)
 
+        self.put(heartbeat_url)
+        self.put(heartbeat_url)
+        resp = self.get(url)
+        self.assertEqual(resp.json()["heartbeat_count"], 3)
+
+        self.put("/servers/999999/heartbeat", expected_status_code=http_client.NOT_FOUND)
+
     def test_newdaemoncommand(self):
         """
         Tests for the /servers/[server_id]/commands service endpoints
@@ -201,6 +208,31 @@ class ServersTest(DriftBaseTestCase):
         resp = self.get(server_url)
         self.assertEqual(len(resp.json()["pending_commands"]), 2)
 
+    def test_daemoncommands_longpoll(self):
+        self.auth_service()
+        machine_id = self._create_machine()["machine_id"]
+        data = self._get_server_data(machine_id)
+        resp = self.post("/servers", data=data, expected_status_code=http_client.CREATED)
+        commands_url = resp.json()["commands_url"]
+
+        # no pending commands so the long poll times out with an empty list
+        resp = self.get(commands_url + "?wait=1")
+        self.assertEqual(resp.json(), [])
+
+        resp = self.post(commands_url, data={"command": "dance_the_polka"},
+                         expected_status_code=http_client.CREATED)
+        command_url = resp.json()["url"]
+        resp = self.get(commands_url + "?wait=1")
+        self.assertEqual(len(resp.json()), 1)
+        self.assertEqual(resp.json()[0]["command"], "dance_the_polka")
+
+        # completed commands are only returned without 'wait'
+        self.patch(command_url, {"status": "completed"})
+        resp = self.get(commands_url + "?wait=0")
+        self.assertEqual(resp.json(), [])
+        resp = self.get(commands_url)
+        self.assertEqual(len(resp.json()), 1)
+
     def test_setdaemoncommandstatus(self):
         """
         Tests for the /servers/[server_id]/commands service endpoints
@@ -1,3 +1,4 @@
+import datetime
 import json
 import logging
 from dateutil import parser
@@ -9,6 +10,7 @@ from flask import g, url_for
 from flask_smorest import abort
 
 from driftbase.models.db import Counter, MatchEvent
+from driftbase.eventbuffer import queue_event
 log = logging.getLogger(__name__)
 
 EXPIRE_SECONDS = 86400
@@ -57,18 +59,20 @@ def clear_counter_cache():
 
 
 def log_match_event(match_id, player_id, event_type_name, details=None, db_session=None):
-
+    """
+    Log a match event. The event is written when the session is committed,
+    which is up to the caller.
+    """
     if not db_session:
         db_session = g.db
 
     log.info("Logging player event to DB: player_id=%s, event=%s", player_id, event_type_name)
-    event = MatchEvent(event_type_id=None,
-                       event_type_name=event_type_name,
-                       player_id=player_id,
-                       match_id=match_id,
-                       details=details)
-    db_session.add(event)
-    db_session.commit()
+    queue_event(db_session, MatchEvent,
+                event_type_id=None,
+                event_type_name=event_type_name,
+                player_id=player_id,
+                match_id=match_id,
+                details=details)
 
 
 class UserCache(object):
@@ -108,32 +112,55 @@ class UserCache(object):
         return self.cache.delete(self._key(user_id))
 
 
+def parse_timestamp(timestamp):
+    """
+    Parse an ISO-8601 timestamp. The common forms are handled by
+    datetime.fromisoformat, anything else falls back to dateutil.
+    Raises ValueError if the timestamp can't be parsed.
+    """
+    if not isinstance(timestamp, str):
+        raise ValueError("Timestamp must be a string")
+    try:
+        if timestamp.endswith("Z"):
+            return datetime.datetime.fromisoformat(timestamp[:-1] + "+00:00")
+        return datetime.datetime.fromisoformat(timestamp)
+    except ValueError:
+        try:
+            return parser.parse(timestamp)
+        except OverflowError as e:
+            raise ValueError(str(e))
+
+
 def verify_log_request(request, required_keys=None):
+    """
+    Validate the list of log events in the request body. Timestamps are only
+    checked, the events are shipped with the timestamps the client sent.
+    """
     args = request.json
     if not isinstance(args, list):
         abort(http_client.METHOD_NOT_ALLOWED, message="This endpoint only accepts a list of dicts")
     if not args:
         log.warning("Invalid log request. No loglines.")
         abort(http_client.METHOD_NOT_ALLOWED, message="This endpoint only accepts a list of dicts")
+    required_keys = required_keys or []
     for event in args:
         if not isinstance(event, dict):
             log.warning("Invalid log request. Entry not dict: %s", event)
             abort(http_client.METHOD_NOT_ALLOWED, message="This endpoint only accepts a list of dicts")
-        if required_keys:
-            for key in required_keys:
-                if key not in event:
-                    log.warning("Invalid log request. Missing required key '%s' from %s",
-                                key, event)
-                    abort(http_client.METHOD_NOT_ALLOWED,
-                          message="Required key, '%s' missing from event" % key)
+        for key in required_keys:
+            if key not in event:
+                log.warning("Invalid log request. Missing required key '%s' from %s",
+                            key, event)
+                abort(http_client.METHOD_NOT_ALLOWED,
+                      message="Required key, '%s' missing from event" % key)
         if "timestamp" in event:
             try:
-                parser.parse(event["timestamp"])
+                parse_timestamp(event["timestamp"])
             except ValueError:
                 log.warning("Invalid log request. Timestamp %s could not be parsed for %s",
                             event["timestamp"], event)
                 abort(http_client.METHOD_NOT_ALLOWED, message="Invalid timestamp, '%s' in event '%s'" %
-                      (event["timestamp"], event["event_name"]))
+                      (event["timestamp"], event.get("event_name")))
 
 
 def url_user(user_id):
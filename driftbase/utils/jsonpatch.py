@@ -0,0 +1,152 @@
+"""
+    Minimal implementation of JSON Patch (RFC 6902) and JSON Pointer (RFC 6901)
+
+    make_patch() produces a list of patch operations which transform one document
+    into another and apply_patch() applies a list of operations to a document.
+"""
+import copy
+
+
+class JsonPatchError(Exception):
+    pass
+
+
+def _escape(token):
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _split_pointer(pointer):
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise JsonPatchError("Invalid JSON pointer '%s'" % pointer)
+    return [_unescape(token) for token in pointer[1:].split("/")]
+
+
+def _list_index(container, token, allow_end=False):
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (token != "0" and token.startswith("0")):
+        raise JsonPatchError("Invalid array index '%s'" % token)
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise JsonPatchError("Array index %s out of range" % index)
+    return index
+
+
+def _resolve(doc, tokens):
+    for token in tokens:
+        if isinstance(doc, dict):
+            if token not in doc:
+                raise JsonPatchError("Member '%s' not found" % token)
+            doc = doc[token]
+        elif isinstance(doc, list):
+            doc = doc[_list_index(doc, token)]
+        else:
+            raise JsonPatchError("Cannot resolve '%s' in a scalar value" % token)
+    return doc
+
+
+def _add(doc, tokens, value):
+    if not tokens:
+        return value
+    parent = _resolve(doc, tokens[:-1])
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_list_index(parent, token, allow_end=True), value)
+    else:
+        raise JsonPatchError("Cannot add '%s' to a scalar value" % token)
+    return doc
+
+
+def _remove(doc, tokens):
+    if not tokens:
+        raise JsonPatchError("Cannot remove the document root")
+    parent = _resolve(doc, tokens[:-1])
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise JsonPatchError("Member '%s' not found" % token)
+        return parent.pop(token)
+    elif isinstance(parent, list):
+        return parent.pop(_list_index(parent, token))
+    raise JsonPatchError("Cannot remove '%s' from a scalar value" % token)
+
+
+def apply_patch(doc, patch):
+    """
+    Returns a copy of 'doc' with the operations in 'patch' applied.
+    Raises JsonPatchError if the patch is malformed or cannot be applied.
+    """
+    if not isinstance(patch, list):
+        raise JsonPatchError("A JSON patch must be a list of operations")
+    doc = copy.deepcopy(doc)
+    for operation in patch:
+        if not isinstance(operation, dict) or "op" not in operation or "path" not in operation:
+            raise JsonPatchError("Invalid patch operation %s" % (operation, ))
+        op = operation["op"]
+        tokens = _split_pointer(operation["path"])
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise JsonPatchError("Operation '%s' requires a 'value'" % op)
+        if op in ("move", "copy") and "from" not in operation:
+            raise JsonPatchError("Operation '%s' requires a 'from'" % op)
+
+        if op == "add":
+            doc = _add(doc, tokens, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            _remove(doc, tokens)
+        elif op == "replace":
+            if not tokens:
+                doc = copy.deepcopy(operation["value"])
+            else:
+                _remove(doc, tokens)
+                doc = _add(doc, tokens, copy.deepcopy(operation["value"]))
+        elif op == "move":
+            from_tokens = _split_pointer(operation["from"])
+            if tokens[:len(from_tokens)] == from_tokens and tokens != from_tokens:
+                raise JsonPatchError("Cannot move a value into one of its children")
+            value = _remove(doc, from_tokens)
+            doc = _add(doc, tokens, value)
+        elif op == "copy":
+            value = _resolve(doc, _split_pointer(operation["from"]))
+            doc = _add(doc, tokens, copy.deepcopy(value))
+        elif op == "test":
+            if _resolve(doc, tokens) != operation["value"]:
+                raise JsonPatchError("Test failed for path '%s'" % operation["path"])
+        else:
+            raise JsonPatchError("Unknown patch operation '%s'" % op)
+    return doc
+
+
+def make_patch(src, dst, path=""):
+    """Returns a list of patch operations which transform 'src' into 'dst'."""
+    # Note that 1 == 1.0 == True in Python so the types must be compared as well
+    if type(src) != type(dst):
+        return [{"op": "replace", "path": path, "value": dst}]
+    if isinstance(src, dict):
+        patch = []
+        for key in src:
+            if key not in dst:
+                patch.append({"op": "remove", "path": path + "/" + _escape(key)})
+        for key, value in dst.items():
+            if key not in src:
+                patch.append({"op": "add", "path": path + "/" + _escape(key), "value": value})
+            else:
+                patch += make_patch(src[key], value, path + "/" + _escape(key))
+        return patch
+    if isinstance(src, list):
+        if len(src) != len(dst):
+            return [{"op": "replace", "path": path, "value": dst}]
+        patch = []
+        for i, (a, b) in enumerate(zip(src, dst)):
+            patch += make_patch(a, b, path + "/" + str(i))
+        return patch
+    if src != dst:
+        return [{"op": "replace", "path": path, "value": dst}]
+    return []
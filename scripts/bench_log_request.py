@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of log request validation.
+
+Times the parsing of event timestamps with dateutil against
+driftbase.utils.parse_timestamp, and a full verify_log_request pass, on a
+payload of 1000 events.
+"""
+import datetime
+import timeit
+
+import click
+from dateutil import parser
+from flask import Flask, request
+
+from driftbase.utils import parse_timestamp, verify_log_request
+
+
+def make_payload(num_events):
+    now = datetime.datetime.utcnow()
+    return [
+        {
+            "event_name": "bench_event",
+            "timestamp": (now + datetime.timedelta(milliseconds=i)).isoformat()[:-3] + "Z",
+            "value": i,
+        }
+        for i in range(num_events)
+    ]
+
+
+def report(name, seconds, number, num_events):
+    per_payload = seconds / number
+    click.echo("{:<24} {:8.2f} ms/payload {:8.2f} us/event".format(
+        name, per_payload * 1000, per_payload / num_events * 1e6))
+
+
+@click.command()
+@click.option("--events", default=1000, help="Number of events in the payload.")
+@click.option("--number", default=50, help="Number of times each payload is processed.")
+def cli(events, number):
+    payload = make_payload(events)
+    timestamps = [event["timestamp"] for event in payload]
+
+    seconds = timeit.timeit(lambda: [parser.parse(ts) for ts in timestamps], number=number)
+    report("dateutil", seconds, number, events)
+
+    seconds = timeit.timeit(lambda: [parse_timestamp(ts) for ts in timestamps], number=number)
+    report("parse_timestamp", seconds, number, events)
+
+    app = Flask(__name__)
+
+    def verify():
+        with app.test_request_context(json=payload):
+            verify_log_request(request, ["event_name", "timestamp"])
+
+    seconds = timeit.timeit(verify, number=number)
+    report("verify_log_request", seconds, number, events)
+
+
+if __name__ == "__main__":
+    cli()
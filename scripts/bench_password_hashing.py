@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of password hashing.
+
+Reports logins per second on a single core for each hashing scheme in
+driftbase.auth.passwords. A login is one password check against a stored hash,
+which is what a returning device or user costs.
+"""
+import timeit
+
+import click
+
+from driftbase.auth import passwords
+
+
+@click.command()
+@click.option("--seconds", default=2.0, help="Approximate run time per scheme.")
+def cli(seconds):
+    password = "a6c5b1f2-7d3e-4c8a-9f1b-2e4d6a8c0b3f"
+    hmac_keys = {"1": "benchmark key"}
+    for scheme in [passwords.HMAC, passwords.PBKDF2, passwords.SCRYPT]:
+        pwhash = passwords.hash_password(password, scheme, hmac_keys, "1")
+        timer = timeit.Timer(lambda: passwords.check_password(pwhash, password, hmac_keys))
+        number, elapsed = timer.autorange()
+        number = max(1, int(number * seconds / elapsed))
+        elapsed = timer.timeit(number=number)
+        click.echo("{:<8} {:10.0f} logins/s/core {:10.3f} ms/login".format(
+            scheme, number / elapsed, elapsed / number * 1000))
+
+
+if __name__ == "__main__":
+    cli()